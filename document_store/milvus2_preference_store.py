@@ -1,22 +1,177 @@
 import logging
+import math
 from typing import Any, Optional
 
-from pymilvus import Collection, CollectionSchema, FieldSchema, utility
+from pymilvus import (
+    Collection,
+    CollectionSchema,
+    FieldSchema,
+    Index,
+    MilvusClient,
+    utility,
+)
 from pymilvus.client.types import DataType
 
-from utils.milvus_utils import connect2milvusdb
+from config.config_loader import config
+from document_store.preference_categories import (
+    CATEGORY_FIELDS,
+    COMPACT_CATEGORIES,
+    encode_categories,
+)
+from document_store.preference_session_cache import invalidate_user
+from document_store.write_behind_buffer import WriteBehindBuffer
+from utils.milvus_utils import (
+    connection_alias,
+    get_database_backend,
+    get_milvus_client,
+)
 
 logger = logging.getLogger(__name__)
 
+# a search filtered by user_name only scans the partition the user is hashed to (partition key),
+# so the index is chosen by the size of the largest partition and not by the size of the collection
+FLAT_MAX_PARTITION_SIZE = config.getint(
+    "database", "flat_max_partition_size", fallback=100000
+)
+HNSW_MAX_PARTITION_SIZE = config.getint(
+    "database", "hnsw_max_partition_size", fallback=2000000
+)
+# quantized vector index instead of the float32 vectors (see select_index): none | sq8 | pq
+QUANTIZATION = config.get("database", "quantization", fallback="none")
+QUANTIZED_INDEX_TYPES = {"sq8": "IVF_SQ8", "pq": "IVF_PQ"}
+EMBEDDING_DIM = config.getint("embedding", "dim", fallback=1536)
+
+# the maintenance and retrieval lookups filter on these fields by equality
+SCALAR_INDEX_FIELDS = ["user_name", "main_category", "subcategory", "detail_category"]
+
+
+def _nlist(max_partition_size: int) -> int:
+    return min(
+        65536,
+        max(16, 2 ** round(math.log2(4 * math.sqrt(max(1, max_partition_size))))),
+    )
+
+
+def select_index(
+    num_entities: int, max_partition_size: int, quantization: str = QUANTIZATION
+) -> dict:
+    """
+    returns the index params for the collection size:
+    FLAT (exact) while the scanned partitions are small, HNSW for medium and IVF_FLAT for very large partitions,
+    with nlist ~ 4 * sqrt(entities per partition).
+    with quantization 'sq8' (1 byte per dimension) or 'pq' (1 byte per 16 dimensions) the vectors are always
+    indexed with IVF_SQ8 or IVF_PQ, trading recall for memory (see retrieval/quantization_report.py).
+    """
+    if get_database_backend() == "lite":
+        # milvus-lite only supports FLAT
+        return {"index_type": "FLAT", "metric_type": "IP", "params": {}}
+    if quantization == "sq8":
+        return {
+            "index_type": QUANTIZED_INDEX_TYPES[quantization],
+            "metric_type": "IP",
+            "params": {"nlist": _nlist(max_partition_size)},
+        }
+    if quantization == "pq":
+        # the dimension has to be divisible by m
+        return {
+            "index_type": QUANTIZED_INDEX_TYPES[quantization],
+            "metric_type": "IP",
+            "params": {
+                "nlist": _nlist(max_partition_size),
+                "m": EMBEDDING_DIM // 16,
+                "nbits": 8,
+            },
+        }
+    if max_partition_size <= FLAT_MAX_PARTITION_SIZE:
+        return {"index_type": "FLAT", "metric_type": "IP", "params": {}}
+    if max_partition_size <= HNSW_MAX_PARTITION_SIZE:
+        return {
+            "index_type": "HNSW",
+            "metric_type": "IP",
+            "params": {"M": 16, "efConstruction": 200},
+        }
+    return {
+        "index_type": "IVF_FLAT",
+        "metric_type": "IP",
+        "params": {"nlist": _nlist(max_partition_size)},
+    }
+
+
+def search_params_for_index(index: dict, limit: int = 10) -> dict:
+    """returns the search params matching the index params (see select_index)"""
+    index_type = index["index_type"]
+    params = index.get("params", {})
+    if index_type == "HNSW":
+        # ef has to be at least the number of results
+        search_params = {"ef": max(64, 4 * limit)}
+    elif index_type.startswith("IVF"):
+        search_params = {"nprobe": max(8, int(params.get("nlist", 128)) // 32)}
+    else:
+        search_params = {}
+    return {"metric_type": index.get("metric_type", "IP"), "params": search_params}
+
+
+def vector_index(collection) -> Optional[Index]:
+    """returns the index of the vector field, the filter fields have scalar indexes of their own"""
+    for index in collection.indexes:
+        if index.field_name == "vector":
+            return index
+    return None
+
+
+def get_search_params(milvus_client, collection_name: str, limit: int = 10) -> dict:
+    """returns the search params for the index the collection currently has, FLAT ones if it has no vector index"""
+    if get_database_backend() == "numpy":
+        # the numpy store always searches exactly
+        return search_params_for_index({"index_type": "FLAT"}, limit=limit)
+    collection = Collection(collection_name, using=connection_alias(milvus_client))
+    index = vector_index(collection)
+    if index is None:
+        # just created or the index is being rebuilt (f.e. during a sweep)
+        return search_params_for_index({"index_type": "FLAT"}, limit=limit)
+    return search_params_for_index(index.params, limit=limit)
+
 
 class Milvus2PreferenceStore:
-    def __init__(self):
-        connect2milvusdb()
-        self.embedding_dim = 1536
+    def __init__(
+        self,
+        milvus_client: Optional[MilvusClient] = None,
+        write_behind: Optional[bool] = None,
+        quantization: Optional[str] = None,
+    ):
+        # the ORM calls run on the connection of the (pooled) client instead of opening a new one
+        self.milvus_client = (
+            milvus_client if milvus_client is not None else get_milvus_client()
+        )
+        self.embedding_dim = EMBEDDING_DIM
         self.metric_type = "IP"
-        self.index_type = "IVF_FLAT"
-        self.index_param = {"nlist": 16384}
-        self.search_param = {"nprobe": 10}
+        self.quantization = quantization if quantization is not None else QUANTIZATION
+        if self.quantization != "none" and (
+            self.quantization not in QUANTIZED_INDEX_TYPES
+            or get_database_backend() == "lite"
+        ):
+            raise ValueError(
+                f"Quantization '{self.quantization}' is not supported by the {get_database_backend()} backend, use none, sq8 or pq with the server"
+            )
+        # new collections are empty and start with FLAT (or the quantized index), adapt_index switches the index once data is loaded
+        index = select_index(
+            num_entities=0, max_partition_size=0, quantization=self.quantization
+        )
+        self.index_type = index["index_type"]
+        self.index_param = index["params"]
+        self.search_param = search_params_for_index(index)["params"]
+        # with write-behind, upload_preferences only buffers the rows (see WriteBehindBuffer)
+        self.write_behind = (
+            write_behind
+            if write_behind is not None
+            else config.getboolean("database", "write_behind", fallback=False)
+        )
+        self._write_buffers = {}
+
+    @property
+    def using(self) -> str:
+        # read per call, a pooled client gets a new connection (and alias) after a reconnect
+        return connection_alias(self.milvus_client)
 
     def _create_collection_and_index(
         self,
@@ -24,14 +179,29 @@ class Milvus2PreferenceStore:
         recreate_collection: Optional[bool] = False,
     ):
 
-        has_collection = utility.has_collection(collection_name=collection_name)
+        has_collection = utility.has_collection(
+            collection_name=collection_name, using=self.using
+        )
 
         if has_collection and recreate_collection == True:
             print("Dropping Collection")
-            utility.drop_collection(collection_name=collection_name)
+            utility.drop_collection(collection_name=collection_name, using=self.using)
             has_collection = False
 
         if not has_collection:
+            # milvus-lite has no partitions, user_name is only a filtered scalar field there
+            use_partition_key = get_database_backend() != "lite"
+            # with compact_categories the categories are stored as their integer ids (see preference_categories)
+            category_fields = [
+                (
+                    FieldSchema(name=field_name, dtype=DataType.INT8)
+                    if COMPACT_CATEGORIES
+                    else FieldSchema(
+                        name=field_name, dtype=DataType.VARCHAR, max_length=50000
+                    )
+                )
+                for field_name in CATEGORY_FIELDS
+            ]
             fields = [
                 FieldSchema(
                     name="pk",
@@ -46,39 +216,32 @@ class Milvus2PreferenceStore:
                 FieldSchema(
                     name="text", dtype=DataType.VARCHAR, max_length=50000
                 ),  # "text" is langchain convention
-                FieldSchema(
-                    name="main_category", dtype=DataType.VARCHAR, max_length=50000
-                ),
-                FieldSchema(
-                    name="subcategory", dtype=DataType.VARCHAR, max_length=50000
-                ),
-                FieldSchema(
-                    name="detail_category", dtype=DataType.VARCHAR, max_length=50000
-                ),
+                *category_fields,
                 FieldSchema(name="attribute", dtype=DataType.VARCHAR, max_length=50000),
                 FieldSchema(
                     name="user_name",
                     dtype=DataType.VARCHAR,
                     description="",
                     max_length=512,
-                    is_partition_key=True,
+                    is_partition_key=use_partition_key,
                 ),
             ]
 
             collection_schema = CollectionSchema(
                 fields=fields,
                 enable_dynamic_field=True,
-                partition_key_field="user_name",
+                partition_key_field="user_name" if use_partition_key else None,
+            )
+            collection = Collection(
+                name=collection_name, schema=collection_schema, using=self.using
             )
-            collection = Collection(name=collection_name, schema=collection_schema)
         else:
             logger.warning(
                 f"Collection {collection_name} already exists. Will not be recreated, please delete or rename."
             )
-            collection = Collection(collection_name)
+            collection = Collection(collection_name, using=self.using)
 
-        has_index = collection.has_index()
-        if not has_index:
+        if vector_index(collection) is None:
             collection.create_index(
                 field_name="vector",
                 index_params={
@@ -88,10 +251,68 @@ class Milvus2PreferenceStore:
                 },
             )
 
+        # milvus-lite only indexes the vector field
+        if get_database_backend() == "server":
+            indexed_fields = {index.field_name for index in collection.indexes}
+            for field_name in SCALAR_INDEX_FIELDS:
+                if field_name not in indexed_fields:
+                    # without index params milvus uses the default scalar index of the field type
+                    collection.create_index(
+                        field_name=field_name, index_name=f"{field_name}_index"
+                    )
+
         collection.load()
 
         return collection
 
+    def adapt_index(self, collection):
+        """
+        rebuilds the vector index if the collection size calls for another index (see select_index).
+        call after loading data, the collection needs to be flushed for the entity counts.
+        """
+        max_partition_size = max(
+            (partition.num_entities for partition in collection.partitions), default=0
+        )
+        index = select_index(
+            collection.num_entities, max_partition_size, quantization=self.quantization
+        )
+        current_vector_index = vector_index(collection)
+        current_index = current_vector_index.params if current_vector_index else None
+        if current_index and (
+            current_index["index_type"] == index["index_type"]
+            and {k: int(v) for k, v in current_index.get("params", {}).items()}
+            == index["params"]
+        ):
+            return index
+
+        logger.info(
+            f"Rebuilding index of {collection.name} ({collection.num_entities} entities, "
+            f"largest partition {max_partition_size}): {index}"
+        )
+        collection.release()
+        if current_index:
+            collection.drop_index(index_name=current_vector_index.index_name)
+        collection.create_index(field_name="vector", index_params=index)
+        collection.load()
+        self.index_type = index["index_type"]
+        self.index_param = index["params"]
+        self.search_param = search_params_for_index(index)["params"]
+        return index
+
+    def _write_buffer(self, collection) -> WriteBehindBuffer:
+        if collection.name not in self._write_buffers:
+            self._write_buffers[collection.name] = WriteBehindBuffer(
+                collection,
+                max_rows=config.getint("database", "write_buffer_size", fallback=1000),
+                flush_interval=config.getfloat(
+                    "database", "flush_interval", fallback=5.0
+                ),
+                compaction_idle=config.getfloat(
+                    "database", "compaction_idle", fallback=60.0
+                ),
+            )
+        return self._write_buffers[collection.name]
+
     def upload_preferences(
         self,
         collection,
@@ -103,12 +324,31 @@ class Milvus2PreferenceStore:
             return
 
         mutation_result: Any = None
+        preferences = [encode_categories(preference) for preference in preferences]
 
         # Only embedding(=vector) and content(=text) is mandatory, the metadata will be uploaded to Milvus in a "dynamic schema", this can then be accessed with $meta["<Your_Field>"]
 
+        if self.write_behind:
+            # flush and compaction run in the background, call sync() for read-after-write
+            self._write_buffer(collection).add(preferences)
+            return mutation_result
+
         mutation_result = collection.insert(preferences)
         collection.flush()
         collection.compact()
         logger.info(f"Inserted {mutation_result.insert_count} entities")
+        for user_name in {preference.get("user_name") for preference in preferences}:
+            invalidate_user(user_name)
 
         return mutation_result
+
+    def sync(self):
+        """writes and flushes all buffered preferences, they are durable and visible to queries afterwards"""
+        # the buffers invalidate the session caches of the users they wrote
+        for write_buffer in self._write_buffers.values():
+            write_buffer.sync()
+
+    def close(self):
+        for write_buffer in self._write_buffers.values():
+            write_buffer.close()
+        self._write_buffers = {}
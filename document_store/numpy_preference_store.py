@@ -0,0 +1,647 @@
+"""
+In-process vector store with the surface of the MilvusClient used by the scripts
+(insert, upsert, delete, query, search, flush) and of the Milvus2PreferenceStore
+(_create_collection_and_index, adapt_index, upload_preferences, sync), for deployments and
+test runs without the etcd + MinIO + Milvus stack. Selected with [database] backend = numpy.
+
+The preferences of each user are kept in a contiguous float32 matrix with the scalar fields
+as columns next to it, so a search filtered by user_name is one matrix-vector product over
+the rows of that user. Collections can be persisted to [database] numpy_path with one vector and
+one metadata file per user, a flush only writes the users changed since the previous one. The
+vectors are memory-mapped when the collection is opened again.
+With [database] quantization = float16 or binary the vectors are stored with 2 bytes or 1 bit per dimension.
+"""
+
+import json
+import os
+import re
+import shutil
+import threading
+from typing import Any, Dict, List, Optional, Union
+
+import numpy as np
+
+from config.config_loader import config
+from utils.custom_logger import log_info
+
+PRIMARY_KEY = "pk"
+VECTOR_FIELD = "vector"
+PARTITION_KEY = "user_name"
+
+# stored vector type per [database] quantization and the suffix of its persisted vector file
+QUANTIZATION_VECTOR_DTYPES = {
+    "none": "float32",
+    "float16": "float16",
+    "binary": "binary",
+}
+_VECTOR_FILE_SUFFIXES = {"float32": "f32", "float16": "f16", "binary": "bin"}
+
+_CONDITION = re.compile(
+    r"""^\s*(\w+)\s*(==|!=)\s*(?:'([^']*)'|"([^"]*)"|(-?\d+(?:\.\d+)?))\s*$"""
+)
+_IN_CONDITION = re.compile(r"^\s*(\w+)\s+(not\s+in|in)\s*\[(.*)\]\s*$", re.IGNORECASE)
+
+
+def _parse_value(value: str):
+    value = value.strip()
+    if value[:1] in ("'", '"'):
+        return value[1:-1]
+    return float(value) if "." in value else int(value)
+
+
+def quantize_vectors(vectors: np.ndarray, vector_dtype: str) -> np.ndarray:
+    """returns the stored form of float32 vectors, binary keeps the sign bit of every dimension"""
+    if vector_dtype == "float16":
+        return vectors.astype(np.float16)
+    if vector_dtype == "binary":
+        return np.packbits(vectors > 0, axis=-1)
+    return vectors.astype(np.float32, copy=False)
+
+
+def dequantize_vectors(vectors: np.ndarray, vector_dtype: str, dim: int) -> np.ndarray:
+    """returns float32 vectors, binary vectors become +-1/sqrt(dim) so they keep unit length"""
+    if vector_dtype == "binary":
+        signs = np.unpackbits(vectors, axis=-1, count=dim).astype(np.float32) * 2 - 1
+        return signs / np.sqrt(dim, dtype=np.float32)
+    return vectors.astype(np.float32, copy=False)
+
+
+def _stored_shape(dim: int, vector_dtype: str) -> tuple:
+    if vector_dtype == "binary":
+        return ((dim + 7) // 8,), np.uint8
+    return (dim,), np.float16 if vector_dtype == "float16" else np.float32
+
+
+def parse_filter(expr: Optional[str]) -> List[tuple]:
+    """
+    parses the subset of the milvus boolean expressions used in this repo:
+    conditions 'field == value', 'field != value', 'field in [...]' and 'field not in [...]'
+    joined by '&&' or 'and'. returns [(field, operator, value or set of values)].
+    """
+    if not expr or not expr.strip():
+        return []
+    conditions = []
+    for part in re.split(r"\s*&&\s*|\s+and\s+", expr.strip()):
+        match = _CONDITION.match(part)
+        if match:
+            field, operator, single, double, number = match.groups()
+            value = (
+                single
+                if single is not None
+                else double if double is not None else _parse_value(number)
+            )
+            conditions.append((field, operator, value))
+            continue
+        match = _IN_CONDITION.match(part)
+        if match:
+            field, operator, values = match.groups()
+            conditions.append(
+                (
+                    field,
+                    "not in" if operator.lower().startswith("not") else "in",
+                    {_parse_value(v) for v in values.split(",") if v.strip()},
+                )
+            )
+            continue
+        raise ValueError(f"Unsupported filter expression for the numpy store: {expr}")
+    return conditions
+
+
+class _UserPartition:
+    """the rows of one user: contiguous vector matrix (grown by doubling) and scalar columns"""
+
+    def __init__(
+        self,
+        dim: int,
+        vectors: Optional[np.ndarray] = None,
+        vector_dtype: str = "float32",
+    ):
+        self.dim = dim
+        self.vector_dtype = vector_dtype
+        self.size = 0 if vectors is None else len(vectors)
+        self.vectors = vectors if vectors is not None else self._empty_vectors(0)
+        self.pks: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.columns: Dict[str, List[Any]] = {}
+
+    def set_pks(self, pks: List[str]):
+        self.pks = pks
+        self.rows = {pk: index for index, pk in enumerate(pks)}
+
+    def _empty_vectors(self, capacity: int) -> np.ndarray:
+        shape, dtype = _stored_shape(self.dim, self.vector_dtype)
+        return np.empty((capacity, *shape), dtype=dtype)
+
+    def _reserve(self, size: int):
+        if size <= len(self.vectors) and self.vectors.flags.writeable:
+            return
+        capacity = max(size, 2 * len(self.vectors), 8)
+        vectors = self._empty_vectors(capacity)
+        vectors[: self.size] = self.vectors[: self.size]
+        self.vectors = vectors
+
+    def append(self, row: dict) -> int:
+        self._reserve(self.size + 1)
+        self.vectors[self.size] = quantize_vectors(
+            np.asarray(row[VECTOR_FIELD], dtype=np.float32), self.vector_dtype
+        )
+        self.pks.append(row[PRIMARY_KEY])
+        self.rows[row[PRIMARY_KEY]] = self.size
+        for column in self.columns.values():
+            column.append(None)
+        for field, value in row.items():
+            if field in (PRIMARY_KEY, VECTOR_FIELD):
+                continue
+            if field not in self.columns:
+                self.columns[field] = [None] * (self.size + 1)
+            self.columns[field][self.size] = value
+        self.size += 1
+        return self.size - 1
+
+    def remove(self, pk: str):
+        """removes the row by moving the last row into its place, so the rows stay contiguous"""
+        self._reserve(self.size)
+        index = self.rows.pop(pk)
+        last = self.size - 1
+        if index != last:
+            self.vectors[index] = self.vectors[last]
+            self.pks[index] = self.pks[last]
+            self.rows[self.pks[index]] = index
+            for column in self.columns.values():
+                column[index] = column[last]
+        self.pks.pop()
+        for column in self.columns.values():
+            column.pop()
+        self.size -= 1
+
+    def row(self, index: int, output_fields: Optional[List[str]]) -> dict:
+        if output_fields is None:
+            fields = []
+        elif "*" in output_fields:
+            fields = [VECTOR_FIELD, *self.columns]
+        else:
+            fields = output_fields
+        row = {PRIMARY_KEY: self.pks[index]}
+        for field in fields:
+            if field == VECTOR_FIELD:
+                row[field] = dequantize_vectors(
+                    self.vectors[index], self.vector_dtype, self.dim
+                ).tolist()
+            elif field in self.columns and self.columns[field][index] is not None:
+                row[field] = self.columns[field][index]
+        return row
+
+    def mask(self, conditions: List[tuple]) -> np.ndarray:
+        mask = np.ones(self.size, dtype=bool)
+        for field, operator, value in conditions:
+            if field == PRIMARY_KEY:
+                column = self.pks
+            else:
+                column = self.columns.get(field, [None] * self.size)
+            if operator == "==":
+                mask &= np.fromiter((v == value for v in column), bool, self.size)
+            elif operator == "!=":
+                mask &= np.fromiter((v != value for v in column), bool, self.size)
+            elif operator == "in":
+                mask &= np.fromiter((v in value for v in column), bool, self.size)
+            else:
+                mask &= np.fromiter((v not in value for v in column), bool, self.size)
+        return mask
+
+
+class _NumpyCollection:
+    def __init__(self, name: str, dim: int, vector_dtype: str = "float32"):
+        self.name = name
+        self.dim = dim
+        self.vector_dtype = vector_dtype
+        self.partitions: Dict[str, _UserPartition] = {}
+        # pk -> user_name of the partition holding the row
+        self.pk_index: Dict[str, str] = {}
+        # user_name -> number of the persisted files of the user
+        self.user_files: Dict[str, int] = {}
+        # users changed since the last save
+        self.dirty: set = set()
+
+    @property
+    def num_entities(self) -> int:
+        return len(self.pk_index)
+
+    def _partitions_for(self, conditions):
+        # a user_name == '...' condition selects the partition directly
+        for field, operator, value in conditions:
+            if field == PARTITION_KEY and operator == "==":
+                partition = self.partitions.get(value)
+                return [partition] if partition is not None else []
+        return list(self.partitions.values())
+
+    def _row_index(self, pk):
+        partition = self.partitions[self.pk_index[pk]]
+        return partition, partition.rows[pk]
+
+    def upsert(self, row: dict):
+        if row[PRIMARY_KEY] in self.pk_index:
+            self.delete_pk(row[PRIMARY_KEY])
+        user_name = row.get(PARTITION_KEY)
+        if user_name not in self.partitions:
+            self.partitions[user_name] = _UserPartition(
+                self.dim, vector_dtype=self.vector_dtype
+            )
+        self.partitions[user_name].append(row)
+        self.pk_index[row[PRIMARY_KEY]] = user_name
+        self.dirty.add(user_name)
+
+    def delete_pk(self, pk) -> bool:
+        if pk not in self.pk_index:
+            return False
+        user_name = self.pk_index.pop(pk)
+        self.partitions[user_name].remove(pk)
+        self.dirty.add(user_name)
+        return True
+
+    def select(self, conditions):
+        """yields (partition, row indices) of the rows matching the conditions"""
+        for partition in self._partitions_for(conditions):
+            if partition.size:
+                indices = np.flatnonzero(partition.mask(conditions))
+                if len(indices):
+                    yield partition, indices
+
+
+class NumpyPreferenceClient:
+    """
+    In-process replacement of the MilvusClient for the preference collections (metric IP).
+    Inserting an existing pk replaces the row, so the pk stays unique.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        dim: int = 1536,
+        vector_dtype: str = "float32",
+    ):
+        if vector_dtype not in _VECTOR_FILE_SUFFIXES:
+            raise ValueError(
+                f"Unsupported vector type for the numpy store: {vector_dtype}"
+            )
+        self.path = path
+        self.dim = dim
+        # used for new collections, persisted collections keep the type they were created with
+        self.vector_dtype = vector_dtype
+        self._collections: Dict[str, _NumpyCollection] = {}
+        self._lock = threading.RLock()
+        # serializes the saves, the files are written without holding _lock
+        self._save_lock = threading.Lock()
+
+    # ==== collections ====
+    def has_collection(self, collection_name: str, **kwargs) -> bool:
+        with self._lock:
+            return collection_name in self._collections or (
+                self.path is not None
+                and os.path.exists(self._metadata_path(collection_name))
+            )
+
+    def create_collection(
+        self, collection_name: str, dimension: Optional[int] = None, **kwargs
+    ):
+        with self._lock:
+            if not self.has_collection(collection_name):
+                self._collections[collection_name] = _NumpyCollection(
+                    collection_name, dimension or self.dim, self.vector_dtype
+                )
+
+    def drop_collection(self, collection_name: str, **kwargs):
+        with self._lock:
+            self._collections.pop(collection_name, None)
+            if self.path is not None:
+                if os.path.exists(self._metadata_path(collection_name)):
+                    os.remove(self._metadata_path(collection_name))
+                shutil.rmtree(self._users_path(collection_name), ignore_errors=True)
+
+    def get_collection(self, collection_name: str) -> _NumpyCollection:
+        with self._lock:
+            if collection_name not in self._collections:
+                if self.path is not None and os.path.exists(
+                    self._metadata_path(collection_name)
+                ):
+                    self._collections[collection_name] = self._load(collection_name)
+                else:
+                    raise KeyError(f"Collection {collection_name} does not exist")
+            return self._collections[collection_name]
+
+    # ==== MilvusClient surface ====
+    def insert(self, collection_name: str, data: Union[dict, List[dict]], **kwargs):
+        rows = [data] if isinstance(data, dict) else list(data)
+        with self._lock:
+            collection = self.get_collection(collection_name)
+            for row in rows:
+                collection.upsert(row)
+        return {"insert_count": len(rows), "ids": [row[PRIMARY_KEY] for row in rows]}
+
+    def upsert(self, collection_name: str, data: Union[dict, List[dict]], **kwargs):
+        result = self.insert(collection_name, data)
+        return {"upsert_count": result["insert_count"]}
+
+    def delete(
+        self,
+        collection_name: str,
+        ids: Optional[Union[str, List[str]]] = None,
+        filter: Optional[str] = None,
+        pks: Optional[Union[str, List[str]]] = None,
+        **kwargs,
+    ):
+        ids = ids if ids is not None else pks
+        with self._lock:
+            collection = self.get_collection(collection_name)
+            if ids is not None:
+                ids = [ids] if isinstance(ids, str) else ids
+            else:
+                ids = [
+                    partition.pks[index]
+                    for partition, indices in collection.select(parse_filter(filter))
+                    for index in indices
+                ]
+            deleted = [pk for pk in ids if collection.delete_pk(pk)]
+        return {"delete_count": len(deleted)}
+
+    def query(
+        self,
+        collection_name: str,
+        filter: str = "",
+        output_fields: Optional[List[str]] = None,
+        ids: Optional[Union[str, List[str]]] = None,
+        limit: Optional[int] = None,
+        **kwargs,
+    ) -> List[dict]:
+        with self._lock:
+            collection = self.get_collection(collection_name)
+            if output_fields is None:
+                output_fields = [
+                    field
+                    for partition in collection.partitions.values()
+                    for field in partition.columns
+                ]
+            results = []
+            if ids is not None:
+                for pk in [ids] if isinstance(ids, str) else ids:
+                    if pk in collection.pk_index:
+                        partition, index = collection._row_index(pk)
+                        results.append(partition.row(index, output_fields))
+            else:
+                for partition, indices in collection.select(parse_filter(filter)):
+                    results.extend(
+                        partition.row(index, output_fields) for index in indices
+                    )
+        return results[:limit] if limit else results
+
+    def search(
+        self,
+        collection_name: str,
+        data: List[List[float]],
+        filter: str = "",
+        limit: int = 10,
+        output_fields: Optional[List[str]] = None,
+        search_params: Optional[dict] = None,
+        **kwargs,
+    ) -> List[List[dict]]:
+        """exact inner product top-k, search_params are accepted for compatibility and ignored"""
+        queries = np.asarray(data, dtype=np.float32).reshape(len(data), -1)
+        conditions = parse_filter(filter)
+        with self._lock:
+            collection = self.get_collection(collection_name)
+            candidates = list(collection.select(conditions))
+            if not candidates:
+                return [[] for _ in range(len(queries))]
+            # (partition, row) of every candidate, the vectors of one user are a contiguous slice
+            if len(candidates) == 1 and len(candidates[0][1]) == candidates[0][0].size:
+                partition = candidates[0][0]
+                vectors = partition.vectors[: partition.size]
+            else:
+                vectors = np.concatenate(
+                    [partition.vectors[indices] for partition, indices in candidates]
+                )
+            owners = [
+                (partition, index)
+                for partition, indices in candidates
+                for index in indices
+            ]
+            scores = (
+                queries
+                @ dequantize_vectors(vectors, collection.vector_dtype, collection.dim).T
+            )
+            k = min(limit, len(owners))
+            results = []
+            for query_scores in scores:
+                top = np.argpartition(-query_scores, k - 1)[:k]
+                top = top[np.argsort(-query_scores[top])]
+                hits = []
+                for position in top:
+                    partition, index = owners[position]
+                    entity = partition.row(index, output_fields or [])
+                    hits.append(
+                        {
+                            "id": entity.pop(PRIMARY_KEY),
+                            "distance": float(query_scores[position]),
+                            "entity": entity,
+                        }
+                    )
+                results.append(hits)
+        return results
+
+    def flush(self, collection_name: str, **kwargs):
+        """persists the users changed since the last flush if a path is configured"""
+        if self.path is None:
+            return
+        self._save(self.get_collection(collection_name))
+
+    def get_server_version(self, **kwargs) -> str:
+        return "numpy"
+
+    def close(self):
+        if self.path is not None:
+            with self._lock:
+                collections = list(self._collections.values())
+            for collection in collections:
+                self._save(collection)
+
+    # ==== persistence ====
+    def _metadata_path(self, collection_name):
+        return os.path.join(self.path, f"{collection_name}.json")
+
+    def _users_path(self, collection_name):
+        return os.path.join(self.path, collection_name)
+
+    def _user_path(self, collection_name, user_file, suffix):
+        return os.path.join(self._users_path(collection_name), f"{user_file}.{suffix}")
+
+    def _save(self, collection: _NumpyCollection):
+        """
+        writes the vector file and the metadata of every changed user, the changed rows are copied
+        under the lock and written after releasing it, so searches only wait for the copy
+        """
+        with self._save_lock:
+            with self._lock:
+                new_users = [
+                    user_name
+                    for user_name in collection.dirty
+                    if user_name not in collection.user_files
+                ]
+                for user_name in new_users:
+                    collection.user_files[user_name] = len(collection.user_files)
+                changed = []
+                for user_name in collection.dirty:
+                    partition = collection.partitions[user_name]
+                    user = {
+                        "user_name": user_name,
+                        "size": partition.size,
+                        "pks": list(partition.pks),
+                        "columns": {
+                            field: list(column)
+                            for field, column in partition.columns.items()
+                        },
+                    }
+                    vectors = np.array(partition.vectors[: partition.size])
+                    changed.append((collection.user_files[user_name], user, vectors))
+                user_files = dict(collection.user_files)
+                collection.dirty = set()
+            try:
+                self._write_users(collection, changed)
+                if new_users or not os.path.exists(
+                    self._metadata_path(collection.name)
+                ):
+                    self._write_json(
+                        self._metadata_path(collection.name),
+                        {
+                            "dim": collection.dim,
+                            "vector_dtype": collection.vector_dtype,
+                            "user_files": user_files,
+                        },
+                    )
+            except Exception:
+                # not persisted, write the users again with the next save
+                with self._lock:
+                    for user_name in new_users:
+                        del collection.user_files[user_name]
+                    collection.dirty.update(user["user_name"] for _, user, _ in changed)
+                raise
+
+    def _write_users(self, collection: _NumpyCollection, changed):
+        os.makedirs(self._users_path(collection.name), exist_ok=True)
+        suffix = _VECTOR_FILE_SUFFIXES[collection.vector_dtype]
+        for user_file, user, vectors in changed:
+            vectors_path = self._user_path(collection.name, user_file, suffix)
+            if len(vectors):
+                with open(vectors_path + ".tmp", "wb") as file:
+                    vectors.tofile(file)
+                os.replace(vectors_path + ".tmp", vectors_path)
+            elif os.path.exists(vectors_path):
+                os.remove(vectors_path)
+            self._write_json(self._user_path(collection.name, user_file, "json"), user)
+
+    @staticmethod
+    def _write_json(file_path, data):
+        with open(file_path + ".tmp", "w") as file:
+            json.dump(data, file)
+        os.replace(file_path + ".tmp", file_path)
+
+    def _load(self, collection_name: str) -> _NumpyCollection:
+        with open(self._metadata_path(collection_name), "r") as file:
+            metadata = json.load(file)
+        vector_dtype = metadata.get("vector_dtype", "float32")
+        collection = _NumpyCollection(collection_name, metadata["dim"], vector_dtype)
+        shape, dtype = _stored_shape(metadata["dim"], vector_dtype)
+        total = 0
+        for user_name, user_file in metadata["user_files"].items():
+            collection.user_files[user_name] = user_file
+            with open(self._user_path(collection_name, user_file, "json"), "r") as file:
+                user = json.load(file)
+            # read-only memory map, a user is copied to memory on its first write
+            partition = (
+                _UserPartition(
+                    metadata["dim"],
+                    np.memmap(
+                        self._user_path(
+                            collection_name,
+                            user_file,
+                            _VECTOR_FILE_SUFFIXES[vector_dtype],
+                        ),
+                        dtype=dtype,
+                        mode="r",
+                        shape=(user["size"], *shape),
+                    ),
+                    vector_dtype=vector_dtype,
+                )
+                if user["size"]
+                else _UserPartition(metadata["dim"], vector_dtype=vector_dtype)
+            )
+            partition.set_pks(user["pks"])
+            partition.columns = user["columns"]
+            collection.partitions[user_name] = partition
+            for pk in partition.pks:
+                collection.pk_index[pk] = user_name
+            total += user["size"]
+        log_info(f"Opened {collection_name} with {total} preferences from {self.path}")
+        return collection
+
+
+class NumpyPreferenceStore:
+    """Milvus2PreferenceStore interface on top of the NumpyPreferenceClient"""
+
+    def __init__(self, milvus_client: Optional[NumpyPreferenceClient] = None):
+        self.milvus_client = (
+            milvus_client if milvus_client is not None else get_numpy_client()
+        )
+        self.embedding_dim = self.milvus_client.dim
+        self.metric_type = "IP"
+        self.index_type = "FLAT"
+
+    def _create_collection_and_index(
+        self,
+        collection_name: str,
+        recreate_collection: Optional[bool] = False,
+    ):
+        if recreate_collection and self.milvus_client.has_collection(collection_name):
+            print("Dropping Collection")
+            self.milvus_client.drop_collection(collection_name)
+        self.milvus_client.create_collection(
+            collection_name, dimension=self.embedding_dim
+        )
+        return self.milvus_client.get_collection(collection_name)
+
+    def adapt_index(self, collection):
+        # the search is always exact, there is no index to choose
+        return {"index_type": "FLAT", "metric_type": self.metric_type, "params": {}}
+
+    def upload_preferences(self, collection, preferences: Any = None):
+        if not preferences:
+            return
+        # persisted by sync() and close(), not on every upload
+        return self.milvus_client.insert(collection.name, preferences)
+
+    def sync(self):
+        for collection_name in list(self.milvus_client._collections):
+            self.milvus_client.flush(collection_name)
+
+    def close(self):
+        self.milvus_client.close()
+
+
+_numpy_client = None
+_numpy_client_lock = threading.Lock()
+
+
+def get_numpy_client() -> NumpyPreferenceClient:
+    """process wide NumpyPreferenceClient, persisted to [database] numpy_path if it is set"""
+    global _numpy_client
+    quantization = config.get("database", "quantization", fallback="none")
+    if quantization not in QUANTIZATION_VECTOR_DTYPES:
+        raise ValueError(
+            f"Quantization '{quantization}' is not supported by the numpy backend, use none, float16 or binary"
+        )
+    with _numpy_client_lock:
+        if _numpy_client is None:
+            _numpy_client = NumpyPreferenceClient(
+                path=config.get("database", "numpy_path", fallback="") or None,
+                dim=config.getint("embedding", "dim", fallback=1536),
+                vector_dtype=QUANTIZATION_VECTOR_DTYPES[quantization],
+            )
+    return _numpy_client
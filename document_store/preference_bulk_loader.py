@@ -0,0 +1,154 @@
+import json
+import time
+from typing import Iterator, Optional
+
+from pymilvus import BulkInsertState, Collection, MilvusClient, utility
+
+from config.config_loader import config
+from document_store.preference_categories import encode_categories
+from utils.custom_logger import log_info
+from utils.embedding_batcher import EmbeddingBatcher
+from utils.milvus_utils import connection_alias, get_database_backend
+
+INSERT_BATCH_SIZE = config.getint("bulk_insert", "insert_batch_size", fallback=1000)
+
+
+def read_jsonl(path: str) -> Iterator[dict]:
+    """yields the lines of a jsonl file one by one instead of loading the whole file"""
+    with open(path, "r") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+class PreferenceBulkLoader:
+    """
+    Loads preferences into a collection in chunks of 'insert_batch_size' rows.
+    Preferences added with an embedding text get their vector from the embedding batcher right before
+    their chunk is inserted, the collection is flushed once in finish().
+
+    With bulk_insert=True the rows are not inserted over gRPC, but written to parquet (or numpy) files
+    with the pymilvus RemoteBulkWriter, uploaded to the object storage of milvus (MinIO, see [bulk_insert]
+    in the config) and imported server side with utility.do_bulk_insert, which is much faster for very large loads.
+    """
+
+    def __init__(
+        self,
+        milvus_client: MilvusClient,
+        collection_name: str,
+        insert_batch_size: int = INSERT_BATCH_SIZE,
+        embedding_batcher: Optional[EmbeddingBatcher] = None,
+        bulk_insert: bool = False,
+    ):
+        self.milvus_client = milvus_client
+        self.collection_name = collection_name
+        self.insert_batch_size = insert_batch_size
+        self.embedding_batcher = embedding_batcher
+        self.bulk_insert = bulk_insert
+        self.number_inserted = 0
+        self._rows = []
+        if bulk_insert and get_database_backend() != "server":
+            raise ValueError(
+                "Bulk insert is only available for the milvus server backend"
+            )
+        self._bulk_writer = self._create_bulk_writer() if bulk_insert else None
+
+    def _create_bulk_writer(self):
+        try:
+            from pymilvus.bulk_writer import BulkFileType, RemoteBulkWriter
+        except ImportError as e:
+            raise ImportError(
+                "Bulk insert needs the bulk writer dependencies of pymilvus, install them with 'pip install \"pymilvus[bulk_writer]\"'"
+            ) from e
+        connect_param = RemoteBulkWriter.S3ConnectParam(
+            endpoint=config.get(
+                "bulk_insert", "minio_endpoint", fallback="localhost:9000"
+            ),
+            access_key=config.get(
+                "bulk_insert", "minio_access_key", fallback="minioadmin"
+            ),
+            secret_key=config.get(
+                "bulk_insert", "minio_secret_key", fallback="minioadmin"
+            ),
+            bucket_name=config.get("bulk_insert", "bucket_name", fallback="a-bucket"),
+            secure=False,
+        )
+        file_type = config.get("bulk_insert", "file_type", fallback="parquet")
+        return RemoteBulkWriter(
+            schema=Collection(
+                self.collection_name, using=connection_alias(self.milvus_client)
+            ).schema,
+            remote_path=f"bulk_insert/{self.collection_name}",
+            connect_param=connect_param,
+            file_type=(
+                BulkFileType.NUMPY if file_type == "numpy" else BulkFileType.PARQUET
+            ),
+        )
+
+    def add(self, preference: dict, embedding_text: Optional[str] = None):
+        """adds one row, if 'embedding_text' is given the vector of the row is created from it"""
+        preference = encode_categories(preference)
+        if embedding_text is not None:
+            self.embedding_batcher.add(embedding_text, preference)
+        self._rows.append(preference)
+        if len(self._rows) >= self.insert_batch_size:
+            self._write_rows()
+
+    def _write_rows(self):
+        if not self._rows:
+            return
+        if self.embedding_batcher is not None:
+            self.embedding_batcher.flush()
+        if self._bulk_writer is not None:
+            for row in self._rows:
+                self._bulk_writer.append_row(row)
+        else:
+            self.milvus_client.insert(
+                collection_name=self.collection_name, data=self._rows
+            )
+        self.number_inserted += len(self._rows)
+        self._rows = []
+
+    def _import_bulk_files(self):
+        self._bulk_writer.commit()
+        task_ids = [
+            utility.do_bulk_insert(
+                collection_name=self.collection_name,
+                files=files,
+                using=connection_alias(self.milvus_client),
+            )
+            for files in self._bulk_writer.batch_files
+        ]
+        for task_id in task_ids:
+            while True:
+                state = utility.get_bulk_insert_state(
+                    task_id=task_id, using=connection_alias(self.milvus_client)
+                )
+                if state.state in (
+                    BulkInsertState.ImportCompleted,
+                    BulkInsertState.ImportFailed,
+                    BulkInsertState.ImportFailedAndCleaned,
+                ):
+                    break
+                time.sleep(2)
+            if state.state != BulkInsertState.ImportCompleted:
+                raise RuntimeError(
+                    f"Bulk insert task {task_id} failed: {state.failed_reason}"
+                )
+            log_info(f"Bulk insert task {task_id} imported {state.row_count} rows")
+
+    def finish(self) -> int:
+        """writes the remaining rows, flushes the collection once and returns the number of loaded rows"""
+        self._write_rows()
+        if self._bulk_writer is not None:
+            self._import_bulk_files()
+        elif get_database_backend() == "numpy":
+            self.milvus_client.flush(self.collection_name)
+        else:
+            Collection(
+                self.collection_name, using=connection_alias(self.milvus_client)
+            ).flush()
+        log_info(
+            f"Loaded {self.number_inserted} preferences into {self.collection_name}"
+        )
+        return self.number_inserted
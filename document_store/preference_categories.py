@@ -0,0 +1,98 @@
+"""
+Storage of the category fields of a preference.
+With [database] compact_categories = True the main_category, subcategory and detail_category fields
+are stored as the small integer ids of extraction/mapping_category_to_label.py instead of VARCHAR strings,
+which shrinks the entities and makes the category filters integer comparisons.
+The helpers convert the preferences and filters at the boundary of the collection, so the rest of the
+code keeps working with the category names.
+CategoryHistogramCache counts the preferences per category of a user with one query per user.
+"""
+
+from collections import Counter
+from typing import Dict, Optional
+
+from config.config_loader import config
+from extraction.mapping_category_to_label import number_to_string, string_to_number
+from utils.latency import timer
+
+CATEGORY_FIELDS = ("main_category", "subcategory", "detail_category")
+
+COMPACT_CATEGORIES = config.getboolean("database", "compact_categories", fallback=False)
+
+
+def encode_categories(preference: dict) -> dict:
+    """returns the preference with the category fields as they are stored in the collection"""
+    if not COMPACT_CATEGORIES:
+        return preference
+    return {
+        key: (
+            string_to_number(input_string=value, category=key)
+            if key in CATEGORY_FIELDS and isinstance(value, str)
+            else value
+        )
+        for key, value in preference.items()
+    }
+
+
+def decode_categories(preference: dict) -> dict:
+    """inverse of encode_categories, for preferences returned by query or search"""
+    if not COMPACT_CATEGORIES:
+        return preference
+    return {
+        key: (
+            number_to_string(number=value, category=key)
+            if key in CATEGORY_FIELDS and isinstance(value, int)
+            else value
+        )
+        for key, value in preference.items()
+    }
+
+
+def category_filter(user_name: str, **categories: str) -> str:
+    """returns the filter expression for the preferences of a user within the given categories"""
+    conditions = [f"user_name=='{user_name}'"]
+    for category, value in categories.items():
+        if COMPACT_CATEGORIES:
+            conditions.append(
+                f"{category}=={string_to_number(input_string=value, category=category)}"
+            )
+        else:
+            conditions.append(f"{category}=='{value}'")
+    return " && ".join(conditions)
+
+
+class CategoryHistogramCache:
+    """
+    Number of preferences per value of one category field (f.e. subcategory) for each user.
+    Milvus has no grouped count, so the histogram of a user is built from one query that only
+    returns the category field and is cached until invalidate() is called for the user.
+    """
+
+    def __init__(self, milvus_client, collection_name: str, category: str):
+        self.milvus_client = milvus_client
+        self.collection_name = collection_name
+        self.category = category
+        self._histograms: Dict[str, Counter] = {}
+
+    def histogram(self, user_name: str) -> Counter:
+        if user_name not in self._histograms:
+            with timer("milvus_query"):
+                rows = self.milvus_client.query(
+                    collection_name=self.collection_name,
+                    filter=category_filter(user_name),
+                    output_fields=[self.category],
+                )
+            self._histograms[user_name] = Counter(
+                decode_categories(row).get(self.category) for row in rows
+            )
+        return self._histograms[user_name]
+
+    def count(self, user_name: str, value: str) -> int:
+        return self.histogram(user_name)[value]
+
+    def invalidate(self, user_name: Optional[str] = None):
+        """drops the histogram of a user (after a write) or of all users"""
+        if user_name is None:
+            self._histograms = {}
+        else:
+            self._histograms.pop(user_name, None)
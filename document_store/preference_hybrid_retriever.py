@@ -0,0 +1,103 @@
+"""
+Retrieval of the preferences of a user without waiting for the embedding round trip.
+The utterance is answered from the BM25 index of the session cache right away, the embedding is requested
+in parallel and, if it returns within 'embedding_timeout' seconds, the lexical and vector hits are fused
+with reciprocal rank fusion. A slow embedding endpoint leaves the lexical answer as fallback.
+"""
+
+import asyncio
+from typing import AsyncIterator, List, Optional, Tuple
+
+from langchain_core.embeddings import Embeddings
+
+from config.config_loader import config
+from document_store.preference_lexical_index import reciprocal_rank_fusion
+from document_store.preference_session_cache import PreferenceSessionCache
+from utils.custom_logger import log_warning
+from utils.latency import timer
+from utils.llm import get_embedding
+
+EMBEDDING_TIMEOUT = config.getfloat("lexical", "embedding_timeout", fallback=0.5)
+
+
+class HybridPreferenceRetriever:
+    """
+    Lexical, vector and fused search over a PreferenceSessionCache, hits are in the format of
+    MilvusClient.search()[0] (the fused score is the rrf score).
+    """
+
+    def __init__(
+        self,
+        session_cache: Optional[PreferenceSessionCache] = None,
+        embedding: Optional[Embeddings] = None,
+        embedding_timeout: Optional[float] = None,
+    ):
+        self.session_cache = session_cache or PreferenceSessionCache()
+        self._embedding = embedding
+        self.embedding_timeout = (
+            embedding_timeout if embedding_timeout is not None else EMBEDDING_TIMEOUT
+        )
+
+    @property
+    def embedding(self) -> Embeddings:
+        if self._embedding is None:
+            self._embedding = get_embedding()
+        return self._embedding
+
+    def search(
+        self, user_name: str, query: str, limit: int = 10, query_vector=None
+    ) -> List[dict]:
+        """fused lexical and vector hits, the query is embedded if no query_vector is given"""
+        lexical_hits = self.session_cache.lexical_search(user_name, query, limit=limit)
+        if query_vector is None:
+            with timer("embedding"):
+                query_vector = self.embedding.embed_query(query)
+        vector_hits = self.session_cache.search(user_name, query_vector, limit=limit)
+        return reciprocal_rank_fusion(lexical_hits, vector_hits, limit=limit)
+
+    async def _aembed(self, query: str):
+        with timer("embedding"):
+            return await self.embedding.aembed_query(query)
+
+    async def astream_search(
+        self, user_name: str, query: str, limit: int = 10
+    ) -> AsyncIterator[Tuple[str, List[dict]]]:
+        """
+        yields ('lexical', hits) immediately and ('fused', hits) once the embedding returned,
+        the fused answer is skipped if the embedding takes longer than embedding_timeout
+        """
+        embedding_task = asyncio.ensure_future(self._aembed(query))
+        try:
+            if not self.session_cache.has_session(user_name):
+                # the strong consistency load of the preferences blocks, keep it off the event loop
+                await asyncio.to_thread(self.session_cache.start_session, user_name)
+            lexical_hits = self.session_cache.lexical_search(
+                user_name, query, limit=limit
+            )
+            yield "lexical", lexical_hits
+            try:
+                query_vector = await asyncio.wait_for(
+                    embedding_task, timeout=self.embedding_timeout
+                )
+            except asyncio.TimeoutError:
+                log_warning(
+                    f"Embedding took longer than {self.embedding_timeout} s, answering from the lexical index only"
+                )
+                return
+            vector_hits = self.session_cache.search(
+                user_name, query_vector, limit=limit
+            )
+            yield "fused", reciprocal_rank_fusion(
+                lexical_hits, vector_hits, limit=limit
+            )
+        finally:
+            # the load failed or the consumer stopped after the lexical hits
+            if not embedding_task.done():
+                embedding_task.cancel()
+
+    async def asearch(self, user_name: str, query: str, limit: int = 10) -> List[dict]:
+        """the best answer available within embedding_timeout: fused hits, else the lexical ones"""
+        hits = []
+        async for _, hits in self.astream_search(user_name, query, limit=limit):
+            pass
+        return hits
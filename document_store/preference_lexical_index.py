@@ -0,0 +1,97 @@
+"""
+Local lexical (BM25) index over the text, attribute and detail_category of the preferences of a user,
+used to answer a retrieval without waiting for the embedding of the utterance.
+reciprocal_rank_fusion() merges the lexical hits with the vector hits once the embedding is available.
+Both work on hits in the format of MilvusClient.search()[0].
+"""
+
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config.config_loader import config
+
+LEXICAL_FIELDS = ("text", "attribute", "detail_category")
+
+BM25_K1 = config.getfloat("lexical", "k1", fallback=1.2)
+BM25_B = config.getfloat("lexical", "b", fallback=0.75)
+RRF_K = config.getint("lexical", "rrf_k", fallback=60)
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """lowercase alphanumeric tokens, so 'Favorite_Cuisine' matches 'favorite cuisine'"""
+    return _TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+def preference_tokens(entity: dict) -> List[str]:
+    return [token for field in LEXICAL_FIELDS for token in tokenize(entity.get(field))]
+
+
+class BM25Index:
+    """
+    BM25 over a small, fixed set of documents (the preferences of one user).
+    The term frequencies are kept as a dense documents x vocabulary matrix, a query is scored with one
+    lookup of its known terms.
+    """
+
+    def __init__(
+        self,
+        documents: List[List[str]],
+        k1: float = BM25_K1,
+        b: float = BM25_B,
+    ):
+        self.vocabulary: Dict[str, int] = {}
+        for document in documents:
+            for token in document:
+                self.vocabulary.setdefault(token, len(self.vocabulary))
+        term_frequencies = np.zeros(
+            (len(documents), len(self.vocabulary)), dtype=np.float32
+        )
+        for row, document in enumerate(documents):
+            for token in document:
+                term_frequencies[row, self.vocabulary[token]] += 1
+        lengths = term_frequencies.sum(axis=1, keepdims=True)
+        average_length = lengths.mean() if len(documents) else 0.0
+        document_frequencies = (term_frequencies > 0).sum(axis=0)
+        self.idf = np.log(
+            1
+            + (len(documents) - document_frequencies + 0.5)
+            / (document_frequencies + 0.5)
+        ).astype(np.float32)
+        # tf part of the score, precomputed since the documents do not change
+        normalization = k1 * (1 - b + b * lengths / max(average_length, 1e-9))
+        self.weights = term_frequencies * (k1 + 1) / (term_frequencies + normalization)
+
+    def scores(self, query: str) -> np.ndarray:
+        """bm25 score of every document, 0 for documents without a query term"""
+        terms = [
+            self.vocabulary[token]
+            for token in tokenize(query)
+            if token in self.vocabulary
+        ]
+        if not terms:
+            return np.zeros(len(self.weights), dtype=np.float32)
+        return self.weights[:, terms] @ self.idf[terms]
+
+
+def reciprocal_rank_fusion(
+    *hit_lists: List[dict], limit: int = 10, k: int = RRF_K
+) -> List[dict]:
+    """
+    fuses ranked hit lists by the sum of 1 / (k + rank) over the lists a hit appears in,
+    the fused score is returned as 'distance'
+    """
+    scores = {}
+    entities = {}
+    for hits in hit_lists:
+        for rank, hit in enumerate(hits, start=1):
+            scores[hit["id"]] = scores.get(hit["id"], 0.0) + 1.0 / (k + rank)
+            entities.setdefault(hit["id"], hit["entity"])
+    ranked = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [
+        {"id": pk, "distance": scores[pk], "entity": dict(entities[pk])}
+        for pk in ranked
+    ]
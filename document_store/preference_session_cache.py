@@ -0,0 +1,173 @@
+"""
+Session cache of the preferences of the users currently talking to the assistant.
+A user has at most a few dozen preferences, so instead of one filtered milvus search per retrieval
+utterance the whole preference set (vectors and scalar fields) is loaded with one query at session start
+and every utterance is scored in process with one matrix-vector product.
+The loaded preferences also get a BM25 index (lexical_search), which answers without an embedding.
+Writes of the maintenance call invalidate_user(), the next retrieval of the user reloads the preferences.
+"""
+
+import threading
+import weakref
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+from config.config_loader import config
+from document_store.preference_categories import category_filter, decode_categories
+from document_store.preference_lexical_index import BM25Index, preference_tokens
+from utils.latency import timer
+from utils.milvus_utils import get_milvus_client
+
+# caches of this process, notified by invalidate_user
+_session_caches = weakref.WeakSet()
+
+SESSION_OUTPUT_FIELDS = [
+    "main_category",
+    "subcategory",
+    "detail_category",
+    "attribute",
+    "text",
+    "user_name",
+]
+
+
+class _UserPreferences:
+    def __init__(self, rows: List[dict]):
+        self.pks = [row["pk"] for row in rows]
+        self.entities = [
+            decode_categories(
+                {
+                    key: value
+                    for key, value in row.items()
+                    if key not in ("pk", "vector")
+                }
+            )
+            for row in rows
+        ]
+        self.vectors = (
+            np.asarray([row["vector"] for row in rows], dtype=np.float32)
+            if rows
+            else None
+        )
+        self.lexical_index = BM25Index(
+            [preference_tokens(entity) for entity in self.entities]
+        )
+
+    def top_hits(self, scores: np.ndarray, limit: int) -> List[dict]:
+        k = min(limit, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            {
+                "id": self.pks[index],
+                "distance": float(scores[index]),
+                "entity": dict(self.entities[index]),
+            }
+            for index in top
+        ]
+
+
+class PreferenceSessionCache:
+    """
+    Preferences of up to 'max_sessions' users, the least recently used session is dropped first.
+    search() returns the hits in the format of MilvusClient.search()[0] (metric IP).
+    """
+
+    def __init__(
+        self,
+        milvus_client=None,
+        collection_name: Optional[str] = None,
+        max_sessions: Optional[int] = None,
+    ):
+        self.milvus_client = (
+            milvus_client if milvus_client is not None else get_milvus_client()
+        )
+        self.collection_name = collection_name or config.get(
+            "database", "collection_name"
+        )
+        self.max_sessions = max_sessions or config.getint(
+            "session_cache", "max_sessions", fallback=1000
+        )
+        self._sessions = OrderedDict()
+        # counts invalidations, a load that overlapped with one is not cached
+        self._generation = 0
+        self._lock = threading.Lock()
+        _session_caches.add(self)
+
+    def _load(self, user_name: str) -> _UserPreferences:
+        with timer("milvus_query"):
+            rows = self.milvus_client.query(
+                collection_name=self.collection_name,
+                filter=category_filter(user_name),
+                output_fields=[*SESSION_OUTPUT_FIELDS, "vector"],
+                # the reload after an invalidation has to see the write that caused it
+                consistency_level="Strong",
+            )
+        return _UserPreferences(rows)
+
+    def _load_session(self, user_name: str) -> _UserPreferences:
+        with self._lock:
+            generation = self._generation
+        preferences = self._load(user_name)
+        with self._lock:
+            if generation == self._generation:
+                self._sessions[user_name] = preferences
+                self._sessions.move_to_end(user_name)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+        return preferences
+
+    def start_session(self, user_name: str) -> int:
+        """loads the preferences of the user, returns their number"""
+        return len(self._load_session(user_name).pks)
+
+    def has_session(self, user_name: str) -> bool:
+        with self._lock:
+            return user_name in self._sessions
+
+    def end_session(self, user_name: str):
+        with self._lock:
+            self._sessions.pop(user_name, None)
+
+    def invalidate(self, user_name: Optional[str] = None):
+        """drops the loaded preferences of a user (or of all users), they are reloaded on the next search"""
+        with self._lock:
+            self._generation += 1
+            if user_name is None:
+                self._sessions.clear()
+            else:
+                self._sessions.pop(user_name, None)
+
+    def _preferences(self, user_name: str) -> _UserPreferences:
+        with self._lock:
+            preferences = self._sessions.get(user_name)
+            if preferences is not None:
+                self._sessions.move_to_end(user_name)
+                return preferences
+        return self._load_session(user_name)
+
+    def search(self, user_name: str, query_vector, limit: int = 10) -> List[dict]:
+        """top 'limit' preferences of the user by inner product with the query vector"""
+        preferences = self._preferences(user_name)
+        if preferences.vectors is None:
+            return []
+        with timer("session_cache_search"):
+            scores = preferences.vectors @ np.asarray(query_vector, dtype=np.float32)
+            return preferences.top_hits(scores, limit)
+
+    def lexical_search(self, user_name: str, query: str, limit: int = 10) -> List[dict]:
+        """top 'limit' preferences of the user by bm25 score of the query text, preferences without a query term are left out"""
+        preferences = self._preferences(user_name)
+        with timer("lexical_search"):
+            scores = preferences.lexical_index.scores(query)
+            return preferences.top_hits(scores, min(limit, int((scores > 0).sum())))
+
+
+def invalidate_user(user_name: Optional[str] = None):
+    """call after writing preferences of a user, drops them from all session caches of the process"""
+    for session_cache in list(_session_caches):
+        session_cache.invalidate(user_name)
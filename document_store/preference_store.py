@@ -0,0 +1,15 @@
+from utils.milvus_utils import get_database_backend, get_milvus_client
+
+
+def get_preference_store(milvus_client=None, **kwargs):
+    """returns the preference store of the configured [database] backend"""
+    if milvus_client is None:
+        milvus_client = get_milvus_client()
+    if get_database_backend() == "numpy":
+        from document_store.numpy_preference_store import NumpyPreferenceStore
+
+        return NumpyPreferenceStore(milvus_client=milvus_client)
+
+    from document_store.milvus2_preference_store import Milvus2PreferenceStore
+
+    return Milvus2PreferenceStore(milvus_client=milvus_client, **kwargs)
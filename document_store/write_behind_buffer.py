@@ -0,0 +1,179 @@
+import logging
+import threading
+import time
+from typing import Any, List
+
+from pymilvus import Collection
+
+from document_store.preference_session_cache import invalidate_user
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """
+    Write-behind buffer for one collection.
+    Inserted rows are collected in memory, a background thread inserts and flushes them when
+    'max_rows' are buffered or the oldest buffered row is older than 'flush_interval' seconds.
+    The collection is compacted once no rows were written for 'compaction_idle' seconds.
+    The buffer is bounded, add() blocks while 'max_rows' rows are waiting to be written.
+    Rows are only visible to queries and durable after they are written, sync() writes and flushes them at once.
+    Rows of a failed insert are put back into the buffer and retried after 'flush_interval' seconds,
+    after a write the session caches of the written users are invalidated.
+    """
+
+    def __init__(
+        self,
+        collection: Collection,
+        max_rows: int = 1000,
+        flush_interval: float = 5.0,
+        compaction_idle: float = 60.0,
+    ):
+        self.collection = collection
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.compaction_idle = compaction_idle
+        self._rows: List[dict] = []
+        self._oldest_row_time = None
+        self._last_write_time = time.monotonic()
+        self._needs_compaction = False
+        # no background write before this time, set after a failed write
+        self._retry_after = 0.0
+        self._writes_in_progress = 0
+        self._error = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name=f"write-behind-{collection.name}", daemon=True
+        )
+        self._thread.start()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(
+                f"Writing buffered rows to {self.collection.name} failed"
+            ) from error
+
+    def add(self, rows: List[dict]):
+        """buffers the rows, a batch that does not fit is added in slices while the buffer is written"""
+        with self._condition:
+            self._raise_error()
+            if self._closed:
+                raise RuntimeError("WriteBehindBuffer is closed")
+            start = 0
+            while start < len(rows):
+                while len(self._rows) >= self.max_rows:
+                    self._condition.notify_all()
+                    self._condition.wait()
+                    self._raise_error()
+                if not self._rows:
+                    self._oldest_row_time = time.monotonic()
+                end = start + self.max_rows - len(self._rows)
+                self._rows.extend(rows[start:end])
+                start = end
+                if len(self._rows) >= self.max_rows:
+                    self._condition.notify_all()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._rows)
+
+    def _take_rows(self):
+        rows, self._rows = self._rows, []
+        self._oldest_row_time = None
+        self._writes_in_progress += 1
+        self._condition.notify_all()
+        return rows
+
+    def _requeue(self, rows: List[dict]):
+        # puts the rows of a failed insert back in front of the buffer, in their original order
+        self._rows[:0] = rows
+        self._oldest_row_time = time.monotonic()
+        self._retry_after = self._oldest_row_time + self.flush_interval
+
+    def _write(self, rows: List[dict]) -> Any:
+        # called without holding the lock, add() can continue to buffer rows meanwhile
+        mutation_result = None
+        try:
+            if rows:
+                try:
+                    mutation_result = self.collection.insert(rows)
+                except Exception:
+                    # not written, keep the rows for the next write instead of dropping them
+                    with self._condition:
+                        self._requeue(rows)
+                    raise
+                self.collection.flush()
+                logger.info(
+                    f"Inserted {mutation_result.insert_count} buffered entities"
+                )
+                for user_name in {row.get("user_name") for row in rows}:
+                    invalidate_user(user_name)
+        finally:
+            with self._condition:
+                self._writes_in_progress -= 1
+                if rows:
+                    self._last_write_time = time.monotonic()
+                    self._needs_compaction = True
+                self._condition.notify_all()
+        return mutation_result
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed:
+                    now = time.monotonic()
+                    if now >= self._retry_after and (
+                        len(self._rows) >= self.max_rows
+                        or (
+                            self._rows
+                            and now - self._oldest_row_time >= self.flush_interval
+                        )
+                    ):
+                        break
+                    if (
+                        self._needs_compaction
+                        and not self._rows
+                        and now - self._last_write_time >= self.compaction_idle
+                    ):
+                        break
+                    self._condition.wait(timeout=min(1.0, self.flush_interval))
+                if self._closed:
+                    return
+                rows = self._take_rows() if self._rows else []
+                compact = not rows
+                if compact:
+                    self._needs_compaction = False
+            try:
+                if compact:
+                    # quiet period, merge the small segments created by the flushes
+                    self.collection.compact()
+                else:
+                    self._write(rows)
+            except Exception as e:
+                logger.exception("Background write of buffered rows failed")
+                with self._condition:
+                    self._error = e
+                    self._condition.notify_all()
+
+    def sync(self) -> Any:
+        """writes and flushes all buffered rows, rows added before the call are durable and visible afterwards"""
+        with self._condition:
+            self._raise_error()
+            # wait for a running background write, its rows are part of the sync
+            while self._writes_in_progress:
+                self._condition.wait()
+            self._raise_error()
+            rows = self._take_rows()
+        return self._write(rows)
+
+    def close(self):
+        """writes the remaining rows and stops the background thread, also if the last write fails"""
+        try:
+            self.sync()
+        finally:
+            with self._condition:
+                self._closed = True
+                self._condition.notify_all()
+            self._thread.join()
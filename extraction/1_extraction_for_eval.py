@@ -5,7 +5,6 @@ import sys
 import uuid
 from pathlib import Path
 
-from rich.progress import track
 from tqdm import tqdm
 
 # Add the project root to the sys.path
@@ -20,16 +19,23 @@ from extraction.mapping_category_to_pyd_category import (
     category_to_pyd_category_sub_extra,
 )
 from extraction.preference_memory import PreferenceMemory
+from extraction.streaming_parser import STREAM_MODES
 from extraction.pydantic_schemas.categories_pydantic import (
-    PreferencesFunctionOutput,
-    return_pydantic_schema,
-    return_pydantic_schema_wo_category,
+    get_pydantic_schema,
+    get_pydantic_schema_wo_category,
+    schema_cache_info,
 )
-from utils.custom_logger import log_debug, log_error
+from utils.checkpoint import RunCheckpoint
+from utils.custom_logger import log_debug, log_error, log_info
+from utils.embedding_batcher import EMBEDDING_BATCH_SIZE, EmbeddingBatcher
 from utils.general_utils import stringify_conversations
-from utils.llm import get_embedding, get_llm_gpt4o
+from utils.latency import timer, write_latency_report
+from utils.llm import get_embedding
 from utils.start_langsmith_tracing import start_langsmith_tracing
 
+EXTRACTION_FUNCTION_NAME = "extract_user_preferences"
+EXTRACTION_FUNCTION_DESCRIPTION = "A function that extracts long-term personal preferences of the user in the categories 'Points of Interest', 'Navigation and Routing', 'Vehicle Settings and Comfort', 'Entertainment and Media' and its specified subcategories. It ignores preferences that don't fit into the categories. Don't generate new categories"
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -61,9 +67,372 @@ def parse_args():
         default="extraction/evaluation/gpt4o/extraction_for_eval_out_of_schema/dataset",
     )
     parser.add_argument("--output_file", type=str, default="extraction_for_eval.jsonl")
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=8,
+        help="maximum number of conversations for which the llm is called concurrently",
+    )
+    parser.add_argument(
+        "--embedding_batch_size",
+        type=int,
+        default=EMBEDDING_BATCH_SIZE,
+        help="number of texts embedded per embedding request",
+    )
+    parser.add_argument(
+        "--stream_extraction",
+        type=str,
+        default="off",
+        choices=STREAM_MODES,
+        help="'strict' streams the extraction function call and stops on arguments that are no object, which saves almost nothing (see extraction/streaming_parser.py). with an llm cache the call is not streamed",
+    )
+    parser.add_argument(
+        "--resume",
+        type=bool,
+        default=False,
+        help="skip users and conversations that are already in the output file (or its .progress file) of a previous run",
+    )
     return parser.parse_args()
 
 
+async def extract_conversation(
+    datapoint,
+    john_user_id,
+    john_username,
+    preference_memory,
+    experiment_type,
+    semaphore,
+    progress,
+    embedding_batcher,
+    stream_extraction="off",
+):
+    """
+    performs the extraction on one conversation, the llm calls are limited by the shared semaphore.
+    the extraction result is written into the datapoint.
+    """
+
+    datapoint_strings = datapoint["user_preference"].split(";")
+    datapoint_user_preference_dict = {
+        "main_category": datapoint_strings[0].strip(),
+        "subcategory": datapoint_strings[1].strip(),
+        "detail_category": datapoint_strings[2].strip(),
+        "attribute": datapoint_strings[3].strip(),
+    }
+
+    main_category_pyd_class = category_to_pyd_category_sub_extra(
+        datapoint_strings[0].strip(), "main_category"
+    )
+    main_category_pyd_variable = category_to_pyd_category(
+        datapoint_strings[0].strip(), "main_category"
+    )
+    subcategory_pyd_class = category_to_pyd_category_sub_extra(
+        datapoint_strings[1].strip(), "subcategory"
+    )
+    subcategory_pyd_variable = category_to_pyd_category(
+        datapoint_strings[1].strip(), "subcategory"
+    )
+    detail_category_pyd_variable = category_to_pyd_category_sub_extra(
+        datapoint_strings[2].strip(), "detail_category"
+    )
+
+    if experiment_type == "in_schema":
+        # remove ground-truth preference from examples in schema
+        ModifiedPreferencesBaseModel, extraction_function = get_pydantic_schema(
+            detail_category_pyd_variable,
+            datapoint_user_preference_dict["attribute"],
+            name=EXTRACTION_FUNCTION_NAME,
+            description=EXTRACTION_FUNCTION_DESCRIPTION,
+        )
+    elif experiment_type == "out_of_schema":
+        # remove ground-truth subcategory and corresponding detail category from schema
+        ModifiedPreferencesBaseModel, extraction_function = (
+            get_pydantic_schema_wo_category(
+                main_category_pyd_variable,
+                subcategory_pyd_variable,
+                subcategory_pyd_class,
+                detail_category_pyd_variable,
+                name=EXTRACTION_FUNCTION_NAME,
+                description=EXTRACTION_FUNCTION_DESCRIPTION,
+            )
+        )
+    else:
+        raise ValueError(
+            "Experiment type not supported, either in_schema or out_of_schema"
+        )
+
+    # create extraction function
+    extraction_chain = await preference_memory.create_memory_function(
+        parameters=ModifiedPreferencesBaseModel,
+        target_type="user_state",
+        name=EXTRACTION_FUNCTION_NAME,
+        custom_instructions="Only extract long-term user preferences, no temporal desires in the current situation. It is better to not extract any preference than to extract temporal wishes.",
+        description=EXTRACTION_FUNCTION_DESCRIPTION,
+        function=extraction_function,
+    )
+
+    conversation_extraction = {}
+
+    keys_to_include_category_eval = [
+        "main_category",
+        "subcategory",
+        "detail_category",
+    ]
+    ground_truth_preference_categories = {
+        key: datapoint_user_preference_dict[key]
+        for key in keys_to_include_category_eval
+        if key in datapoint_user_preference_dict
+    }
+
+    conversation_extraction.update(
+        {
+            "ground_truth_preference": datapoint_user_preference_dict,
+            "ground_truth_preference_categories_labels": convert_preference_to_labels(
+                ground_truth_preference_categories
+            ),
+        }
+    )
+
+    # convert conversation into expected messages format
+    conversation = datapoint["extraction_conversation"]
+    messages = [
+        {
+            "content": str(list(turn.values())[0]),
+            "role": (
+                "User" if str(list(turn.keys())[0]) == "USER" else "Voice Assistant"
+            ),
+            "name": (john_username if str(list(turn.keys())[0]) == "USER" else None),
+            "metadata": {
+                "user_id": (
+                    str(john_user_id) if str(list(turn.keys())[0]) == "USER" else None
+                ),
+            },
+        }
+        for turn in conversation
+    ]
+
+    # perform extraction on one conversation
+    messages_string = stringify_conversations(messages)
+    print("\nConversation: \n", messages_string)
+    async with semaphore:
+        with timer("extraction"):
+            if stream_extraction == "off":
+                output_extraction = await extraction_chain.ainvoke(
+                    input={"user_name": john_username, "conversation": messages_string}
+                )
+            else:
+                output_extraction = await preference_memory.astream_extraction(
+                    extraction_chain,
+                    input={
+                        "user_name": john_username,
+                        "conversation": messages_string,
+                    },
+                )
+        log_debug(f"Outout Extraction: {output_extraction}")
+
+        # validate if output is valid according to preference schema and retry if necessary
+        output_extraction_retry, valid_at_try = (
+            await preference_memory.avalidate_output_and_retry(
+                output_extraction=output_extraction,
+                pydantic_schema=ModifiedPreferencesBaseModel,
+                chain=extraction_chain,
+                messages_string=messages_string,
+                username=john_username,
+            )
+        )
+
+    conversation_extraction.update(
+        {
+            "valid_at_try": valid_at_try,
+            "repaired_locally": output_extraction_retry.additional_kwargs.get(
+                "repaired_locally", False
+            ),
+            "stopped_early": output_extraction_retry.additional_kwargs.get(
+                "stopped_early", False
+            ),
+        }
+    )
+    if valid_at_try == 1 and not conversation_extraction["repaired_locally"]:
+        pass
+    elif valid_at_try in (1, 2):
+        # invalid first output, repaired locally (try 1) or by the llm retry (try 2)
+        conversation_extraction.update(
+            {
+                "failed_extraction_1": json.loads(
+                    output_extraction.additional_kwargs["function_call"]["arguments"]
+                ),
+            }
+        )
+        output_extraction = output_extraction_retry
+    else:
+        conversation_extraction.update(
+            {
+                "failed_extraction_1": json.loads(
+                    output_extraction.additional_kwargs["function_call"]["arguments"]
+                ),
+                "failed_extraction_2": json.loads(
+                    output_extraction_retry.additional_kwargs["function_call"][
+                        "arguments"
+                    ]
+                ),
+            }
+        )
+
+    function_json_extraction = json.loads(
+        output_extraction.additional_kwargs["function_call"]["arguments"]
+    )
+    log_debug(f"Function Json Extraction: {function_json_extraction}")
+
+    # log extraction and extracted labels for evaluation
+    num_preference_counter = 0
+
+    if function_json_extraction and not valid_at_try == None:
+        for (
+            main_category,
+            rest,
+        ) in (
+            function_json_extraction.items()
+        ):  # in for loop are preferences of one main category
+            extracted_preferences_per_category = {"main_category": main_category}
+            for subcategory, rest in rest.items():
+                # discard if preference extracted in no_or_other_preferences
+                if not (subcategory == "no_or_other_preferences"):
+                    extracted_preferences_per_category.update(
+                        {"subcategory": subcategory}
+                    )
+                    for detail_category, value in rest.items():
+                        # discard if preference extracted in no_or_other_preferences
+                        if not (detail_category == "no_or_other_preferences"):
+                            extracted_preferences_per_category.update(
+                                {"detail_category": detail_category}
+                            )
+                            for preference in value:
+                                extracted_preference = (
+                                    extracted_preferences_per_category.copy()
+                                )
+                                extracted_preference.update(
+                                    {
+                                        "text": preference[
+                                            "user_sentence_preference_revealed"
+                                        ],
+                                        "attribute": preference["user_preference"],
+                                        "vector": None,  # filled by the embedding batcher of the user, vector is replaced when uploading to database in load_extracted_to_database_vctr_dc_attr_text.py
+                                        "user_name": john_username,
+                                    }
+                                )
+
+                                keys_to_include_preference_eval = [
+                                    "main_category",
+                                    "subcategory",
+                                    "detail_category",
+                                    "attribute",
+                                ]
+                                extracted_preference_eval = {
+                                    key: extracted_preference[key]
+                                    for key in keys_to_include_preference_eval
+                                    if key in extracted_preference
+                                }
+                                extracted_preference_categories_eval = {
+                                    key: extracted_preference[key]
+                                    for key in keys_to_include_category_eval
+                                    if key in extracted_preference
+                                }
+
+                                embedding_batcher.add(
+                                    extracted_preference["text"],
+                                    extracted_preference,
+                                )
+
+                                conversation_extraction.update(
+                                    {
+                                        f"extracted_preference_{num_preference_counter}_full": extracted_preference,
+                                        f"extracted_preference_{num_preference_counter}_core": extracted_preference_eval,
+                                        f"extracted_preference_{num_preference_counter}_categories_label": convert_preference_to_labels(
+                                            extracted_preference_categories_eval
+                                        ),
+                                    }
+                                )
+                                num_preference_counter += 1
+
+    conversation_extraction.update(
+        {
+            "number_preferences_extracted": num_preference_counter,
+        }
+    )
+
+    # add extraction result to datapoint
+    datapoint["conversation_extracted_preferences"] = conversation_extraction
+    progress.update(1)
+
+
+def restore_conversation(datapoint, embedding_batcher):
+    """
+    registers the extracted preferences of a conversation restored from the checkpoint for embedding,
+    the checkpoint is written before the vectors are filled in.
+    """
+    conversation_extraction = datapoint["conversation_extracted_preferences"]
+    for key, extracted_preference in conversation_extraction.items():
+        if key.startswith("extracted_preference_") and key.endswith("_full"):
+            embedding_batcher.add(extracted_preference["text"], extracted_preference)
+
+
+async def extract_user(
+    line,
+    preference_memory,
+    experiment_type,
+    semaphore,
+    progress,
+    embedding,
+    embedding_batch_size,
+    checkpoint,
+    stream_extraction="off",
+):
+    """
+    performs the extraction on all conversations of one user (= one dataset line) concurrently.
+    the extracted preferences of the user are embedded together in batches afterwards.
+    finished conversations are saved to the checkpoint, conversations saved by a previous run are not extracted again.
+    """
+    john_user_id = uuid.UUID(line["user_uuid"])
+    john_username = f"john-{john_user_id.hex[:4]}"
+    embedding_batcher = EmbeddingBatcher(
+        embedding=embedding, chunk_size=embedding_batch_size
+    )
+
+    async def extract_and_save(index, datapoint):
+        await extract_conversation(
+            datapoint=datapoint,
+            john_user_id=john_user_id,
+            john_username=john_username,
+            preference_memory=preference_memory,
+            experiment_type=experiment_type,
+            semaphore=semaphore,
+            progress=progress,
+            embedding_batcher=embedding_batcher,
+            stream_extraction=stream_extraction,
+        )
+        await checkpoint.asave_conversation(line["user_uuid"], index, datapoint)
+
+    conversation_tasks = []
+    for index, datapoint in enumerate(line["data"]):  # one conversation in for loop
+        restored_datapoint = checkpoint.conversation_result(line["user_uuid"], index)
+        if restored_datapoint is not None:
+            line["data"][index] = restored_datapoint
+            restore_conversation(restored_datapoint, embedding_batcher)
+            progress.update(1)
+        else:
+            conversation_tasks.append(extract_and_save(index, datapoint))
+
+    await asyncio.gather(*conversation_tasks)
+    async with semaphore:
+        await embedding_batcher.aflush()
+
+    # write line extended with extraction results, filter conversations where no extraction is performed
+    filtered_data = filter(
+        lambda d: "conversation_extracted_preferences" in d, line["data"]
+    )
+    line["data"] = list(filtered_data)
+    return line
+
+
 async def main():
 
     # ====================================================================
@@ -76,14 +445,17 @@ async def main():
 
     if args.experiment_type == "in_schema":
         os.makedirs(args.output_dir_in_schema, exist_ok=True)
+        output_path = os.path.join(args.output_dir_in_schema, args.output_file)
     elif args.experiment_type == "out_of_schema":
         os.makedirs(args.output_dir_out_of_schema, exist_ok=True)
+        output_path = os.path.join(args.output_dir_out_of_schema, args.output_file)
     else:
         raise ValueError(
             "Experiment type not supported, either in_schema or out_of_schema"
         )
 
     preference_memory = PreferenceMemory()
+    embedding = get_embedding()
 
     # read out train dataset
     train_dataset_lines = []
@@ -92,270 +464,54 @@ async def main():
             train_dataset_line = json.loads(line.strip())
             train_dataset_lines.append(train_dataset_line)
 
-    for idx, line in enumerate(
-        track(train_dataset_lines[:50])
-    ):  # evaluate on 50 dataset lines (= 50 user with 10 conversations each)
-        john_user_id = uuid.UUID(line["user_uuid"])
-        john_username = f"john-{john_user_id.hex[:4]}"
-
-        for datapoint in tqdm(line["data"]):  # one conversation in for loop
-
-            datapoint_strings = datapoint["user_preference"].split(";")
-            datapoint_user_preference_dict = {
-                "main_category": datapoint_strings[0].strip(),
-                "subcategory": datapoint_strings[1].strip(),
-                "detail_category": datapoint_strings[2].strip(),
-                "attribute": datapoint_strings[3].strip(),
-            }
-
-            main_category_pyd_class = category_to_pyd_category_sub_extra(
-                datapoint_strings[0].strip(), "main_category"
-            )
-            main_category_pyd_variable = category_to_pyd_category(
-                datapoint_strings[0].strip(), "main_category"
-            )
-            subcategory_pyd_class = category_to_pyd_category_sub_extra(
-                datapoint_strings[1].strip(), "subcategory"
-            )
-            subcategory_pyd_variable = category_to_pyd_category(
-                datapoint_strings[1].strip(), "subcategory"
-            )
-            detail_category_pyd_variable = category_to_pyd_category_sub_extra(
-                datapoint_strings[2].strip(), "detail_category"
-            )
-
-            if args.experiment_type == "in_schema":
-                # remove ground-truth preference from examples in schema
-                ModifiedPreferencesBaseModel = return_pydantic_schema(
-                    detail_category_pyd_variable,
-                    datapoint_user_preference_dict["attribute"],
-                )
-            elif args.experiment_type == "out_of_schema":
-                # remove ground-truth subcategory and corresponding detail category from schema
-                ModifiedPreferencesBaseModel = return_pydantic_schema_wo_category(
-                    main_category_pyd_variable,
-                    subcategory_pyd_variable,
-                    subcategory_pyd_class,
-                    detail_category_pyd_variable,
-                )
-            else:
-                raise ValueError(
-                    "Experiment type not supported, either in_schema or out_of_schema"
-                )
-
-            # create extraction function
-            extraction_chain = await preference_memory.create_memory_function(
-                llm=get_llm_gpt4o(),
-                parameters=ModifiedPreferencesBaseModel,
-                target_type="user_state",
-                name="extract_user_preferences",
-                custom_instructions="Only extract long-term user preferences, no temporal desires in the current situation. It is better to not extract any preference than to extract temporal wishes.",
-                description="A function that extracts long-term personal preferences of the user in the categories 'Points of Interest', 'Navigation and Routing', 'Vehicle Settings and Comfort', 'Entertainment and Media' and its specified subcategories. It ignores preferences that don't fit into the categories. Don't generate new categories",
+    # evaluate on 50 dataset lines (= 50 user with 10 conversations each)
+    train_dataset_lines = train_dataset_lines[:50]
+
+    checkpoint = RunCheckpoint(output_path, resume=args.resume)
+    if args.resume:
+        train_dataset_lines = [
+            line
+            for line in train_dataset_lines
+            if not checkpoint.is_completed(line["user_uuid"])
+        ]
+        log_info(f"{len(train_dataset_lines)} users left to extract")
+
+    # all conversations are scheduled at once, the semaphore bounds the number of concurrent llm calls
+    semaphore = asyncio.Semaphore(args.max_concurrency)
+    progress = tqdm(total=sum(len(line["data"]) for line in train_dataset_lines))
+    user_tasks = [
+        asyncio.create_task(
+            extract_user(
+                line=line,
+                preference_memory=preference_memory,
+                experiment_type=args.experiment_type,
+                semaphore=semaphore,
+                progress=progress,
+                embedding=embedding,
+                embedding_batch_size=args.embedding_batch_size,
+                checkpoint=checkpoint,
+                stream_extraction=args.stream_extraction,
             )
-
-            conversation_extraction = {}
-
-            keys_to_include_category_eval = [
-                "main_category",
-                "subcategory",
-                "detail_category",
-            ]
-            ground_truth_preference_categories = {
-                key: datapoint_user_preference_dict[key]
-                for key in keys_to_include_category_eval
-                if key in datapoint_user_preference_dict
-            }
-
-            conversation_extraction.update(
-                {
-                    "ground_truth_preference": datapoint_user_preference_dict,
-                    "ground_truth_preference_categories_labels": convert_preference_to_labels(
-                        ground_truth_preference_categories
-                    ),
-                }
-            )
-
-            # convert conversation into expected messages format
-            conversation = datapoint["extraction_conversation"]
-            messages = [
-                {
-                    "content": str(list(turn.values())[0]),
-                    "role": (
-                        "User"
-                        if str(list(turn.keys())[0]) == "USER"
-                        else "Voice Assistant"
-                    ),
-                    "name": (
-                        john_username if str(list(turn.keys())[0]) == "USER" else None
-                    ),
-                    "metadata": {
-                        "user_id": (
-                            str(john_user_id)
-                            if str(list(turn.keys())[0]) == "USER"
-                            else None
-                        ),
-                    },
-                }
-                for turn in conversation
-            ]
-
-            # perform extraction on one conversation
-            messages_string = stringify_conversations(messages)
-            print("\nConversation: \n", messages_string)
-            output_extraction = extraction_chain.invoke(
-                input={"user_name": john_username, "conversation": messages_string}
-            )
-            log_debug(f"Outout Extraction: {output_extraction}")
-
-            # validate if output is valid according to preference schema and retry if necessary
-            output_extraction_retry, valid_at_try = (
-                preference_memory.validate_output_and_retry(
-                    output_extraction=output_extraction,
-                    pydantic_schema=ModifiedPreferencesBaseModel,
-                    chain=extraction_chain,
-                    messages_string=messages_string,
-                    username=john_username,
-                )
-            )
-
-            conversation_extraction.update(
-                {
-                    "valid_at_try": valid_at_try,
-                }
-            )
-            if valid_at_try == 1:
-                pass
-            elif valid_at_try == 2:
-                conversation_extraction.update(
-                    {
-                        "failed_extraction_1": json.loads(
-                            output_extraction.additional_kwargs["function_call"][
-                                "arguments"
-                            ]
-                        ),
-                    }
-                )
-                output_extraction = output_extraction_retry
-            else:
-                conversation_extraction.update(
-                    {
-                        "failed_extraction_1": json.loads(
-                            output_extraction.additional_kwargs["function_call"][
-                                "arguments"
-                            ]
-                        ),
-                        "failed_extraction_2": json.loads(
-                            output_extraction_retry.additional_kwargs["function_call"][
-                                "arguments"
-                            ]
-                        ),
-                    }
-                )
-
-            function_json_extraction = json.loads(
-                output_extraction.additional_kwargs["function_call"]["arguments"]
-            )
-            log_debug(f"Function Json Extraction: {function_json_extraction}")
-
-            # log extraction and extracted labels for evaluation
-            num_preference_counter = 0
-
-            if function_json_extraction and not valid_at_try == None:
-                for (
-                    main_category,
-                    rest,
-                ) in (
-                    function_json_extraction.items()
-                ):  # in for loop are preferences of one main category
-                    extracted_preferences_per_category = {
-                        "main_category": main_category
-                    }
-                    for subcategory, rest in rest.items():
-                        # discard if preference extracted in no_or_other_preferences
-                        if not (subcategory == "no_or_other_preferences"):
-                            extracted_preferences_per_category.update(
-                                {"subcategory": subcategory}
-                            )
-                            for detail_category, value in rest.items():
-                                # discard if preference extracted in no_or_other_preferences
-                                if not (detail_category == "no_or_other_preferences"):
-                                    extracted_preferences_per_category.update(
-                                        {"detail_category": detail_category}
-                                    )
-                                    for preference in value:
-                                        extracted_preference = (
-                                            extracted_preferences_per_category.copy()
-                                        )
-                                        extracted_preference.update(
-                                            {
-                                                "text": preference[
-                                                    "user_sentence_preference_revealed"
-                                                ],
-                                                "attribute": preference[
-                                                    "user_preference"
-                                                ],
-                                                "vector": get_embedding().embed_query(
-                                                    preference[
-                                                        "user_sentence_preference_revealed"
-                                                    ]
-                                                ),  # vector is replaced when uploading to database in load_extracted_to_database_vctr_dc_attr_text.py
-                                                "user_name": john_username,
-                                            }
-                                        )
-
-                                        keys_to_include_preference_eval = [
-                                            "main_category",
-                                            "subcategory",
-                                            "detail_category",
-                                            "attribute",
-                                        ]
-                                        extracted_preference_eval = {
-                                            key: extracted_preference[key]
-                                            for key in keys_to_include_preference_eval
-                                            if key in extracted_preference
-                                        }
-                                        extracted_preference_categories_eval = {
-                                            key: extracted_preference[key]
-                                            for key in keys_to_include_category_eval
-                                            if key in extracted_preference
-                                        }
-
-                                        conversation_extraction.update(
-                                            {
-                                                f"extracted_preference_{num_preference_counter}_full": extracted_preference,
-                                                f"extracted_preference_{num_preference_counter}_core": extracted_preference_eval,
-                                                f"extracted_preference_{num_preference_counter}_categories_label": convert_preference_to_labels(
-                                                    extracted_preference_categories_eval
-                                                ),
-                                            }
-                                        )
-                                        num_preference_counter += 1
-
-            conversation_extraction.update(
-                {
-                    "number_preferences_extracted": num_preference_counter,
-                }
-            )
-
-            # add extraction result to datapoint
-            datapoint["conversation_extracted_preferences"] = conversation_extraction
-
-        # write line extended with extraction results, filter conversations where no extraction is performed
-        filtered_data = filter(
-            lambda d: "conversation_extracted_preferences" in d, line["data"]
         )
-        line["data"] = list(filtered_data)
-
-        if args.experiment_type == "in_schema":
-            with open(
-                os.path.join(args.output_dir_in_schema, args.output_file), "a"
-            ) as file:
-                file.write(json.dumps(line) + "\n")
-        elif args.experiment_type == "out_of_schema":
-            with open(
-                os.path.join(args.output_dir_out_of_schema, args.output_file), "a"
-            ) as file:
-                file.write(json.dumps(line) + "\n")
+        for line in train_dataset_lines
+    ]
+
+    # lines are awaited in dataset order, so the output file keeps the user order
+    try:
+        for user_task in user_tasks:
+            line = await user_task
+            checkpoint.write_line(line)
+        checkpoint.finish()
+    finally:
+        for user_task in user_tasks:
+            user_task.cancel()
+        progress.close()
+    log_debug(f"Schema cache: {schema_cache_info()}")
+    # local_repairs is the number of llm retries saved by the local repair of invalid outputs
+    print(f"Validation retries: {preference_memory.retry_stats}")
+    if args.stream_extraction != "off":
+        print(f"Extraction streams: {preference_memory.stream_stats}")
+    write_latency_report("1_extraction_for_eval")
 
 
 if __name__ == "__main__":
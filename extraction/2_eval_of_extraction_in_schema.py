@@ -114,6 +114,8 @@ def main():
     valid_at_try_1_counter = 0
     valid_at_try_2_counter = 0
     not_valid_extraction_counter = 0
+    # outputs made valid by the local schema repair, they count as valid at try 1 (one llm try)
+    repaired_locally_counter = 0
 
     for line in extraction_for_eval_lines:
         for conversation in line["data"]:
@@ -334,6 +336,8 @@ def main():
                         string_in_extracted_preference_counter_user_only += 1
             # ========
 
+            if conversation_extraction.get("repaired_locally", False):
+                repaired_locally_counter += 1
             if conversation_extraction["valid_at_try"] == 1:
                 valid_at_try_1_counter += 1
             elif conversation_extraction["valid_at_try"] == 2:
@@ -427,6 +431,7 @@ def main():
         "valid_at_try_1_counter": valid_at_try_1_counter,
         "valid_at_try_2_counter": valid_at_try_2_counter,
         "not_valid_extraction_counter": not_valid_extraction_counter,
+        "repaired_locally_counter": repaired_locally_counter,
     }
     if args.write_to_file:
         with open(os.path.join(args.output_dir, args.output_file), "a") as file:
@@ -115,6 +115,8 @@ def main():
     valid_at_try_1_counter = 0
     valid_at_try_2_counter = 0
     not_valid_extraction_counter = 0
+    # outputs made valid by the local schema repair, they count as valid at try 1 (one llm try)
+    repaired_locally_counter = 0
 
     for i in list(range(0, 50)):  # + list(range(20, 50)) + list(range(60, 70)):
         line = extraction_for_eval_lines[i]
@@ -207,6 +209,8 @@ def main():
             ]
             number_preferences_extracted_total += number_preferences_extracted
 
+            if conversation_extraction.get("repaired_locally", False):
+                repaired_locally_counter += 1
             if conversation_extraction["valid_at_try"] == 1:
                 valid_at_try_1_counter += 1
             elif conversation_extraction["valid_at_try"] == 2:
@@ -266,6 +270,7 @@ def main():
         "valid_at_try_1_counter": valid_at_try_1_counter,
         "valid_at_try_2_counter": valid_at_try_2_counter,
         "not_valid_extraction_counter": not_valid_extraction_counter,
+        "repaired_locally_counter": repaired_locally_counter,
     }
     if args.write_to_file:
         with open(os.path.join(args.output_dir, args.output_file), "a") as file:
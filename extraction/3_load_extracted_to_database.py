@@ -5,14 +5,11 @@ Only preferences with extraction accuracy of 1.0 are loaded to the database.
 """
 
 import argparse
-import json
 import os
 import pickle
 import sys
 from pathlib import Path
 
-from pymilvus import MilvusClient
-
 # Add the project root to the sys.path
 project_root = Path(__file__).parent.parent
 sys.path.append(str(project_root))
@@ -20,7 +17,13 @@ sys.path.append(str(project_root))
 from dotenv import load_dotenv
 
 from config.config_loader import config
-from document_store.milvus2_preference_store import Milvus2PreferenceStore
+from document_store.preference_bulk_loader import (
+    INSERT_BATCH_SIZE,
+    PreferenceBulkLoader,
+    read_jsonl,
+)
+from document_store.preference_store import get_preference_store
+from utils.milvus_utils import get_milvus_client
 
 
 def parse_args():
@@ -32,6 +35,18 @@ def parse_args():
         default="extraction/evaluation/gpt4o/eval_of_extraction_in_schema/dataset/eval_of_extraction.jsonl",
         help="The directory + filename where to read the conversations from",
     )
+    parser.add_argument(
+        "--insert_batch_size",
+        type=int,
+        default=INSERT_BATCH_SIZE,
+        help="number of preferences inserted per insert request",
+    )
+    parser.add_argument(
+        "--bulk_insert",
+        type=bool,
+        default=False,
+        help="import the preferences with milvus bulk insert from parquet files uploaded to MinIO (see [bulk_insert] in the config), for very large loads",
+    )
     return parser.parse_args()
 
 
@@ -39,24 +54,22 @@ def main():
 
     args = parse_args()
     load_dotenv()
-    milvus_preference_store = Milvus2PreferenceStore()
+    milvus_client = get_milvus_client()
+    milvus_preference_store = get_preference_store(milvus_client=milvus_client)
     collection_name = "user_preferences_vctr_text"
-    milvus_preference_store._create_collection_and_index(
+    collection = milvus_preference_store._create_collection_and_index(
         collection_name=collection_name, recreate_collection=True
     )
-    milvus_client = MilvusClient(
-        uri=f"http://{config.get('database', 'host')}:{config.get('database', 'port')}"
-    )
-
-    # read out train dataset
-    extraction_for_eval_lines = []
-    with open(args.extracted_prefs_dir, "r") as file:
-        for line in file:
-            extraction_for_eval_line = json.loads(line.strip())
-            extraction_for_eval_lines.append(extraction_for_eval_line)
 
+    preference_loader = PreferenceBulkLoader(
+        milvus_client=milvus_client,
+        collection_name=collection_name,
+        insert_batch_size=args.insert_batch_size,
+        bulk_insert=args.bulk_insert,
+    )
     used_conversation_uuids = []
-    for line in extraction_for_eval_lines:
+    # the file is streamed, the preferences (embedded at extraction) are inserted in chunks
+    for line in read_jsonl(args.extracted_prefs_dir):
         if "data" in line:
             for conversation in line["data"]:
                 try:  # only score conversations where extraction is performed
@@ -81,9 +94,11 @@ def main():
                 extracted_preference["user_name"] = line["user_uuid"]
                 extracted_preference["pk"] = conversation["conversation_uuid"]
                 used_conversation_uuids.append(conversation["conversation_uuid"])
-                milvus_client.insert(
-                    collection_name=collection_name, data=extracted_preference
-                )
+                preference_loader.add(extracted_preference)
+
+    preference_loader.finish()
+    # choose the index for the loaded number of preferences
+    milvus_preference_store.adapt_index(collection)
     with open(
         os.path.join(Path(__file__).parent, "used_conversation_uuids.pkl"), "wb"
     ) as file:
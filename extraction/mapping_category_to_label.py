@@ -1,7 +1,9 @@
+from functools import lru_cache
+
 import numpy as np
 
 
-def string_to_number(input_string, category) -> int:
+def category_mapping(category) -> dict:
     # Define the mapping of strings to numbers
     if category == "main_category":
         mapping = {
@@ -128,7 +130,11 @@ def string_to_number(input_string, category) -> int:
         }
     else:
         mapping = {}
+    return mapping
+
 
+def string_to_number(input_string, category) -> int:
+    mapping = category_mapping(category)
     # Check if the input string is in the mapping
     if input_string in mapping:
         return int(mapping[input_string])
@@ -137,6 +143,25 @@ def string_to_number(input_string, category) -> int:
         raise ValueError(f"No mapping found for string: {input_string}")
 
 
+@lru_cache(maxsize=None)
+def _number_to_string_mapping(category) -> dict:
+    mapping = {}
+    for string, number in category_mapping(category).items():
+        # prefer the pydantic name (f.e. 'gas_station') over the display name ('Gas Station')
+        if number not in mapping or (string.islower() and " " not in string):
+            mapping[number] = string
+    return mapping
+
+
+def number_to_string(number, category) -> str:
+    """inverse of string_to_number, returns the pydantic name of the category"""
+    mapping = _number_to_string_mapping(category)
+    if int(number) in mapping:
+        return mapping[int(number)]
+    else:
+        raise ValueError(f"No mapping found for number: {number}")
+
+
 def convert_preference_to_labels(preference) -> np.ndarray:
     label_list = []
     for key, value in preference.items():
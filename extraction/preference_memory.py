@@ -1,8 +1,13 @@
 import datetime
+import hashlib
 import json
 import os
+import threading
 import uuid
+from collections import OrderedDict
+from contextlib import aclosing
 from typing import (
+    Callable,
     Dict,
     Optional,
     Union,
@@ -10,12 +15,22 @@ from typing import (
 )
 
 from langchain.chains.base import Chain
+from langchain_core.caches import BaseCache
 from langchain_core.language_models import BaseLanguageModel
-from langchain_core.prompts import BasePromptTemplate, ChatPromptTemplate
+from langchain_core.messages import AIMessage
+from langchain_core.prompts import (
+    BasePromptTemplate,
+    ChatPromptTemplate,
+    SystemMessagePromptTemplate,
+)
 from langchain_core.utils.function_calling import convert_pydantic_to_openai_function
 from pydantic import BaseModel, ValidationError
 
-from utils.custom_logger import log_debug, log_error, log_info
+from extraction.schema_repair import repair_extraction
+from extraction.streaming_parser import FunctionArgumentsStreamParser
+from utils.custom_logger import log_debug, log_error, log_info, log_warning
+from utils.latency import timer
+from utils.llm import get_llm_gpt4o
 
 extraction_prompt = ChatPromptTemplate.from_messages(
     [
@@ -39,12 +54,38 @@ extraction_prompt = ChatPromptTemplate.from_messages(
     ]
 )
 
+# appended to the system message of the extraction prompt for the retry,
+# the previous output and the validation error are input variables of the retry prompt
+retry_instructions = (
+    "\n\n# Errors from previous try:\n Your previous call did not produce a valid output format (possible reasons: category was skipped, non-existing key, subcategory corresponds to different parent category): "
+    "{previous_extraction_output}. This failed because of the validation error:\n"
+    "{validation_error}"
+    "Please correct the error and extract the same preference in the correct format."
+)
+
+
+def create_retry_chain(chain: Chain) -> Chain:
+    """
+    returns the retry chain for an extraction chain (prompt | llm with bound function).
+    the retry prompt is a new prompt, the prompt of 'chain' is not modified,
+    so the retry chain can be invoked concurrently with the extraction chain.
+    """
+    prompt = chain.first
+    retry_system_message = SystemMessagePromptTemplate.from_template(
+        prompt.messages[0].prompt.template + retry_instructions
+    )
+    retry_prompt = ChatPromptTemplate.from_messages(
+        [retry_system_message, *prompt.messages[1:]]
+    ).partial(**prompt.partial_variables)
+    return retry_prompt | chain.last
+
 
 def create_preference_extraction_chain_pydantic(
     pydantic_schema: BaseModel,
     data: dict,
     llm: BaseLanguageModel,
     prompt: Optional[Union[BasePromptTemplate, ChatPromptTemplate]] = None,
+    function: Optional[Dict] = None,
 ) -> Chain:
     """Creates a chain that extracts user preferences from a conversation using pydantic schema.
 
@@ -53,19 +94,21 @@ def create_preference_extraction_chain_pydantic(
         data: includes information of preference extraction function.
         llm: The language model to use.
         prompt: The prompt to use for extraction.
+        function: precomputed openai function of the pydantic schema, created if not given.
 
     Returns:
         Chain that can be used to extract information from a passage.
     """
 
-    function = cast(
-        Dict,
-        convert_pydantic_to_openai_function(
-            model=pydantic_schema,
-            name=data["schema"]["name"],
-            description=data["schema"]["description"],
-        ),
-    )
+    if function is None:
+        function = cast(
+            Dict,
+            convert_pydantic_to_openai_function(
+                model=pydantic_schema,
+                name=data["schema"]["name"],
+                description=data["schema"]["description"],
+            ),
+        )
     extraction_prompt = (
         prompt
         if type(prompt) == ChatPromptTemplate
@@ -82,30 +125,104 @@ def create_preference_extraction_chain_pydantic(
     return chain
 
 
+def _chain_llm_cache(chain) -> Optional[BaseCache]:
+    """returns the response cache of the llm in the chain (unwrapping bound kwargs), if it has one"""
+    for step in getattr(chain, "steps", [chain]):
+        while hasattr(step, "bound"):
+            step = step.bound
+        cache = getattr(step, "cache", None)
+        if isinstance(cache, BaseCache):
+            return cache
+    return None
+
+
 class PreferenceMemory:
+    """
+    creates and runs the preference extraction chains.
+    the llm clients (and with them their http connection pools) are created once per temperature
+    and the bound extraction chains are cached by the hash of their function schema,
+    so repeated extractions with the same schema reuse the same client and chain.
+    """
+
+    def __init__(
+        self,
+        llm_factory: Callable[..., BaseLanguageModel] = get_llm_gpt4o,
+        max_cached_chains: int = 256,
+        local_repair: bool = True,
+    ) -> None:
+        self.llm_factory = llm_factory
+        self.max_cached_chains = max_cached_chains
+        self.local_repair = local_repair
+        self._llm_pool: Dict[float, BaseLanguageModel] = {}
+        self._chain_cache: "OrderedDict[str, Chain]" = OrderedDict()
+        # id(chain) -> (chain, retry chain), the chain is kept so that its id is not reused
+        self._retry_chain_cache: "OrderedDict[int, tuple[Chain, Chain]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # local_repairs = llm retries saved by repairing the output locally
+        self.retry_stats = {"local_repairs": 0, "llm_retries": 0}
+        # cached = streams replaced by ainvoke because the llm has a response cache,
+        # empty = streams without any chunk, repeated with ainvoke
+        self.stream_stats = {
+            "stopped_early": 0,
+            "completed": 0,
+            "cached": 0,
+            "empty": 0,
+        }
 
-    def __init__(self) -> None:
-        pass
+    def get_llm(self, temperature: float = 0.0) -> BaseLanguageModel:
+        """returns the long-lived llm client for the temperature, created on first use"""
+        if temperature not in self._llm_pool:
+            self._llm_pool[temperature] = self.llm_factory(temperature=temperature)
+        return self._llm_pool[temperature]
+
+    def _chain_cache_key(self, function_schema, custom_instructions, llm) -> str:
+        key = json.dumps(
+            {
+                "function": function_schema,
+                "custom_instructions": custom_instructions,
+                "llm": id(llm),
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
 
     async def create_memory_function(
         self,
-        llm: BaseLanguageModel,
-        parameters: BaseModel,
+        llm: Optional[BaseLanguageModel] = None,
+        parameters: BaseModel = None,
         *,
         target_type: str = "user_state",
         name: Optional[str] = None,
         description: Optional[str] = None,
         custom_instructions: Optional[str] = None,
         function_id: Optional[str] = None,
+        function: Optional[Dict] = None,
     ) -> Chain:
+        """
+        returns the extraction chain for the pydantic schema 'parameters'.
+        if no llm is given, the pooled llm of the PreferenceMemory is used.
+        chains are cached (LRU) by their function schema, custom instructions and llm.
+        """
+        if llm is None:
+            llm = self.get_llm()
+
+        if function is not None:
+            # precomputed function json (see get_pydantic_schema), skips rebuilding the json schema
+            function_schema = function
+        else:
+            params = parameters.model_json_schema()
 
-        params = parameters.model_json_schema()
+            function_schema = {
+                "name": name or params.pop("title", ""),
+                "description": description or params.pop("description", ""),
+                "parameters": params,
+            }
 
-        function_schema = {
-            "name": name or params.pop("title", ""),
-            "description": description or params.pop("description", ""),
-            "parameters": params,
-        }
+        cache_key = self._chain_cache_key(function_schema, custom_instructions, llm)
+        with self._cache_lock:
+            if cache_key in self._chain_cache:
+                self._chain_cache.move_to_end(cache_key)
+                return self._chain_cache[cache_key]
 
         data = {
             "type": target_type,
@@ -115,11 +232,71 @@ class PreferenceMemory:
         }
 
         extraction_chain = create_preference_extraction_chain_pydantic(
-            pydantic_schema=parameters, llm=llm, data=data, prompt=extraction_prompt
+            pydantic_schema=parameters,
+            llm=llm,
+            data=data,
+            prompt=extraction_prompt,
+            function=function,
         )
 
+        with self._cache_lock:
+            self._chain_cache[cache_key] = extraction_chain
+            if len(self._chain_cache) > self.max_cached_chains:
+                self._chain_cache.popitem(last=False)
+
         return extraction_chain
 
+    async def astream_extraction(self, chain: Chain, input: dict):
+        """
+        runs the extraction chain in streaming mode and stops reading the stream as soon as
+        the function call arguments show that no preference will be extracted (see streaming_parser.py).
+        an early stopped output has the arguments '{}' and is marked with 'stopped_early'.
+        chat model streams bypass the llm cache, so with a record/replay cache attached the chain is
+        invoked instead, otherwise replay would call the api and record would store nothing.
+        """
+        if _chain_llm_cache(chain) is not None:
+            self.stream_stats["cached"] += 1
+            return await chain.ainvoke(input)
+        parser = FunctionArgumentsStreamParser()
+        output_extraction = None
+        # closing the stream aborts the request instead of waiting for the remaining tokens
+        async with aclosing(chain.astream(input)) as stream:
+            async for chunk in stream:
+                output_extraction = (
+                    chunk if output_extraction is None else output_extraction + chunk
+                )
+                function_call = chunk.additional_kwargs.get("function_call") or {}
+                if parser.feed(function_call.get("arguments") or ""):
+                    break
+
+        if output_extraction is None:
+            # the stream ended without a chunk, get the answer without streaming
+            log_warning("Extraction stream returned no chunks, invoking instead")
+            self.stream_stats["empty"] += 1
+            return await chain.ainvoke(input)
+        function_name = output_extraction.additional_kwargs.get(
+            "function_call", {}
+        ).get("name")
+        if parser.stopped_early:
+            self.stream_stats["stopped_early"] += 1
+            log_debug(f"Extraction stream stopped early at: {parser.arguments}")
+            return AIMessage(
+                content="",
+                additional_kwargs={
+                    "function_call": {"name": function_name, "arguments": "{}"},
+                    "stopped_early": True,
+                },
+            )
+        self.stream_stats["completed"] += 1
+        additional_kwargs = dict(output_extraction.additional_kwargs)
+        additional_kwargs["function_call"] = {
+            "name": function_name,
+            "arguments": parser.arguments,
+        }
+        return AIMessage(
+            content=output_extraction.content, additional_kwargs=additional_kwargs
+        )
+
     def validate_extraction(self, extraction_result, pydantic_schema: BaseModel):
         if not extraction_result:
             log_debug("The extraction_result is empty. Passing validation by default.")
@@ -133,21 +310,31 @@ class PreferenceMemory:
             log_info("The JSON output is not valid:")
             return e
 
+    def get_retry_chain(self, chain: Chain) -> Chain:
+        """returns the (cached) retry chain of an extraction chain, see create_retry_chain"""
+        with self._cache_lock:
+            if id(chain) in self._retry_chain_cache:
+                self._retry_chain_cache.move_to_end(id(chain))
+                return self._retry_chain_cache[id(chain)][1]
+        retry_chain = create_retry_chain(chain)
+        with self._cache_lock:
+            self._retry_chain_cache[id(chain)] = (chain, retry_chain)
+            if len(self._retry_chain_cache) > self.max_cached_chains:
+                self._retry_chain_cache.popitem(last=False)
+        return retry_chain
+
     def retry_chain_with_validation_error(
         self, extraction_output: str, validation_error: str, chain: Chain
-    ) -> Chain:
-        chain_ = chain.copy()
-        original_prompt = chain.first.messages[0].prompt.template
-        chain_.first.messages[0].prompt.template = (
-            chain.first.messages[0].prompt.template
-            + "\n"
-            + "\n# Errors from previous try:\n Your previous call did not produce a valid output format (possible reasons: category was skipped, non-existing key, subcategory corresponds to different parent category): "
-            + str(extraction_output).replace("{", "{{").replace("}", "}}")
-            + ". This failed because of the validation error:\n"
-            + str(validation_error).replace("{", "{{").replace("}", "}}")
-            + "Please correct the error and extract the same preference in the correct format."
-        )
-        return chain_, original_prompt
+    ) -> tuple[Chain, dict]:
+        """
+        returns the retry chain and the additional inputs (previous output and validation error) for the retry.
+        neither the chain nor its prompt are modified.
+        """
+        retry_inputs = {
+            "previous_extraction_output": str(extraction_output),
+            "validation_error": str(validation_error),
+        }
+        return self.get_retry_chain(chain), retry_inputs
 
     def filter_none_values(self, d):
         if isinstance(d, dict):
@@ -159,6 +346,62 @@ class PreferenceMemory:
         else:
             return d
 
+    def filter_output_extraction(self, output_extraction):
+        # filter None outputs
+        filtered_extraction = json.dumps(
+            self.filter_none_values(
+                json.loads(
+                    output_extraction.additional_kwargs["function_call"]["arguments"]
+                )
+            )
+        )
+        output_extraction.additional_kwargs["function_call"][
+            "arguments"
+        ] = filtered_extraction
+        return output_extraction
+
+    def validate_retry_output(self, output_extraction, pydantic_schema):
+        output_extraction_arguments = json.loads(
+            output_extraction.additional_kwargs["function_call"]["arguments"]
+        )
+        validation_error = self.validate_extraction(
+            extraction_result=output_extraction_arguments,
+            pydantic_schema=pydantic_schema,
+        )
+        if validation_error:
+            valid_at_try = None
+            log_error(
+                f"Repeating Validation of the extraction output w.r.t the pydantic schema: {validation_error}"
+            )
+            return output_extraction, valid_at_try
+        else:
+            valid_at_try = 2
+            return self.filter_output_extraction(output_extraction), valid_at_try
+
+    def repair_output_extraction(self, output_extraction, pydantic_schema):
+        """
+        tries to repair an invalid output along the category hierarchy (see extraction/schema_repair.py).
+        returns a repaired copy of the output, marked with 'repaired_locally', or None if the repair failed.
+        """
+        if not self.local_repair:
+            return None
+        repaired_arguments = repair_extraction(
+            json.loads(
+                output_extraction.additional_kwargs["function_call"]["arguments"]
+            ),
+            pydantic_schema,
+        )
+        if repaired_arguments is None:
+            return None
+        self.retry_stats["local_repairs"] += 1
+        log_info("Invalid extraction output repaired locally, skipping the llm retry.")
+        output_extraction_repaired = output_extraction.model_copy(deep=True)
+        output_extraction_repaired.additional_kwargs["function_call"]["arguments"] = (
+            json.dumps(repaired_arguments)
+        )
+        output_extraction_repaired.additional_kwargs["repaired_locally"] = True
+        return output_extraction_repaired
+
     def validate_output_and_retry(
         self, output_extraction, pydantic_schema, chain, username, messages_string
     ):
@@ -170,62 +413,83 @@ class PreferenceMemory:
         )
 
         if validation_error:
-            extraction_chain_retry, original_prompt = (
+            # the retry with the llm is only done if the repair fails, a repaired output took one llm
+            # try and is marked with 'repaired_locally' instead of counting as the second try
+            output_extraction_repaired = self.repair_output_extraction(
+                output_extraction, pydantic_schema
+            )
+            if output_extraction_repaired is not None:
+                valid_at_try = 1
+                return (
+                    self.filter_output_extraction(output_extraction_repaired),
+                    valid_at_try,
+                )
+
+            self.retry_stats["llm_retries"] += 1
+            extraction_chain_retry, retry_inputs = (
                 self.retry_chain_with_validation_error(
                     extraction_output=str(output_extraction_arguments),
                     validation_error=validation_error,
                     chain=chain,
                 )
             )
-            output_extraction = extraction_chain_retry.invoke(
-                input={"user_name": username, "conversation": messages_string}
-            )
+            with timer("validation_retry"):
+                output_extraction = extraction_chain_retry.invoke(
+                    input={
+                        "user_name": username,
+                        "conversation": messages_string,
+                        **retry_inputs,
+                    }
+                )
+            return self.validate_retry_output(output_extraction, pydantic_schema)
+        else:
+            valid_at_try = 1
+            return self.filter_output_extraction(output_extraction), valid_at_try
 
-            # remove validation error message again
-            chain.first.messages[0].prompt.template = original_prompt
+    async def avalidate_output_and_retry(
+        self, output_extraction, pydantic_schema, chain, username, messages_string
+    ):
+        """
+        async version of validate_output_and_retry, the retry call is awaited so that
+        other extractions can run concurrently while waiting for the llm.
+        """
+        output_extraction_arguments = json.loads(
+            output_extraction.additional_kwargs["function_call"]["arguments"]
+        )
+        validation_error = self.validate_extraction(
+            output_extraction_arguments, pydantic_schema
+        )
 
-            output_extraction_arguments = json.loads(
-                output_extraction.additional_kwargs["function_call"]["arguments"]
-            )
-            validation_error = self.validate_extraction(
-                extraction_result=output_extraction_arguments,
-                pydantic_schema=pydantic_schema,
+        if validation_error:
+            # the retry with the llm is only done if the repair fails, a repaired output took one llm
+            # try and is marked with 'repaired_locally' instead of counting as the second try
+            output_extraction_repaired = self.repair_output_extraction(
+                output_extraction, pydantic_schema
             )
-            if validation_error:
-                valid_at_try = None
-                log_error(
-                    f"Repeating Validation of the extraction output w.r.t the pydantic schema: {validation_error}"
+            if output_extraction_repaired is not None:
+                valid_at_try = 1
+                return (
+                    self.filter_output_extraction(output_extraction_repaired),
+                    valid_at_try,
                 )
-                return output_extraction, valid_at_try
-            else:
-                valid_at_try = 2
-                # filter None outputs
-                filtered_extraction = json.dumps(
-                    self.filter_none_values(
-                        json.loads(
-                            output_extraction.additional_kwargs["function_call"][
-                                "arguments"
-                            ]
-                        )
-                    )
+
+            self.retry_stats["llm_retries"] += 1
+            extraction_chain_retry, retry_inputs = (
+                self.retry_chain_with_validation_error(
+                    extraction_output=str(output_extraction_arguments),
+                    validation_error=validation_error,
+                    chain=chain,
                 )
-                output_extraction.additional_kwargs["function_call"][
-                    "arguments"
-                ] = filtered_extraction
-                return output_extraction, valid_at_try
+            )
+            with timer("validation_retry"):
+                output_extraction = await extraction_chain_retry.ainvoke(
+                    input={
+                        "user_name": username,
+                        "conversation": messages_string,
+                        **retry_inputs,
+                    }
+                )
+            return self.validate_retry_output(output_extraction, pydantic_schema)
         else:
             valid_at_try = 1
-            # filter None outputs
-            filtered_extraction = json.dumps(
-                self.filter_none_values(
-                    json.loads(
-                        output_extraction.additional_kwargs["function_call"][
-                            "arguments"
-                        ]
-                    )
-                )
-            )
-            output_extraction.additional_kwargs["function_call"][
-                "arguments"
-            ] = filtered_extraction
-            return output_extraction, valid_at_try
+            return self.filter_output_extraction(output_extraction), valid_at_try
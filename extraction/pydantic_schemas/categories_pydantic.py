@@ -6,10 +6,14 @@ The actual ground-truth preference is always excluded from the examples.
 
 import json
 from copy import deepcopy
+from functools import lru_cache
 from typing import List, Optional
 
+from langchain_core.utils.function_calling import convert_pydantic_to_openai_function
 from pydantic import BaseModel, Field
 
+from config.config_loader import config
+
 default = (None,)
 
 
@@ -643,9 +647,8 @@ class PreferencesFunctionOutput(BaseModel):
         extra = "forbid"
 
 
-def return_pydantic_schema(detail_category_variable, attribute):
-    EXAMPLES = deepcopy(EXAMPLES_ORIGINAL)
-
+def normalize_example_attribute(detail_category_variable, attribute):
+    # some dataset attributes carry an explanation, the examples only hold the short form
     if (
         detail_category_variable == "preferred_temperature"
         or detail_category_variable == "willingness_to_pay_extra_for_green_fuel"
@@ -658,7 +661,14 @@ def return_pydantic_schema(detail_category_variable, attribute):
         == "distance_willing_to_walk_from_parking_to_destination"
     ):
         attribute = attribute.split("(")[0].strip()
+    return attribute
+
+
+def return_pydantic_schema(detail_category_variable, attribute):
+    EXAMPLES = deepcopy(EXAMPLES_ORIGINAL)
+
     if detail_category_variable and attribute:
+        attribute = normalize_example_attribute(detail_category_variable, attribute)
         EXAMPLES[detail_category_variable].remove(attribute)
 
     class OutputFormat(BaseModel):
@@ -1645,3 +1655,74 @@ def return_pydantic_schema_wo_category(
     # rebuild = UserPreferences.model_rebuild(force=True)
     rebuild = PreferencesFunctionOutput.model_rebuild(force=True)
     return PreferencesFunctionOutput
+
+
+# ==== Cached schema factory ====
+# The schemas only depend on the excluded categories/attribute, which repeat across users.
+# Building them redefines all nested models, so they are built once per exclusion and kept in a bounded LRU.
+SCHEMA_CACHE_SIZE = config.getint("extraction", "schema_cache_size", fallback=256)
+
+
+def _to_openai_function(pydantic_schema, name, description):
+    return convert_pydantic_to_openai_function(
+        model=pydantic_schema, name=name, description=description
+    )
+
+
+@lru_cache(maxsize=SCHEMA_CACHE_SIZE)
+def _cached_pydantic_schema(detail_category_variable, attribute, name, description):
+    pydantic_schema = return_pydantic_schema(detail_category_variable, attribute)
+    return pydantic_schema, _to_openai_function(pydantic_schema, name, description)
+
+
+@lru_cache(maxsize=SCHEMA_CACHE_SIZE)
+def _cached_pydantic_schema_wo_category(
+    maincategory_variable, subcategory_variable, subcategory_class, name, description
+):
+    # the detail category is not used to build the schema, so it is not part of the key
+    pydantic_schema = return_pydantic_schema_wo_category(
+        maincategory_variable, subcategory_variable, subcategory_class, None
+    )
+    return pydantic_schema, _to_openai_function(pydantic_schema, name, description)
+
+
+def get_pydantic_schema(detail_category_variable, attribute, name, description):
+    """
+    cached version of return_pydantic_schema.
+    returns the schema and its openai function json (with the given function name and description).
+    the returned objects are shared between calls and must not be modified.
+    """
+    if detail_category_variable and attribute:
+        attribute = normalize_example_attribute(detail_category_variable, attribute)
+    return _cached_pydantic_schema(
+        detail_category_variable, attribute, name, description
+    )
+
+
+def get_pydantic_schema_wo_category(
+    maincategory_variable,
+    subcategory_variable,
+    subcategory_class,
+    detail_category_variable,
+    name,
+    description,
+):
+    """
+    cached version of return_pydantic_schema_wo_category.
+    returns the schema and its openai function json (with the given function name and description).
+    the returned objects are shared between calls and must not be modified.
+    """
+    return _cached_pydantic_schema_wo_category(
+        maincategory_variable,
+        subcategory_variable,
+        subcategory_class,
+        name,
+        description,
+    )
+
+
+def schema_cache_info():
+    return {
+        "in_schema": _cached_pydantic_schema.cache_info()._asdict(),
+        "out_of_schema": _cached_pydantic_schema_wo_category.cache_info()._asdict(),
+    }
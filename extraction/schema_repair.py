@@ -0,0 +1,163 @@
+"""
+Local repair of extraction outputs that do not validate against the preference schema.
+Most invalid outputs put a detail category below the wrong subcategory (or skip the subcategory),
+or contain keys that do not exist in the schema. Both can be fixed with the category hierarchy
+from 'dataset/categories_v4.csv' without calling the llm again.
+"""
+
+import csv
+import typing
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+from pydantic import BaseModel, ValidationError
+
+from extraction.mapping_category_to_pyd_category import category_to_pyd_category
+
+CATEGORIES_PATH = Path(__file__).parent.parent / "dataset" / "categories_v4.csv"
+NO_OR_OTHER = "no_or_other_preferences"
+
+
+@lru_cache(maxsize=1)
+def load_category_hierarchy(path: str = str(CATEGORIES_PATH)) -> dict:
+    """returns {detail_category: (main_category, subcategory)} with the pydantic variable names"""
+    hierarchy = {}
+    with open(path, "r") as file:
+        for row in csv.DictReader(file, delimiter="#"):
+            detail_category = category_to_pyd_category(
+                row["Detail Category"], "detail_category"
+            )
+            hierarchy[detail_category] = (
+                category_to_pyd_category(row["Main Category"], "main_category"),
+                category_to_pyd_category(row["Subcategory"], "subcategory"),
+            )
+    return hierarchy
+
+
+def _nested_model(annotation):
+    # unwraps Optional[...] / List[...] to the pydantic model inside
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return annotation
+    for arg in typing.get_args(annotation):
+        model = _nested_model(arg)
+        if model is not None:
+            return model
+    return None
+
+
+def schema_structure(pydantic_schema) -> dict:
+    """returns {main_category: {subcategory: set(detail_categories)}} allowed by the schema"""
+    structure = {}
+    for main_category, main_field in pydantic_schema.model_fields.items():
+        main_model = _nested_model(main_field.annotation)
+        if main_model is None:
+            continue
+        structure[main_category] = {}
+        for subcategory, sub_field in main_model.model_fields.items():
+            sub_model = _nested_model(sub_field.annotation)
+            if sub_model is None:
+                continue
+            structure[main_category][subcategory] = {
+                detail_category
+                for detail_category in sub_model.model_fields
+                if detail_category != NO_OR_OTHER
+            }
+    return structure
+
+
+def _collect_preferences(node, found, dropped):
+    # collects all (detail_category, preferences) wherever they are placed in the output,
+    # a single preference dict under a detail category is taken as a list of one preference.
+    # non-empty preference lists under keys that are no detail category and other non-null values
+    # under a detail category are collected in dropped
+    if not isinstance(node, dict):
+        return
+    hierarchy = load_category_hierarchy()
+    for key, value in node.items():
+        if key in hierarchy:
+            if isinstance(value, list):
+                found.append((key, value))
+            elif isinstance(value, dict) and _clean_preference(value) is not None:
+                found.append((key, [value]))
+            elif value is not None:
+                dropped.append(key)
+        elif isinstance(value, dict):
+            _collect_preferences(value, found, dropped)
+        elif isinstance(value, list) and value:
+            dropped.append(key)
+
+
+def _clean_preference(preference):
+    if not isinstance(preference, dict):
+        return None
+    cleaned = {
+        key: preference.get(key)
+        for key in ("user_sentence_preference_revealed", "user_preference")
+    }
+    if not any(cleaned.values()):
+        return None
+    return cleaned
+
+
+def repair_extraction(extraction_result: dict, pydantic_schema) -> Optional[dict]:
+    """
+    Rebuilds the extraction output along the category hierarchy:
+    detail categories are moved below their correct main- and subcategory, keys that are not in the
+    schema (including detail categories whose subcategory is excluded from the schema) are dropped.
+    Returns the repaired output if it validates against the schema, otherwise None.
+    None is also returned if a non-empty preference list would be dropped, the llm retry then gets the
+    chance to extract the preference in the schema instead of losing it.
+    """
+    if not isinstance(extraction_result, dict):
+        return None
+    hierarchy = load_category_hierarchy()
+    structure = schema_structure(pydantic_schema)
+
+    repaired = {}
+    # keep no_or_other_preferences where it is allowed
+    for main_category, main_value in extraction_result.items():
+        if main_category not in structure or not isinstance(main_value, dict):
+            continue
+        if isinstance(main_value.get(NO_OR_OTHER), str):
+            repaired.setdefault(main_category, {})[NO_OR_OTHER] = main_value[
+                NO_OR_OTHER
+            ]
+        for subcategory, sub_value in main_value.items():
+            if subcategory in structure[main_category] and isinstance(sub_value, dict):
+                if isinstance(sub_value.get(NO_OR_OTHER), str):
+                    repaired.setdefault(main_category, {}).setdefault(subcategory, {})[
+                        NO_OR_OTHER
+                    ] = sub_value[NO_OR_OTHER]
+
+    preferences = []
+    dropped = []
+    _collect_preferences(extraction_result, preferences, dropped)
+    if dropped:
+        return None
+    for detail_category, values in preferences:
+        main_category, subcategory = hierarchy[detail_category]
+        if detail_category not in structure.get(main_category, {}).get(
+            subcategory, set()
+        ):
+            if values:
+                return None
+            continue
+        cleaned = [
+            preference
+            for preference in map(_clean_preference, values)
+            if preference is not None
+        ]
+        if not cleaned:
+            if values:
+                return None
+            continue
+        repaired.setdefault(main_category, {}).setdefault(subcategory, {}).setdefault(
+            detail_category, []
+        ).extend(cleaned)
+
+    try:
+        pydantic_schema(**repaired)
+    except (ValidationError, TypeError):
+        return None
+    return repaired
@@ -0,0 +1,66 @@
+"""
+Incremental parsing of the streamed function call arguments of the extraction chain.
+Most conversations contain no long-term preference, so the extraction stream can be stopped as soon
+as its structure shows that nothing will be extracted instead of awaiting the whole function call.
+"""
+
+STREAM_MODES = ("off", "strict")
+
+
+class FunctionArgumentsStreamParser:
+    """
+    Scans the json arguments fragment by fragment and tracks only the structure (object depth,
+    strings).
+
+    feed() returns True once the stream can be stopped:
+    - the arguments do not start with an object (e.g. 'null'): no preference
+    - the top level object is closed: complete, the arguments are parsed as usual
+    A 'no_or_other_preferences' key does not end the stream: it comes first in every category object
+    (usually null) and preferences of the same or later categories may follow it.
+    The function call of the extraction always starts with an object, so the stream only stops early on
+    malformed arguments and saves almost no tokens.
+    """
+
+    def __init__(self):
+        self.arguments = ""
+        self.stopped_early = False
+        self.done = False
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def _stop_early(self):
+        self.done = True
+        self.stopped_early = True
+
+    def feed(self, fragment: str) -> bool:
+        for char in fragment:
+            if self.done:
+                break
+            self.arguments += char
+            if self._in_string:
+                # braces within strings are no structure
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char.isspace():
+                continue
+            if not self._started:
+                self._started = True
+                if char != "{":
+                    self._stop_early()
+                    break
+            if char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.done = True
+        return self.done
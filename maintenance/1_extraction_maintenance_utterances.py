@@ -30,7 +30,8 @@ from extraction.preference_memory import PreferenceMemory
 from extraction.pydantic_schemas.categories_pydantic import (
     PreferencesFunctionOutput,
 )
-from utils.llm import get_llm_gpt4o
+from utils.checkpoint import RunCheckpoint
+from utils.latency import timer, write_latency_report
 from utils.start_langsmith_tracing import start_langsmith_tracing
 
 
@@ -56,6 +57,12 @@ def parse_args():
         type=str,
         default="extraction_maintenance_utterances_test.jsonl",
     )
+    parser.add_argument(
+        "--resume",
+        type=bool,
+        default=False,
+        help="skip users and conversations that are already in the output file (or its .progress file) of a previous run",
+    )
     return parser.parse_args()
 
 
@@ -66,11 +73,13 @@ async def main():
         start_langsmith_tracing(project_name=args.langsmith_project_name)
 
     os.makedirs(args.output_dir, exist_ok=True)
+    checkpoint = RunCheckpoint(
+        os.path.join(args.output_dir, args.output_file), resume=args.resume
+    )
 
     preference_memory = PreferenceMemory()
 
     extraction_chain = await preference_memory.create_memory_function(
-        llm=get_llm_gpt4o(),
         parameters=PreferencesFunctionOutput,
         target_type="user_state",
         name="extract_user_preferences",
@@ -88,11 +97,20 @@ async def main():
     for idx, line in enumerate(
         track(train_dataset_lines[:-1])
     ):  # one user in for loop, exclude line with overall results
+        if checkpoint.is_completed(line["user_uuid"]):
+            continue
         john_user_id = uuid.UUID(line["user_uuid"])
         john_username = f"john-{john_user_id.hex[:4]}"
 
-        for conversation in tqdm(line["data"]):  # one conversation in for loop
-
+        for conversation_idx, conversation in enumerate(
+            tqdm(line["data"])
+        ):  # one conversation in for loop
+            restored_conversation = checkpoint.conversation_result(
+                line["user_uuid"], conversation_idx
+            )
+            if restored_conversation is not None:
+                line["data"][conversation_idx] = restored_conversation
+                continue
             try:  # only score conversations where extraction is performed
                 conversation_extraction = conversation[
                     "conversation_extracted_preferences"
@@ -189,7 +207,7 @@ async def main():
 
             # perform extraction for negate preference
             preference_negate_dict = {}
-            with get_openai_callback() as cb:
+            with get_openai_callback() as cb, timer("extraction"):
                 output_extraction_maintenance_negate = extraction_chain.invoke(
                     input={"user_name": john_username, "conversation": question_negate}
                 )
@@ -206,11 +224,15 @@ async def main():
             preference_negate_dict.update(
                 {
                     "valid_at_try": valid_at_try,
+                    "repaired_locally": output_extraction_maintenance_negate_retry.additional_kwargs.get(
+                        "repaired_locally", False
+                    ),
                 }
             )
-            if valid_at_try == 1:
+            if valid_at_try == 1 and not preference_negate_dict["repaired_locally"]:
                 pass
-            elif valid_at_try == 2:
+            elif valid_at_try in (1, 2):
+                # invalid first output, repaired locally (try 1) or by the llm retry (try 2)
                 preference_negate_dict.update(
                     {
                         "failed_extraction_1": json.loads(
@@ -319,6 +341,9 @@ async def main():
             conversation["maintenance_questions"][
                 "question_different_extraction"
             ] = preference_different_dict
+            checkpoint.save_conversation(
+                line["user_uuid"], conversation_idx, conversation
+            )
 
         # write line extended with extraction results, filter conversations where no extraction is performed
         filtered_data = filter(
@@ -326,8 +351,12 @@ async def main():
             line["data"],
         )
         line["data"] = list(filtered_data)
-        with open(os.path.join(args.output_dir, args.output_file), "a") as file:
-            file.write(json.dumps(line) + "\n")
+        checkpoint.write_line(line)
+    checkpoint.finish()
+
+    # local_repairs is the number of llm retries saved by the local repair of invalid outputs
+    print(f"Validation retries: {preference_memory.retry_stats}")
+    write_latency_report("1_extraction_maintenance_utterances")
 
 
 if __name__ == "__main__":
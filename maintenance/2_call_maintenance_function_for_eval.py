@@ -2,6 +2,7 @@
 File to call the maintenance functions for each extracted preference from the maintenance utterances.
 """
 
+import asyncio
 import json
 import os
 import sys
@@ -18,12 +19,20 @@ sys.path.append(str(project_root))
 import argparse
 
 from dotenv import load_dotenv
-from pymilvus import MilvusClient
 
 from config.config_loader import config
 from dataset.utils.mapping_detail_category_to_type import detail_category_to_type
+from document_store.preference_categories import (
+    category_filter,
+    decode_categories,
+    encode_categories,
+)
+from document_store.preference_session_cache import invalidate_user
 from maintenance.maintenance_functions import Maintenace
+from utils.checkpoint import RunCheckpoint
 from utils.custom_logger import log_debug
+from utils.latency import write_latency_report
+from utils.milvus_utils import get_async_milvus_client
 from utils.start_langsmith_tracing import start_langsmith_tracing
 
 
@@ -53,21 +62,29 @@ def parse_args():
         default=False,
         help="wether to actually perform the function in the database or just simulate",
     )
+    parser.add_argument(
+        "--resume",
+        type=bool,
+        default=False,
+        help="skip users, conversations and (with --perform_function) preferences that are already in the output file (or its .progress file) of a previous run, so maintenance functions are not performed twice",
+    )
     return parser.parse_args()
 
 
-def main():
+async def main():
     load_dotenv()
     args = parse_args()
     if args.trace_by_langsmith:
         start_langsmith_tracing(project_name=args.langsmith_project_name)
 
-    milvus_client = MilvusClient(
-        uri=f"http://{config.get('database', 'host')}:{config.get('database', 'port')}"
-    )
+    # the database calls of the maintenance run on the milvus I/O threads
+    milvus_client = get_async_milvus_client()
     maintenance = Maintenace()
 
     os.makedirs(args.output_dir, exist_ok=True)
+    checkpoint = RunCheckpoint(
+        os.path.join(args.output_dir, args.output_file), resume=args.resume
+    )
 
     train_dataset_lines = []
     with open(args.extraction_maintenance_result_dir, "r") as file:
@@ -76,7 +93,25 @@ def main():
             train_dataset_lines.append(train_dataset_line)
 
     for line in track(train_dataset_lines):
-        for conversation_data in tqdm(line["data"]):
+        if checkpoint.is_completed(line["user_uuid"]):
+            continue
+        for conversation_idx, conversation_data in enumerate(tqdm(line["data"])):
+            restored_conversation = checkpoint.conversation_result(
+                line["user_uuid"], conversation_idx
+            )
+            if restored_conversation is not None:
+                line["data"][conversation_idx] = restored_conversation
+                continue
+            # with --perform_function every preference is checkpointed after its database write,
+            # a conversation interrupted in between continues after the last written preference
+            first_question_idx = 0
+            restored_step = checkpoint.conversation_step(
+                line["user_uuid"], conversation_idx
+            )
+            if restored_step is not None:
+                conversation_data, last_question_idx = restored_step
+                line["data"][conversation_idx] = conversation_data
+                first_question_idx = last_question_idx + 1
             conversation_extraction = conversation_data[
                 "conversation_extracted_preferences"
             ]
@@ -118,6 +153,8 @@ def main():
 
             dict_list = [preference_equal, preference_negate, preference_different]
             for idx, extracted_preference in enumerate(dict_list):
+                if idx < first_question_idx:
+                    continue
                 eval_preference_dict = {}
                 if idx == 0:
                     question = "equal"
@@ -143,10 +180,16 @@ def main():
                     }
                     print("\nIncoming Preference:\n")
                     print(f"{question}: {extracted_preference_slim}")
-                    expr = f"user_name=='{conversation_data['user_uuid']}' && main_category=='{extracted_preference['main_category']}' && subcategory=='{extracted_preference['subcategory']}' && detail_category=='{extracted_preference['detail_category']}'"
+                    expr = category_filter(
+                        conversation_data["user_uuid"],
+                        main_category=extracted_preference["main_category"],
+                        subcategory=extracted_preference["subcategory"],
+                        detail_category=extracted_preference["detail_category"],
+                    )
 
                     # if existing preferences are empty, make sure you uploaded the extracted preferences to milvus with 'extraction/3_load_extracted_to_database.py' or 'extraction/3_load_extracted_to_database_vctr_dc_attr_text.py'
-                    existing_preferences = milvus_client.query(
+                    # timed as milvus_query by the async client
+                    existing_preferences = await milvus_client.query(
                         collection_name=config.get("database", "collection_name"),
                         filter=expr,
                         output_fields=[
@@ -159,6 +202,10 @@ def main():
                             "user_name",
                         ],
                     )
+                    existing_preferences = [
+                        decode_categories(existing_preference)
+                        for existing_preference in existing_preferences
+                    ]
                     eval_preference_dict.update(
                         {"number_preferences_existing": len(existing_preferences)}
                     )
@@ -167,12 +214,13 @@ def main():
                     print(existing_preferences)
                     if not existing_preferences:
                         if args.perform_function:
-                            milvus_client.insert(
+                            await milvus_client.insert(
                                 collection_name=config.get(
                                     "database", "collection_name"
                                 ),
-                                data=extracted_preference,
+                                data=encode_categories(extracted_preference),
                             )
+                            invalidate_user(extracted_preference.get("user_name"))
                             tool_call = "insert_preference"
 
                     else:
@@ -185,7 +233,7 @@ def main():
                             print("\n Category Type 'MP': performing filter...")
                             with get_openai_callback() as cb:
                                 run_tool_answer, tool_call = (
-                                    maintenance.filter_extracted_preference_mp(
+                                    await maintenance.afilter_extracted_preference_mp(
                                         incoming_preference=extracted_preference,
                                         existing_preferences=existing_preferences,
                                         perform_function=args.perform_function,
@@ -200,7 +248,7 @@ def main():
                             print("\n Category Type 'MNP': performing filter...")
                             with get_openai_callback() as cb:
                                 run_tool_answer, tool_call = (
-                                    maintenance.filter_extracted_preference_mnp(
+                                    await maintenance.afilter_extracted_preference_mnp(
                                         incoming_preference=extracted_preference,
                                         existing_preferences=existing_preferences,
                                         perform_function=args.perform_function,
@@ -220,6 +268,13 @@ def main():
                     preference_negate_dict["evaluation"] = eval_preference_dict
                 elif question == "different":
                     preference_different_dict["evaluation"] = eval_preference_dict
+                if args.perform_function:
+                    checkpoint.save_step(
+                        line["user_uuid"], conversation_idx, idx, conversation_data
+                    )
+            checkpoint.save_conversation(
+                line["user_uuid"], conversation_idx, conversation_data
+            )
 
         # write line extended with extraction results, filter conversations where no extraction is performed
         filtered_data = filter(
@@ -228,9 +283,10 @@ def main():
             line["data"],
         )
         line["data"] = list(filtered_data)
-        with open(os.path.join(args.output_dir, args.output_file), "a") as file:
-            file.write(json.dumps(line) + "\n")
+        checkpoint.write_line(line)
+    checkpoint.finish()
+    write_latency_report("2_call_maintenance_function_for_eval")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -1,15 +1,18 @@
 from typing import Optional, Type
 
-from dotenv import load_dotenv
 from langchain.callbacks.manager import (
+    AsyncCallbackManagerForToolRun,
     CallbackManagerForToolRun,
 )
 from pydantic import BaseModel, Field
 from langchain.tools import BaseTool
-from pymilvus import MilvusClient
 
 from config.config_loader import config
+from document_store.preference_categories import encode_categories
+from document_store.preference_session_cache import invalidate_user
+from utils.latency import timer
 from utils.llm import get_embedding
+from utils.milvus_utils import get_async_milvus_client, get_milvus_client
 
 
 class AppendInput(BaseModel):
@@ -50,14 +53,30 @@ class Append(BaseTool):
         run_manager: Optional[CallbackManagerForToolRun] = True,
     ) -> str:
         if perform_function:
-            load_dotenv()
-            milvus_client = MilvusClient(
-                uri=f"http://{config.get('database', 'host')}:{config.get('database', 'port')}"
-            )
+            milvus_client = get_milvus_client()
             milvus_client.insert(
                 collection_name=config.get("database", "collection_name"),
-                data=incoming_preference,
+                data=encode_categories(incoming_preference),
             )
+            invalidate_user(incoming_preference.get("user_name"))
+
+        return (
+            f"Preference '{incoming_preference['detail_category']}: {incoming_preference['attribute']}' got appended",
+            self.name,
+        )
+
+    async def _arun(
+        self,
+        incoming_preference,
+        perform_function=True,
+        run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ) -> str:
+        if perform_function:
+            await get_async_milvus_client().insert(
+                collection_name=config.get("database", "collection_name"),
+                data=encode_categories(incoming_preference),
+            )
+            invalidate_user(incoming_preference.get("user_name"))
 
         return (
             f"Preference '{incoming_preference['detail_category']}: {incoming_preference['attribute']}' got appended",
@@ -89,21 +108,56 @@ class Pass(BaseTool):
                 )
                 new_joint_preference = incoming_preference.copy()
                 new_joint_preference["text"] = concat_sentences
-                new_joint_preference["vector"] = get_embedding().embed_query(
-                    concat_sentences
-                )
-                load_dotenv()
-                milvus_client = MilvusClient(
-                    uri=f"http://{config.get('database', 'host')}:{config.get('database', 'port')}"
-                )
+                with timer("embedding"):
+                    new_joint_preference["vector"] = get_embedding().embed_query(
+                        concat_sentences
+                    )
+                milvus_client = get_milvus_client()
                 milvus_client.delete(
                     collection_name=config.get("database", "collection_name"),
                     pks=pk_of_equal_existing_preference,
                 )
                 milvus_client.insert(
                     collection_name=config.get("database", "collection_name"),
-                    data=new_joint_preference,
+                    data=encode_categories(new_joint_preference),
                 )
+                invalidate_user(incoming_preference.get("user_name"))
+        return (
+            f"Preference '{incoming_preference['detail_category']}: {incoming_preference['attribute']}' got passed",
+            self.name,
+        )
+
+    async def _arun(
+        self,
+        incoming_preference,
+        pk_of_equal_existing_preference=None,
+        equal_existing_preference=None,
+        perform_function=True,
+        run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ) -> str:
+        if perform_function:
+            if pk_of_equal_existing_preference and equal_existing_preference:
+                concat_sentences = (
+                    incoming_preference["text"]
+                    + "\n"
+                    + equal_existing_preference["text"]
+                )
+                new_joint_preference = incoming_preference.copy()
+                new_joint_preference["text"] = concat_sentences
+                with timer("embedding"):
+                    new_joint_preference["vector"] = await get_embedding().aembed_query(
+                        concat_sentences
+                    )
+                milvus_client = get_async_milvus_client()
+                await milvus_client.delete(
+                    collection_name=config.get("database", "collection_name"),
+                    pks=pk_of_equal_existing_preference,
+                )
+                await milvus_client.insert(
+                    collection_name=config.get("database", "collection_name"),
+                    data=encode_categories(new_joint_preference),
+                )
+                invalidate_user(incoming_preference.get("user_name"))
         return (
             f"Preference '{incoming_preference['detail_category']}: {incoming_preference['attribute']}' got passed",
             self.name,
@@ -126,18 +180,40 @@ class Update(BaseTool):
         run_manager: Optional[CallbackManagerForToolRun] = None,
     ) -> str:
         if perform_function:
-            load_dotenv()
-            milvus_client = MilvusClient(
-                uri=f"http://{config.get('database', 'host')}:{config.get('database', 'port')}"
-            )
+            milvus_client = get_milvus_client()
             milvus_client.delete(
                 collection_name=config.get("database", "collection_name"),
                 pks=pk_to_delete_existing_preference,
             )
             milvus_client.insert(
                 collection_name=config.get("database", "collection_name"),
-                data=incoming_preference,
+                data=encode_categories(incoming_preference),
+            )
+            invalidate_user(incoming_preference.get("user_name"))
+        return (
+            f"Preference '{to_delete_existing_preference['detail_category']}: {to_delete_existing_preference['attribute']}' got updated to '{incoming_preference['detail_category']}: {incoming_preference['attribute']}'",
+            self.name,
+        )
+
+    async def _arun(
+        self,
+        incoming_preference,
+        pk_to_delete_existing_preference,
+        to_delete_existing_preference,
+        perform_function=True,
+        run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ) -> str:
+        if perform_function:
+            milvus_client = get_async_milvus_client()
+            await milvus_client.delete(
+                collection_name=config.get("database", "collection_name"),
+                pks=pk_to_delete_existing_preference,
+            )
+            await milvus_client.insert(
+                collection_name=config.get("database", "collection_name"),
+                data=encode_categories(incoming_preference),
             )
+            invalidate_user(incoming_preference.get("user_name"))
         return (
             f"Preference '{to_delete_existing_preference['detail_category']}: {to_delete_existing_preference['attribute']}' got updated to '{incoming_preference['detail_category']}: {incoming_preference['attribute']}'",
             self.name,
@@ -14,6 +14,7 @@ from langchain_core.utils.function_calling import convert_to_openai_function
 
 from maintenance.maintenance_function_calling import Append, Pass, Update
 from utils.custom_logger import log_info, log_warning
+from utils.latency import timed, timer
 from utils.llm import get_llm_gpt4o
 
 MAINTENANCE_PROMPT_MP = ChatPromptTemplate.from_messages(
@@ -112,6 +113,7 @@ class Maintenace:
             temperature=0.0
         ).bind_tools(self.functions_p_u)
 
+    @timed("maintenance_tool")
     def run_tool(self, tool_name, args, perform_function=True):
         if tool_name == "append_preference":
             append_function = Append()
@@ -178,17 +180,45 @@ class Maintenace:
 
         return run_tool_answer, tool_call
 
-    def filter_extracted_preference_mp(
-        self, incoming_preference, existing_preferences, perform_function=True
-    ):
-        """
-        performs one of the functions pass, update, append based on similar stored preferences and the new incoming preference.
-        the new incoming preference should be from a mp (multiple possible) category
-        params:
-        incoming_preference: the currently extracted preference which should be inserted to the storage
-        existing_preferences: the existing preferences within the detail_category.
-        perform_function: if the function should actually be performed in the database or only simulated
-        """
+    @timed("maintenance_tool")
+    async def arun_tool(self, tool_name, args, perform_function=True):
+        """run_tool for async callers, the database calls run on the milvus I/O threads"""
+        if tool_name == "append_preference":
+            return await Append()._arun(
+                self.incoming_preference, perform_function=perform_function
+            )
+
+        # args is None if the llm called no tool and the preference is passed by default
+        args = args or {}
+        if tool_name == "pass_preference":
+            pk = args.get("pk_of_equal_existing_preference")
+        elif tool_name == "update_preference":
+            pk = args.get("pk_of_to_delete_existing_preference")
+        else:
+            pk = None
+        matching_dict = next(
+            (item for item in self.exisiting_preferences if item.get("pk") == pk),
+            None,
+        )
+        if not matching_dict:
+            log_warning(f"pk generated by llm does not match existing preferences key")
+            return await Pass()._arun(self.incoming_preference, perform_function=False)
+        if tool_name == "pass_preference":
+            return await Pass()._arun(
+                self.incoming_preference,
+                pk_of_equal_existing_preference=pk,
+                equal_existing_preference=matching_dict,
+                perform_function=perform_function,
+            )
+        return await Update()._arun(
+            incoming_preference=self.incoming_preference,
+            pk_to_delete_existing_preference=pk,
+            to_delete_existing_preference=matching_dict,
+            perform_function=perform_function,
+        )
+
+    def _prompt_input(self, incoming_preference, existing_preferences):
+        # the prompt sees the detail category, text and attribute (and pk of the existing preferences)
         self.incoming_preference = incoming_preference
         self.exisiting_preferences = existing_preferences
         keys_to_include_incoming_preference = ["detail_category", "text", "attribute"]
@@ -212,28 +242,30 @@ class Maintenace:
                 if key in existing_preference
             }
             existing_preferences_prompt_input.append(existing_preference_prompt_input)
+        return {
+            "incoming_preference": incoming_preference_prompt_input,
+            "existing_preferences": existing_preference_prompt_input,
+        }
+
+    @staticmethod
+    def _tool_call(result):
+        # raises KeyError if the llm did not call a tool
+        tool_call = result.additional_kwargs["tool_calls"][0]
+        return tool_call["function"]["name"], json.loads(
+            tool_call["function"]["arguments"]
+        )
+
+    def _filter(self, chain, chain_retry, prompt_input, perform_function):
         try:
-            result = self.maintenance_chain_mp.invoke(
-                input={
-                    "incoming_preference": incoming_preference_prompt_input,
-                    "existing_preferences": existing_preference_prompt_input,
-                }
-            )
-            tool_call = result.additional_kwargs["tool_calls"][0]
-            tool_name = tool_call["function"]["name"]
-            tool_args = json.loads(tool_call["function"]["arguments"])
+            with timer("maintenance_llm"):
+                result = chain.invoke(input=prompt_input)
+            tool_name, tool_args = self._tool_call(result)
         except KeyError:
             try:
                 log_info(f"In the first call no tool was called. Retrying now.")
-                result = self.maintenance_chain_retry_mp.invoke(
-                    input={
-                        "incoming_preference": incoming_preference_prompt_input,
-                        "existing_preferences": existing_preference_prompt_input,
-                    }
-                )
-                tool_call = result.additional_kwargs["tool_calls"][0]
-                tool_name = tool_call["function"]["name"]
-                tool_args = json.loads(tool_call["function"]["arguments"])
+                with timer("maintenance_llm"):
+                    result = chain_retry.invoke(input=prompt_input)
+                tool_name, tool_args = self._tool_call(result)
             except KeyError:
                 log_info(
                     f"The second call did not call a tool again. Passing the preference as default."
@@ -248,62 +280,17 @@ class Maintenace:
         log_info(f"{run_tool_answer}")
         return run_tool_answer, tool_call
 
-    def filter_extracted_preference_mnp(
-        self, incoming_preference, existing_preferences, perform_function=True
-    ):
-        """
-        performs one of the functions pass, update, or (if category empty) append based on similar stored preferences and the new incoming preference.
-        the new incoming preference should be from a mnp (multiple not possible) category
-        params:
-        incoming_preference: the currently extracted preference which should be inserted to the storage
-        existing_preferences: the existing preferences within the detail_category.
-        perform_function: if the function should actually be performed in the database or only simulated
-        """
-        self.incoming_preference = incoming_preference
-        self.exisiting_preferences = existing_preferences
-        keys_to_include_incoming_preference = ["detail_category", "text", "attribute"]
-        incoming_preference_prompt_input = {
-            key: incoming_preference[key]
-            for key in keys_to_include_incoming_preference
-            if key in incoming_preference
-        }
-
-        existing_preferences_prompt_input = []
-        keys_to_include_existing_preferences = [
-            "pk",
-            "detail_category",
-            "text",
-            "attribute",
-        ]
-        for existing_preference in existing_preferences:
-            existing_preference_prompt_input = {
-                key: existing_preference[key]
-                for key in keys_to_include_existing_preferences
-                if key in existing_preference
-            }
-            existing_preferences_prompt_input.append(existing_preference_prompt_input)
+    async def _afilter(self, chain, chain_retry, prompt_input, perform_function):
         try:
-            result = self.maintenance_chain_mnp.invoke(
-                input={
-                    "incoming_preference": incoming_preference_prompt_input,
-                    "existing_preferences": existing_preference_prompt_input,
-                }
-            )
-            tool_call = result.additional_kwargs["tool_calls"][0]
-            tool_name = tool_call["function"]["name"]
-            tool_args = json.loads(tool_call["function"]["arguments"])
+            with timer("maintenance_llm"):
+                result = await chain.ainvoke(input=prompt_input)
+            tool_name, tool_args = self._tool_call(result)
         except KeyError:
             try:
                 log_info(f"In the first call no tool was called. Retrying now.")
-                result = self.maintenance_chain_retry_mnp.invoke(
-                    input={
-                        "incoming_preference": incoming_preference_prompt_input,
-                        "existing_preferences": existing_preference_prompt_input,
-                    }
-                )
-                tool_call = result.additional_kwargs["tool_calls"][0]
-                tool_name = tool_call["function"]["name"]
-                tool_args = json.loads(tool_call["function"]["arguments"])
+                with timer("maintenance_llm"):
+                    result = await chain_retry.ainvoke(input=prompt_input)
+                tool_name, tool_args = self._tool_call(result)
             except KeyError:
                 log_info(
                     f"The second call did not call a tool again. Passing the preference as default."
@@ -311,10 +298,67 @@ class Maintenace:
                 tool_name = "pass_preference"
                 tool_args = None
 
-        run_tool_answer, tool_call = self.run_tool(
+        run_tool_answer, tool_call = await self.arun_tool(
             tool_name=tool_name, args=tool_args, perform_function=perform_function
         )
         print(run_tool_answer)
         log_info(f"{run_tool_answer}")
-
         return run_tool_answer, tool_call
+
+    def filter_extracted_preference_mp(
+        self, incoming_preference, existing_preferences, perform_function=True
+    ):
+        """
+        performs one of the functions pass, update, append based on similar stored preferences and the new incoming preference.
+        the new incoming preference should be from a mp (multiple possible) category
+        params:
+        incoming_preference: the currently extracted preference which should be inserted to the storage
+        existing_preferences: the existing preferences within the detail_category.
+        perform_function: if the function should actually be performed in the database or only simulated
+        """
+        return self._filter(
+            self.maintenance_chain_mp,
+            self.maintenance_chain_retry_mp,
+            self._prompt_input(incoming_preference, existing_preferences),
+            perform_function,
+        )
+
+    async def afilter_extracted_preference_mp(
+        self, incoming_preference, existing_preferences, perform_function=True
+    ):
+        """async version of filter_extracted_preference_mp, the database calls run on the milvus I/O threads"""
+        return await self._afilter(
+            self.maintenance_chain_mp,
+            self.maintenance_chain_retry_mp,
+            self._prompt_input(incoming_preference, existing_preferences),
+            perform_function,
+        )
+
+    def filter_extracted_preference_mnp(
+        self, incoming_preference, existing_preferences, perform_function=True
+    ):
+        """
+        performs one of the functions pass, update, or (if category empty) append based on similar stored preferences and the new incoming preference.
+        the new incoming preference should be from a mnp (multiple not possible) category
+        params:
+        incoming_preference: the currently extracted preference which should be inserted to the storage
+        existing_preferences: the existing preferences within the detail_category.
+        perform_function: if the function should actually be performed in the database or only simulated
+        """
+        return self._filter(
+            self.maintenance_chain_mnp,
+            self.maintenance_chain_retry_mnp,
+            self._prompt_input(incoming_preference, existing_preferences),
+            perform_function,
+        )
+
+    async def afilter_extracted_preference_mnp(
+        self, incoming_preference, existing_preferences, perform_function=True
+    ):
+        """async version of filter_extracted_preference_mnp, the database calls run on the milvus I/O threads"""
+        return await self._afilter(
+            self.maintenance_chain_mnp,
+            self.maintenance_chain_retry_mnp,
+            self._prompt_input(incoming_preference, existing_preferences),
+            perform_function,
+        )
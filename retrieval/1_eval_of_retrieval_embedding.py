@@ -6,23 +6,47 @@ import argparse
 import json
 import os
 import sys
-import time
 from pathlib import Path
 
+import numpy as np
+
 # Add the project root to the sys.path
 project_root = Path(__file__).parent.parent
 sys.path.append(str(project_root))
 
 from dotenv import load_dotenv
-from pymilvus import MilvusClient
 
 from config.config_loader import config
+from document_store.milvus2_preference_store import get_search_params
+from document_store.preference_categories import (
+    CategoryHistogramCache,
+    decode_categories,
+)
+from document_store.preference_lexical_index import reciprocal_rank_fusion
+from document_store.preference_session_cache import PreferenceSessionCache
 from extraction.mapping_category_to_pyd_category import category_to_pyd_category
+from utils.latency import timer, write_latency_report
 from utils.llm import get_embedding
+from utils.milvus_utils import get_milvus_client
+from utils.ranking_metrics import ranking_metrics, relevance_matrix
 from utils.start_langsmith_tracing import start_langsmith_tracing
 
 # import tikzplotlib
 
+# scalar fields of the retrieved preferences written to the evaluation file, the vectors are not needed
+RETRIEVAL_OUTPUT_FIELDS = [
+    "main_category",
+    "subcategory",
+    "detail_category",
+    "attribute",
+    "text",
+    "user_name",
+]
+
+RETRIEVAL_LIMIT = 10
+# cutoffs relative to the number of preferences of the same subcategory (ssc): top-ssc, top-(ssc + 1), top-(ssc + 2)
+SSC_OFFSETS = {"": 0, "_p1": 1, "_p2": 2}
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -66,9 +90,144 @@ def parse_args():
     parser.add_argument(
         "--collection_name_text", type=str, default="user_preferences_vctr_text"
     )
+    parser.add_argument(
+        "--session_cache",
+        type=bool,
+        default=False,
+        help="load the preferences of a user once and score the questions in memory instead of one milvus search per question",
+    )
+    parser.add_argument(
+        "--batched",
+        type=bool,
+        default=False,
+        help="embed all questions with one request and search the questions of a user with one multi-vector search",
+    )
+    parser.add_argument(
+        "--retrieval_mode",
+        type=str,
+        default="vector",
+        choices=["vector", "lexical", "hybrid"],
+        help="vector search, bm25 over text, attribute and detail_category without embedding (uses the session cache), or both fused by reciprocal rank fusion",
+    )
     return parser.parse_args()
 
 
+def score_retrievals(evaluations):
+    """
+    scores the retrieved preferences of the questions at the cutoffs top-(ssc + offset) and top-RETRIEVAL_LIMIT in one pass.
+    returns the ranking metrics of the preferences of the same subcategory and of the ground truth preference
+    (the preference loaded from the conversation, pk = conversation uuid)
+    """
+    retrieved = [evaluation["retrieved_preferences"] for evaluation in evaluations]
+    same_subcategory = relevance_matrix(
+        retrieved,
+        lambda row, preference: preference["entity"].get("subcategory")
+        == evaluations[row]["subcategory"],
+    )
+    ground_truth = relevance_matrix(
+        retrieved,
+        lambda row, preference: preference["id"]
+        == evaluations[row]["conversation_uuid"],
+    )
+    cutoffs = np.asarray(
+        [
+            [
+                *(
+                    evaluation["number_same_subcategory_preferences"] + offset
+                    for offset in SSC_OFFSETS.values()
+                ),
+                RETRIEVAL_LIMIT,
+            ]
+            for evaluation in evaluations
+        ],
+        dtype=int,
+    ).reshape(len(evaluations), len(SSC_OFFSETS) + 1)
+    return (
+        ranking_metrics(
+            same_subcategory,
+            cutoffs,
+            num_relevant=[
+                evaluation["number_same_subcategory_preferences"]
+                for evaluation in evaluations
+            ],
+        ),
+        ranking_metrics(ground_truth, cutoffs, num_relevant=[1] * len(evaluations)),
+    )
+
+
+def batched_search(
+    milvus_client,
+    collection_name,
+    lines,
+    search_params,
+    session_cache=None,
+    embedding=None,
+):
+    """
+    embeds the questions of all evaluated conversations with one embed_documents call and searches the
+    questions of each user with one multi-vector search (the filter of a search applies to all its vectors).
+    returns {conversation_uuid: (question embedding, retrieved preferences)}
+    """
+    questions = []
+    for line in lines:
+        for conversation in line["data"]:
+            # same selection as the evaluation loop
+            try:
+                if not (
+                    conversation["conversation_extracted_preferences"]["evaluation"][
+                        "conv_detail_accuracy"
+                    ]
+                    == 1.0
+                ):
+                    continue
+            except KeyError:
+                break
+            questions.append(
+                (
+                    line["user_uuid"],
+                    conversation["conversation_uuid"],
+                    conversation["next_conversation_question"],
+                )
+            )
+    embedding = embedding or get_embedding()
+    with timer("embedding"):
+        embeddings = embedding.embed_documents([question for *_, question in questions])
+
+    questions_by_user = {}
+    for (user_id, conversation_uuid, _), question_embedding in zip(
+        questions, embeddings
+    ):
+        questions_by_user.setdefault(user_id, []).append(
+            (conversation_uuid, question_embedding)
+        )
+    results = {}
+    for user_id, user_questions in questions_by_user.items():
+        vectors = [question_embedding for _, question_embedding in user_questions]
+        if session_cache is not None:
+            retrieved = [
+                session_cache.search(user_id, vector, limit=RETRIEVAL_LIMIT)
+                for vector in vectors
+            ]
+        else:
+            with timer("milvus_search"):
+                retrieved = milvus_client.search(
+                    collection_name=collection_name,
+                    data=vectors,
+                    filter=f"user_name=='{user_id}'",
+                    limit=RETRIEVAL_LIMIT,
+                    search_params=search_params,
+                    output_fields=RETRIEVAL_OUTPUT_FIELDS,
+                )
+            for hits in retrieved:
+                for hit in hits:
+                    hit["entity"] = decode_categories(hit["entity"])
+        for (conversation_uuid, question_embedding), hits in zip(
+            user_questions, retrieved
+        ):
+            results[conversation_uuid] = (question_embedding, list(hits))
+    return results
+
+
 def main():
 
     args = parse_args()
@@ -84,10 +243,25 @@ def main():
 
     os.makedirs(args.output_dir, exist_ok=True)
     load_dotenv()
-    milvus_client = MilvusClient(
-        uri=f"http://{config.get('database', 'host')}:{config.get('database', 'port')}"
+    milvus_client = get_milvus_client()
+    # search params matching the index of the collection (see Milvus2PreferenceStore.adapt_index)
+    search_params = get_search_params(
+        milvus_client, args.collection_name, limit=RETRIEVAL_LIMIT
+    )
+    # number of preferences per subcategory, queried once per user
+    subcategory_histograms = CategoryHistogramCache(
+        milvus_client, args.collection_name, category="subcategory"
+    )
+    # the lexical index is built on the preferences loaded by the session cache
+    session_cache = (
+        PreferenceSessionCache(milvus_client, args.collection_name)
+        if args.session_cache or args.retrieval_mode != "vector"
+        else None
     )
 
+    # created once, the embedding timer measures the requests and not the client construction
+    embedding = get_embedding()
+
     # read out train dataset
     extraction_for_eval_lines = []
     with open(args.extraction_result_dir, "r") as file:
@@ -95,18 +269,28 @@ def main():
             extraction_for_eval_line = json.loads(line.strip())
             extraction_for_eval_lines.append(extraction_for_eval_line)
 
-    all_ground_truth_preference_retrieved_top_ssc = []
-    all_ground_truth_preference_retrieved_top_ssc_p1 = []
-    all_ground_truth_preference_retrieved_top_ssc_p2 = []
+    batched_results = None
+    if args.batched and args.retrieval_mode != "lexical":
+        with timer("batched_retrieval"):
+            batched_results = batched_search(
+                milvus_client,
+                args.collection_name,
+                extraction_for_eval_lines[:-1],
+                search_params,
+                session_cache=session_cache,
+                embedding=embedding,
+            )
+        print(f"Embedded and searched {len(batched_results)} questions")
+
+    all_ground_truth_preference_retrieved = {suffix: [] for suffix in SSC_OFFSETS}
+    total_ratio_relevant = {suffix: [] for suffix in SSC_OFFSETS}
+    all_reciprocal_ranks = []
     total_number_same_subcategory_preferences = 0
     total_number_questions = 0
-    total_ratio_relevant_ssc = []
-    total_ratio_relevant_ssc_p1 = []
-    total_ratio_relevant_ssc_p2 = []
     for line in extraction_for_eval_lines[:-1]:  # last line is the evaluation scores
         user_id = line["user_uuid"]
+        line_evaluations = []
         for conversation in line["data"]:
-            start_time = time.time()
             try:  # only score conversations where extraction is performed
                 conversation_extraction = conversation[
                     "conversation_extracted_preferences"
@@ -127,164 +311,155 @@ def main():
                 input_string=subcategory, category="subcategory"
             )
             # get number of preference for same subcategory
-            same_subcategory_preferences = milvus_client.query(
-                collection_name=args.collection_name,
-                filter=f"user_name=='{user_id}' && subcategory=='{subcategory_pyd}'",
+            number_same_subcategory_preferences = subcategory_histograms.count(
+                user_id, subcategory_pyd
             )
-            number_same_subcategory_preferences = len(same_subcategory_preferences)
             total_number_same_subcategory_preferences += (
                 number_same_subcategory_preferences
             )
             next_conversation_question = conversation["next_conversation_question"]
-            next_conversation_question_embedding = get_embedding().embed_query(
-                next_conversation_question
-            )
-            medium_time = time.time()
-            embedding_time = medium_time - start_time
-            print(embedding_time)
-            retrieved_preferences = milvus_client.search(
-                collection_name=args.collection_name,
-                data=[next_conversation_question_embedding],
-                filter=f"user_name=='{user_id}'",
-                limit=10,
-                search_params={"params": {"level": 3}},
-                output_fields=["*"],
-            )
+            if args.retrieval_mode == "lexical":
+                retrieved_preferences = [
+                    session_cache.lexical_search(
+                        user_id, next_conversation_question, limit=RETRIEVAL_LIMIT
+                    )
+                ]
+            elif batched_results is not None:
+                # embedded and searched up front, see batched_search
+                next_conversation_question_embedding, retrieved_hits = batched_results[
+                    conversation_uuid
+                ]
+                retrieved_preferences = [retrieved_hits]
+            else:
+                with timer("embedding"):
+                    next_conversation_question_embedding = embedding.embed_query(
+                        next_conversation_question
+                    )
+                if session_cache is not None:
+                    # exact in-memory search, the categories are decoded on load
+                    retrieved_preferences = [
+                        session_cache.search(
+                            user_id,
+                            next_conversation_question_embedding,
+                            limit=RETRIEVAL_LIMIT,
+                        )
+                    ]
+                else:
+                    with timer("milvus_search"):
+                        retrieved_preferences = milvus_client.search(
+                            collection_name=args.collection_name,
+                            data=[next_conversation_question_embedding],
+                            filter=f"user_name=='{user_id}'",
+                            limit=RETRIEVAL_LIMIT,
+                            search_params=search_params,
+                            output_fields=RETRIEVAL_OUTPUT_FIELDS,
+                        )
+                    for retrieved_preference in retrieved_preferences[0]:
+                        retrieved_preference["entity"] = decode_categories(
+                            retrieved_preference["entity"]
+                        )
+            if args.retrieval_mode == "hybrid":
+                retrieved_preferences = [
+                    reciprocal_rank_fusion(
+                        session_cache.lexical_search(
+                            user_id, next_conversation_question, limit=RETRIEVAL_LIMIT
+                        ),
+                        retrieved_preferences[0],
+                        limit=RETRIEVAL_LIMIT,
+                    )
+                ]
             retrieved_ids = [
                 retrieved_preference["id"]
                 for retrieved_preference in retrieved_preferences[0]
             ]
 
-            ratio_relevant_irrelevant_ssc = [0, 0, 0]
-            # top-(number_same_subcategory)
-            ground_truth_preference_retrieved_top_ssc = False
-            for id, preference in zip(
-                retrieved_ids[:number_same_subcategory_preferences],
-                retrieved_preferences[0],
-            ):
-                if preference["entity"]["subcategory"] == subcategory_pyd:
-                    ratio_relevant_irrelevant_ssc[0] += 1
-                else:
-                    ratio_relevant_irrelevant_ssc[1] += 1
-
-                if id == conversation_uuid:
-                    ground_truth_preference_retrieved_top_ssc = True
-
-            ratio_relevant_irrelevant_ssc[2] = (
-                ratio_relevant_irrelevant_ssc[0] / number_same_subcategory_preferences
-            )
-            total_ratio_relevant_ssc.append(ratio_relevant_irrelevant_ssc[2])
-            all_ground_truth_preference_retrieved_top_ssc.append(
-                ground_truth_preference_retrieved_top_ssc
-            )
-
-            # top-(number_same_subcategory + 1)
-            ratio_relevant_irrelevant_ssc_p1 = [0, 0, 0]
-            ground_truth_preference_retrieved_top_ssc_p1 = False
-            for id, preference in zip(
-                retrieved_ids[: number_same_subcategory_preferences + 1],
-                retrieved_preferences[0],
-            ):
-                if preference["entity"]["subcategory"] == subcategory_pyd:
-                    ratio_relevant_irrelevant_ssc_p1[0] += 1
-                else:
-                    ratio_relevant_irrelevant_ssc_p1[1] += 1
-
-                if id == conversation_uuid:
-                    ground_truth_preference_retrieved_top_ssc_p1 = True
-
-            ratio_relevant_irrelevant_ssc[2] = ratio_relevant_irrelevant_ssc_p1[0] / (
-                number_same_subcategory_preferences + 1
-            )
-            total_ratio_relevant_ssc_p1.append(ratio_relevant_irrelevant_ssc[2])
-            all_ground_truth_preference_retrieved_top_ssc_p1.append(
-                ground_truth_preference_retrieved_top_ssc_p1
+            line_evaluations.append(
+                {
+                    "conversation": conversation,
+                    "conversation_uuid": conversation_uuid,
+                    "subcategory": subcategory_pyd,
+                    "number_same_subcategory_preferences": number_same_subcategory_preferences,
+                    "retrieved_ids": retrieved_ids,
+                    "retrieved_preferences": retrieved_preferences[0],
+                }
             )
-
-            # top-(number_same_subcategory + 2)
-            ratio_relevant_irrelevant_ssc_p2 = [0, 0, 0]
-            ground_truth_preference_retrieved_top_ssc_p2 = False
-            for id, preference in zip(
-                retrieved_ids[: number_same_subcategory_preferences + 2],
-                retrieved_preferences[0],
-            ):
-                if preference["entity"]["subcategory"] == subcategory_pyd:
-                    ratio_relevant_irrelevant_ssc_p2[0] += 1
-                else:
-                    ratio_relevant_irrelevant_ssc_p2[1] += 1
-
-                if id == conversation_uuid:
-                    ground_truth_preference_retrieved_top_ssc_p2 = True
-
-            ratio_relevant_irrelevant_ssc[2] = ratio_relevant_irrelevant_ssc_p2[0] / (
-                number_same_subcategory_preferences + 2
-            )
-            total_ratio_relevant_ssc_p2.append(ratio_relevant_irrelevant_ssc[2])
-            all_ground_truth_preference_retrieved_top_ssc_p2.append(
-                ground_truth_preference_retrieved_top_ssc_p2
-            )
-            # remove vectors
-            for item in retrieved_preferences[0]:
-                item["entity"]["vector"] = None
-            conversation["evaluation_next_conversation_question_embedding"] = {
-                # "next_conversation_question_embedding": next_conversation_question_embedding,
-                "number_same_subcategory_preferences": number_same_subcategory_preferences,
-                "retrieved_ids": retrieved_ids,
-                "retrieved_preferences_top_ssc_p2": retrieved_preferences[0][
-                    : number_same_subcategory_preferences + 2
-                ],
-                "ground_truth_preference_retrieved_top_ssc": ground_truth_preference_retrieved_top_ssc,
-                "ratio_relevant_irrelevant_ssc": ratio_relevant_irrelevant_ssc[2],
-                "ground_truth_preference_retrieved_top_ssc_p1": ground_truth_preference_retrieved_top_ssc_p1,
-                "ratio_relevant_irrelevant_ssc_p1": ratio_relevant_irrelevant_ssc_p1[2],
-                "ground_truth_preference_retrieved_top_ssc_p2": ground_truth_preference_retrieved_top_ssc_p2,
-                "ratio_relevant_irrelevant_ssc_p2": ratio_relevant_irrelevant_ssc_p2[2],
-            }
             total_number_questions += 1
 
-            end_time = time.time()
-            latency = end_time - start_time
-            print(latency)
+        if line_evaluations:
+            subcategory_metrics, ground_truth_metrics = score_retrievals(
+                line_evaluations
+            )
+            for row, evaluation in enumerate(line_evaluations):
+                number_same_subcategory_preferences = evaluation[
+                    "number_same_subcategory_preferences"
+                ]
+                conversation_evaluation = {
+                    "number_same_subcategory_preferences": number_same_subcategory_preferences,
+                    "retrieved_ids": evaluation["retrieved_ids"],
+                    "retrieved_preferences_top_ssc_p2": evaluation[
+                        "retrieved_preferences"
+                    ][: number_same_subcategory_preferences + 2],
+                }
+                for column, suffix in enumerate(SSC_OFFSETS):
+                    ground_truth_retrieved = bool(
+                        ground_truth_metrics["hit"][row, column]
+                    )
+                    ratio_relevant = float(
+                        subcategory_metrics["precision"][row, column]
+                    )
+                    conversation_evaluation[
+                        f"ground_truth_preference_retrieved_top_ssc{suffix}"
+                    ] = ground_truth_retrieved
+                    conversation_evaluation[
+                        f"ratio_relevant_irrelevant_ssc{suffix}"
+                    ] = ratio_relevant
+                    all_ground_truth_preference_retrieved[suffix].append(
+                        ground_truth_retrieved
+                    )
+                    total_ratio_relevant[suffix].append(ratio_relevant)
+                reciprocal_rank = float(
+                    ground_truth_metrics["reciprocal_rank"][row, -1]
+                )
+                conversation_evaluation["reciprocal_rank_ground_truth_preference"] = (
+                    reciprocal_rank
+                )
+                all_reciprocal_ranks.append(reciprocal_rank)
+                evaluation["conversation"][
+                    "evaluation_next_conversation_question_embedding"
+                ] = conversation_evaluation
 
+        if session_cache is not None:
+            session_cache.end_session(user_id)
         if args.write_to_file:
             # write line extended with extraction results
             with open(os.path.join(args.output_dir, args.output_file), "a") as file:
                 file.write(json.dumps(line) + "\n")
 
     # aggregate evaluations
-    accuracy_ground_truth_preference_retrieved_top_ssc = sum(
-        all_ground_truth_preference_retrieved_top_ssc
-    ) / len(all_ground_truth_preference_retrieved_top_ssc)
-    accuracy_ground_truth_preference_retrieved_top_ssc_p1 = sum(
-        all_ground_truth_preference_retrieved_top_ssc_p1
-    ) / len(all_ground_truth_preference_retrieved_top_ssc_p1)
-    accuracy_ground_truth_preference_retrieved_top_ssc_p2 = sum(
-        all_ground_truth_preference_retrieved_top_ssc_p2
-    ) / len(all_ground_truth_preference_retrieved_top_ssc_p2)
-    mean_ratio_relevant_ssc = sum(total_ratio_relevant_ssc) / len(
-        total_ratio_relevant_ssc
-    )
-    mean_ratio_relevant_ssc_p1 = sum(total_ratio_relevant_ssc_p1) / len(
-        total_ratio_relevant_ssc_p1
+    all_evaluation_scores = {}
+    for suffix in SSC_OFFSETS:
+        all_evaluation_scores[
+            f"accuracy_ground_truth_preference_retrieved_top_ssc{suffix}"
+        ] = float(np.mean(all_ground_truth_preference_retrieved[suffix]))
+    all_evaluation_scores.update(
+        {
+            "mean_number_same_subcategory_preferences": total_number_same_subcategory_preferences
+            / total_number_questions,
+            "mean_questions_per_user": total_number_questions
+            / len(extraction_for_eval_lines),
+        }
     )
-    mean_ratio_relevant_ssc_p2 = sum(total_ratio_relevant_ssc_p2) / len(
-        total_ratio_relevant_ssc_p2
+    for suffix in SSC_OFFSETS:
+        all_evaluation_scores[f"mean_ratio_relevant_ssc{suffix}"] = float(
+            np.mean(total_ratio_relevant[suffix])
+        )
+    all_evaluation_scores[f"mrr_ground_truth_preference@{RETRIEVAL_LIMIT}"] = float(
+        np.mean(all_reciprocal_ranks)
     )
-    all_evaluation_scores = {
-        "accuracy_ground_truth_preference_retrieved_top_ssc": accuracy_ground_truth_preference_retrieved_top_ssc,
-        "accuracy_ground_truth_preference_retrieved_top_ssc_p1": accuracy_ground_truth_preference_retrieved_top_ssc_p1,
-        "accuracy_ground_truth_preference_retrieved_top_ssc_p2": accuracy_ground_truth_preference_retrieved_top_ssc_p2,
-        "mean_number_same_subcategory_preferences": total_number_same_subcategory_preferences
-        / total_number_questions,
-        "mean_questions_per_user": total_number_questions
-        / len(extraction_for_eval_lines),
-        "mean_ratio_relevant_ssc": mean_ratio_relevant_ssc,
-        "mean_ratio_relevant_ssc_p1": mean_ratio_relevant_ssc_p1,
-        "mean_ratio_relevant_ssc_p2": mean_ratio_relevant_ssc_p2,
-    }
     if args.write_to_file:
         with open(os.path.join(args.output_dir, args.output_file), "a") as file:
             file.write(json.dumps(all_evaluation_scores) + "\n")
+    write_latency_report("1_eval_of_retrieval_embedding")
 
 
 if __name__ == "__main__":
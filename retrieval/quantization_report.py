@@ -0,0 +1,298 @@
+"""
+File to compare the quantization modes of the preference vectors on the retrieval evaluation set.
+The retrieval questions (next_conversation_question) are searched within the preferences of their user and
+for every mode the memory per vector, recall@k against the float32 exact search and hit@k of the
+ground truth preference (the preference loaded from the conversation of the question) are reported.
+The float16 and binary modes of the numpy backend are computed in memory from the loaded float32 vectors,
+with --milvus_indexes the IVF_SQ8 and IVF_PQ indexes are built on the collection (server backend only)
+and the original index is restored at the end.
+"""
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# Add the project root to the sys.path
+project_root = Path(__file__).parent.parent
+sys.path.append(str(project_root))
+
+from dotenv import load_dotenv
+from pymilvus import Collection
+
+from config.config_loader import config
+from document_store.milvus2_preference_store import (
+    EMBEDDING_DIM,
+    search_params_for_index,
+    select_index,
+    vector_index,
+)
+from document_store.numpy_preference_store import (
+    QUANTIZATION_VECTOR_DTYPES,
+    dequantize_vectors,
+    quantize_vectors,
+)
+from retrieval.sweep_index_params import load_vectors, rebuild_index
+from utils.llm import get_embedding
+from utils.milvus_utils import (
+    connection_alias,
+    get_database_backend,
+    get_milvus_client,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--collection_name",
+        type=str,
+        default=config.get("database", "collection_name"),
+    )
+    parser.add_argument(
+        "--extraction_result_dir",
+        type=str,
+        default="extraction/evaluation/gpt4o/eval_of_extraction_in_schema/dataset/eval_of_extraction.jsonl",
+    )
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 5, 10])
+    parser.add_argument(
+        "--milvus_indexes",
+        type=bool,
+        default=False,
+        help="also rebuild the collection with the IVF_SQ8 and IVF_PQ index (server backend)",
+    )
+    parser.add_argument(
+        "--output_file",
+        type=str,
+        default="retrieval/evaluation/quantization/quantization_report.json",
+    )
+    return parser.parse_args()
+
+
+def load_all_vectors(milvus_client, collection_name):
+    """returns {user_name: (pks, vector matrix)} of all stored preferences"""
+    if get_database_backend() == "server":
+        return load_vectors(
+            Collection(collection_name, using=connection_alias(milvus_client))
+        )
+    rows_by_user = {}
+    for row in milvus_client.query(
+        collection_name=collection_name,
+        filter="pk != ''",
+        output_fields=["pk", "user_name", "vector"],
+    ):
+        pks, vectors = rows_by_user.setdefault(row["user_name"], ([], []))
+        pks.append(row["pk"])
+        vectors.append(row["vector"])
+    return {
+        user_name: (pks, np.asarray(vectors, dtype=np.float32))
+        for user_name, (pks, vectors) in rows_by_user.items()
+    }
+
+
+def load_questions(path, users):
+    """returns [(user_name, conversation_uuid, question vector)] of the retrieval questions"""
+    questions = []
+    with open(path, "r") as file:
+        for line in file:
+            line = json.loads(line)
+            if line.get("user_uuid") not in users:
+                continue
+            for conversation in line["data"]:
+                if "next_conversation_question" in conversation:
+                    questions.append(
+                        (
+                            line["user_uuid"],
+                            conversation["conversation_uuid"],
+                            conversation["next_conversation_question"],
+                        )
+                    )
+    vectors = get_embedding().embed_documents([question for *_, question in questions])
+    return [
+        (user_name, conversation_uuid, np.asarray(vector, dtype=np.float32))
+        for (user_name, conversation_uuid, _), vector in zip(questions, vectors)
+    ]
+
+
+def top_k(pks, scores, limit):
+    top = np.argsort(-scores)[:limit]
+    return [pks[i] for i in top]
+
+
+def numpy_search(vectors_by_user, questions, vector_dtype, limit):
+    """searches the questions in the quantized vectors of their user like the numpy backend"""
+    stored_by_user = {
+        user_name: quantize_vectors(vectors, vector_dtype)
+        for user_name, (_, vectors) in vectors_by_user.items()
+    }
+    results = []
+    for user_name, _, query in questions:
+        pks = vectors_by_user[user_name][0]
+        vectors = dequantize_vectors(
+            stored_by_user[user_name], vector_dtype, EMBEDDING_DIM
+        )
+        results.append(top_k(pks, vectors @ query, limit))
+    return results
+
+
+def milvus_search(milvus_client, collection_name, questions, index, limit):
+    search_params = search_params_for_index(index, limit=limit)
+    results = []
+    for user_name, _, query in questions:
+        result = milvus_client.search(
+            collection_name=collection_name,
+            data=[query.tolist()],
+            filter=f"user_name=='{user_name}'",
+            limit=limit,
+            search_params=search_params,
+            output_fields=["pk"],
+        )
+        results.append([hit["id"] for hit in result[0]])
+    return results
+
+
+def evaluate(results, exact, ground_truth, ks):
+    report = {}
+    for k in ks:
+        report[f"recall@{k}"] = float(
+            np.mean(
+                [
+                    len(set(retrieved[:k]) & set(expected[:k]))
+                    / max(1, len(expected[:k]))
+                    for retrieved, expected in zip(results, exact)
+                ]
+            )
+        )
+    for k in ks:
+        report[f"hit@{k}"] = float(
+            np.mean(
+                [
+                    pk in retrieved[:k]
+                    for retrieved, pk in zip(results, ground_truth)
+                    if pk is not None
+                ]
+            )
+        )
+    return report
+
+
+def bytes_per_vector(mode, index=None):
+    if mode == "float16":
+        return 2 * EMBEDDING_DIM
+    if mode == "binary":
+        return (EMBEDDING_DIM + 7) // 8
+    if index is not None and index["index_type"] == "IVF_SQ8":
+        return EMBEDDING_DIM
+    if index is not None and index["index_type"] == "IVF_PQ":
+        return index["params"]["m"] * index["params"]["nbits"] // 8
+    return 4 * EMBEDDING_DIM
+
+
+def main():
+
+    args = parse_args()
+    load_dotenv()
+    milvus_client = get_milvus_client()
+    limit = max(args.k)
+
+    vectors_by_user = load_all_vectors(milvus_client, args.collection_name)
+    questions = load_questions(args.extraction_result_dir, set(vectors_by_user))
+    # the preferences are loaded with the conversation uuid as pk, questions of skipped conversations have no ground truth
+    ground_truth = [
+        (
+            conversation_uuid
+            if conversation_uuid in vectors_by_user[user_name][0]
+            else None
+        )
+        for user_name, conversation_uuid, _ in questions
+    ]
+    exact = numpy_search(vectors_by_user, questions, "float32", limit)
+    print(
+        f"{sum(len(pks) for pks, _ in vectors_by_user.values())} preferences of {len(vectors_by_user)} users, {len(questions)} questions"
+    )
+
+    results = []
+    for quantization, vector_dtype in QUANTIZATION_VECTOR_DTYPES.items():
+        result = {
+            "backend": "numpy",
+            "quantization": quantization,
+            "bytes_per_vector": bytes_per_vector(vector_dtype),
+            **evaluate(
+                numpy_search(vectors_by_user, questions, vector_dtype, limit),
+                exact,
+                ground_truth,
+                args.k,
+            ),
+        }
+        results.append(result)
+
+    if args.milvus_indexes:
+        if get_database_backend() != "server":
+            raise ValueError("--milvus_indexes needs the milvus server backend")
+        collection = Collection(
+            args.collection_name, using=connection_alias(milvus_client)
+        )
+        original_index = vector_index(collection)
+        original_index = original_index.params if original_index else None
+        max_partition_size = max(
+            (partition.num_entities for partition in collection.partitions), default=0
+        )
+        try:
+            for quantization in ("none", "sq8", "pq"):
+                index = select_index(
+                    collection.num_entities,
+                    max_partition_size,
+                    quantization=quantization,
+                )
+                rebuild_index(collection, index)
+                result = {
+                    "backend": "server",
+                    "quantization": quantization,
+                    "index_type": index["index_type"],
+                    "index_params": index["params"],
+                    "bytes_per_vector": bytes_per_vector(quantization, index),
+                    **evaluate(
+                        milvus_search(
+                            milvus_client,
+                            args.collection_name,
+                            questions,
+                            index,
+                            limit,
+                        ),
+                        exact,
+                        ground_truth,
+                        args.k,
+                    ),
+                }
+                results.append(result)
+        finally:
+            if original_index:
+                rebuild_index(collection, original_index)
+
+    for result in results:
+        print(
+            f"{result['backend']:<7} {result['quantization']:<8} {result['bytes_per_vector']:>6} B/vector  "
+            + "  ".join(f"recall@{k} {result[f'recall@{k}']:.3f}" for k in args.k)
+            + "  "
+            + "  ".join(f"hit@{k} {result[f'hit@{k}']:.3f}" for k in args.k)
+        )
+
+    os.makedirs(os.path.dirname(args.output_file), exist_ok=True)
+    with open(args.output_file, "w") as file:
+        json.dump(
+            {
+                "collection_name": args.collection_name,
+                "num_questions": len(questions),
+                "k": args.k,
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+
+
+if __name__ == "__main__":
+    main()
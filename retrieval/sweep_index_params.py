@@ -0,0 +1,242 @@
+"""
+File to benchmark vector index configurations on the loaded preferences.
+For every configuration the index of the collection is rebuilt, the retrieval questions are searched
+(filtered by user like in the retrieval evaluation) and recall@k against exact search and the p50/p99 latency are reported.
+The original index of the collection is restored at the end.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+# Add the project root to the sys.path
+project_root = Path(__file__).parent.parent
+sys.path.append(str(project_root))
+
+from dotenv import load_dotenv
+from pymilvus import Collection
+
+from config.config_loader import config
+from document_store.milvus2_preference_store import (
+    search_params_for_index,
+    vector_index,
+)
+from utils.llm import get_embedding
+from utils.milvus_utils import connection_alias, get_milvus_client
+
+SWEEP_CONFIGS = [
+    ({"index_type": "FLAT", "metric_type": "IP", "params": {}}, {}),
+    *[
+        (
+            {
+                "index_type": "HNSW",
+                "metric_type": "IP",
+                "params": {"M": m, "efConstruction": 200},
+            },
+            {"ef": ef},
+        )
+        for m in (8, 16, 32)
+        for ef in (16, 64, 256)
+    ],
+    *[
+        (
+            {"index_type": "IVF_FLAT", "metric_type": "IP", "params": {"nlist": nlist}},
+            {"nprobe": nprobe},
+        )
+        for nlist in (16, 128, 1024)
+        for nprobe in (1, 8, 32)
+        if nprobe <= nlist
+    ],
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--collection_name",
+        type=str,
+        default=config.get("database", "collection_name"),
+    )
+    parser.add_argument(
+        "--extraction_result_dir",
+        type=str,
+        default="extraction/evaluation/gpt4o/eval_of_extraction_in_schema/dataset/eval_of_extraction.jsonl",
+        help="the retrieval questions (next_conversation_question) of this file are used as queries",
+    )
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--num_queries", type=int, default=200)
+    parser.add_argument(
+        "--output_file",
+        type=str,
+        default="retrieval/evaluation/index_sweep/index_sweep.json",
+    )
+    return parser.parse_args()
+
+
+def load_vectors(collection):
+    """returns {user_name: (pks, vector matrix)} of all stored preferences"""
+    rows_by_user = {}
+    iterator = collection.query_iterator(
+        batch_size=1000, output_fields=["pk", "user_name", "vector"]
+    )
+    while True:
+        rows = iterator.next()
+        if not rows:
+            iterator.close()
+            break
+        for row in rows:
+            pks, vectors = rows_by_user.setdefault(row["user_name"], ([], []))
+            pks.append(row["pk"])
+            vectors.append(row["vector"])
+    return {
+        user_name: (pks, np.asarray(vectors, dtype=np.float32))
+        for user_name, (pks, vectors) in rows_by_user.items()
+    }
+
+
+def load_queries(path, users, num_queries):
+    queries = []
+    with open(path, "r") as file:
+        for line in file:
+            line = json.loads(line)
+            if line.get("user_uuid") not in users:
+                continue
+            for conversation in line["data"]:
+                if "next_conversation_question" in conversation:
+                    queries.append(
+                        (line["user_uuid"], conversation["next_conversation_question"])
+                    )
+    queries = queries[:num_queries]
+    vectors = get_embedding().embed_documents([question for _, question in queries])
+    return [
+        (user_name, np.asarray(vector, dtype=np.float32))
+        for (user_name, _), vector in zip(queries, vectors)
+    ]
+
+
+def exact_top_k(vectors_by_user, user_name, query, limit):
+    pks, vectors = vectors_by_user[user_name]
+    scores = vectors @ query
+    top = np.argsort(-scores)[:limit]
+    return [pks[i] for i in top]
+
+
+def rebuild_index(collection, index):
+    collection.release()
+    current_index = vector_index(collection)
+    if current_index:
+        collection.drop_index(index_name=current_index.index_name)
+    collection.create_index(field_name="vector", index_params=index)
+    collection.load()
+
+
+def run_config(milvus_client, collection_name, queries, exact, search_params, limit):
+    latencies = []
+    recalls = []
+    for (user_name, query), exact_ids in zip(queries, exact):
+        start_time = time.perf_counter()
+        result = milvus_client.search(
+            collection_name=collection_name,
+            data=[query.tolist()],
+            filter=f"user_name=='{user_name}'",
+            limit=limit,
+            search_params={"metric_type": "IP", "params": search_params},
+            output_fields=["pk"],
+        )
+        latencies.append(time.perf_counter() - start_time)
+        retrieved_ids = {hit["id"] for hit in result[0]}
+        recalls.append(len(retrieved_ids & set(exact_ids)) / max(1, len(exact_ids)))
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        "recall": float(np.mean(recalls)),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+    }
+
+
+def main():
+
+    args = parse_args()
+    load_dotenv()
+    milvus_client = get_milvus_client()
+    collection = Collection(args.collection_name, using=connection_alias(milvus_client))
+    original_index = vector_index(collection)
+    original_index = original_index.params if original_index else None
+
+    vectors_by_user = load_vectors(collection)
+    queries = load_queries(
+        args.extraction_result_dir, set(vectors_by_user), args.num_queries
+    )
+    exact = [
+        exact_top_k(vectors_by_user, user_name, query, args.limit)
+        for user_name, query in queries
+    ]
+    print(
+        f"{collection.num_entities} preferences of {len(vectors_by_user)} users, {len(queries)} queries"
+    )
+
+    results = []
+    try:
+        for index, search_params in SWEEP_CONFIGS:
+            rebuild_index(collection, index)
+            # warm up
+            run_config(
+                milvus_client,
+                args.collection_name,
+                queries[:5],
+                exact[:5],
+                search_params,
+                args.limit,
+            )
+            result = run_config(
+                milvus_client,
+                args.collection_name,
+                queries,
+                exact,
+                search_params,
+                args.limit,
+            )
+            result.update(
+                {
+                    "index_type": index["index_type"],
+                    "index_params": index["params"],
+                    "search_params": search_params,
+                }
+            )
+            results.append(result)
+            print(
+                f"{index['index_type']:<9} {json.dumps(index['params']):<32} {json.dumps(search_params):<16} "
+                f"recall@{args.limit} {result['recall']:.3f}  p50 {result['p50_ms']:.2f} ms  p99 {result['p99_ms']:.2f} ms"
+            )
+    finally:
+        if original_index:
+            rebuild_index(collection, original_index)
+
+    os.makedirs(os.path.dirname(args.output_file), exist_ok=True)
+    with open(args.output_file, "w") as file:
+        json.dump(
+            {
+                "collection_name": args.collection_name,
+                "num_entities": collection.num_entities,
+                "limit": args.limit,
+                "num_queries": len(queries),
+                "default_search_params": (
+                    search_params_for_index(original_index, args.limit)
+                    if original_index
+                    else None
+                ),
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+
+
+if __name__ == "__main__":
+    main()
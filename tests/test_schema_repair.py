@@ -0,0 +1,54 @@
+import sys
+from pathlib import Path
+
+# Add the project root to the sys.path
+project_root = Path(__file__).parent.parent
+sys.path.append(str(project_root))
+
+from extraction.pydantic_schemas.categories_pydantic import PreferencesFunctionOutput
+from extraction.schema_repair import repair_extraction
+
+PREFERENCE = {
+    "user_sentence_preference_revealed": "I love italian food",
+    "user_preference": "Italian",
+}
+
+
+def test_misplaced_detail_category_is_moved():
+    repaired = repair_extraction(
+        {"points_of_interest": {"favourite_cuisine": [PREFERENCE]}},
+        PreferencesFunctionOutput,
+    )
+    assert repaired == {
+        "points_of_interest": {"restaurant": {"favourite_cuisine": [PREFERENCE]}}
+    }
+
+
+def test_unknown_key_list_is_not_dropped_silently():
+    assert (
+        repair_extraction(
+            {"points_of_interest": {"restaurant": {"favourite_food": [PREFERENCE]}}},
+            PreferencesFunctionOutput,
+        )
+        is None
+    )
+
+
+def test_single_preference_dict_is_wrapped():
+    repaired = repair_extraction(
+        {"points_of_interest": {"restaurant": {"favourite_cuisine": PREFERENCE}}},
+        PreferencesFunctionOutput,
+    )
+    assert repaired == {
+        "points_of_interest": {"restaurant": {"favourite_cuisine": [PREFERENCE]}}
+    }
+
+
+def test_string_preference_is_not_dropped_silently():
+    assert (
+        repair_extraction(
+            {"points_of_interest": {"restaurant": {"favourite_cuisine": "Italian"}}},
+            PreferencesFunctionOutput,
+        )
+        is None
+    )
@@ -0,0 +1,133 @@
+import asyncio
+import json
+import os
+import threading
+from typing import Optional
+
+from utils.custom_logger import log_info
+
+
+def repair_jsonl(path: str) -> None:
+    """removes a partially written last line (e.g. after a crash during the write)"""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as file:
+        content = file.read()
+        if not content or content.endswith(b"\n"):
+            return
+        end = content.rfind(b"\n") + 1
+        log_info(f"Removing truncated last line of {path}")
+        file.truncate(end)
+
+
+def read_jsonl(path: str) -> list:
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def append_jsonl(path: str, record: dict) -> None:
+    """appends the record as one line with a single write and syncs it to disk before returning"""
+    with open(path, "a") as file:
+        file.write(json.dumps(record) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+
+class RunCheckpoint:
+    """
+    Checkpoint for the scripts that write one JSONL line per user (= per dataset line).
+    Finished users are read from the output file itself, finished conversations of users that are
+    not finished yet are kept in a sidecar file '<output_path>.progress'.
+    With resume=False the output file is appended to as before and the sidecar is started fresh.
+    Conversations that write to the database can also save each finished step (save_step), so a resumed
+    run continues after the last step instead of performing the writes of the conversation again.
+    """
+
+    def __init__(self, output_path: str, resume: bool = False, key: str = "user_uuid"):
+        self.output_path = output_path
+        self.progress_path = output_path + ".progress"
+        self.key = key
+        self.completed = set()
+        # {user key: {conversation index: conversation}}
+        self._conversations = {}
+        # {user key: {conversation index: (conversation, last finished step)}}
+        self._steps = {}
+        self._lock = threading.Lock()
+
+        if resume:
+            repair_jsonl(self.output_path)
+            repair_jsonl(self.progress_path)
+            self.completed = {
+                line.get(key) for line in read_jsonl(self.output_path)
+            } - {None}
+            for record in read_jsonl(self.progress_path):
+                if "step" in record:
+                    self._steps.setdefault(record["key"], {})[record["index"]] = (
+                        record["conversation"],
+                        record["step"],
+                    )
+                    continue
+                self._conversations.setdefault(record["key"], {})[record["index"]] = (
+                    record["conversation"]
+                )
+            log_info(
+                f"Resuming from {self.output_path}: {len(self.completed)} users and "
+                f"{sum(len(c) for c in self._conversations.values())} conversations already done"
+            )
+        elif os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
+
+    def is_completed(self, user_key: str) -> bool:
+        return user_key in self.completed
+
+    def conversation_result(self, user_key: str, index: int) -> Optional[dict]:
+        """returns the saved result of conversation 'index' of the user or None if it is not done yet"""
+        return self._conversations.get(user_key, {}).get(index)
+
+    def conversation_step(self, user_key: str, index: int) -> Optional[tuple]:
+        """returns (conversation, last finished step) of an unfinished conversation or None"""
+        if self.conversation_result(user_key, index) is not None:
+            return None
+        return self._steps.get(user_key, {}).get(index)
+
+    def save_step(
+        self, user_key: str, index: int, step: int, conversation: dict
+    ) -> None:
+        """saves the conversation after 'step' is finished, f.e. after each database write"""
+        with self._lock:
+            append_jsonl(
+                self.progress_path,
+                {
+                    "key": user_key,
+                    "index": index,
+                    "step": step,
+                    "conversation": conversation,
+                },
+            )
+
+    def save_conversation(self, user_key: str, index: int, conversation: dict) -> None:
+        with self._lock:
+            append_jsonl(
+                self.progress_path,
+                {"key": user_key, "index": index, "conversation": conversation},
+            )
+
+    async def asave_conversation(
+        self, user_key: str, index: int, conversation: dict
+    ) -> None:
+        """save_conversation off the event loop, the fsync does not stall other tasks"""
+        await asyncio.to_thread(self.save_conversation, user_key, index, conversation)
+
+    def write_line(self, line: dict) -> None:
+        """appends the finished line of a user to the output file"""
+        append_jsonl(self.output_path, line)
+        self.completed.add(line.get(self.key))
+        self._conversations.pop(line.get(self.key), None)
+        self._steps.pop(line.get(self.key), None)
+
+    def finish(self) -> None:
+        """removes the sidecar file once all users are written"""
+        if os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
@@ -0,0 +1,68 @@
+from typing import Optional
+
+from langchain_core.embeddings import Embeddings
+
+from config.config_loader import config
+from utils.latency import timer
+from utils.llm import get_embedding
+
+EMBEDDING_BATCH_SIZE = config.getint("embedding", "batch_size", fallback=256)
+
+
+class EmbeddingBatcher:
+    """
+    Collects texts together with the dict the embedding should be written to.
+    On flush the texts are embedded with embed_documents in chunks of 'chunk_size'
+    and the vectors are scattered back into the dicts (under 'key').
+    Identical texts are only embedded once.
+    """
+
+    def __init__(
+        self,
+        embedding: Optional[Embeddings] = None,
+        chunk_size: int = EMBEDDING_BATCH_SIZE,
+    ):
+        self.embedding = embedding if embedding is not None else get_embedding()
+        self.chunk_size = chunk_size
+        self._pending: list[tuple[str, dict, str]] = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, text: str, target: dict, key: str = "vector"):
+        """register 'text' to be embedded into target[key] on the next flush"""
+        self._pending.append((text, target, key))
+
+    def _take_pending(self):
+        # texts added while a flush is awaiting the embeddings belong to the next flush
+        pending, self._pending = self._pending, []
+        texts = list(dict.fromkeys(text for text, _, _ in pending))
+        return pending, texts
+
+    def _chunks(self, texts):
+        for i in range(0, len(texts), self.chunk_size):
+            yield texts[i : i + self.chunk_size]
+
+    def _scatter(self, pending, texts, vectors):
+        vector_by_text = dict(zip(texts, vectors))
+        for text, target, key in pending:
+            target[key] = vector_by_text[text]
+        return len(pending)
+
+    def flush(self) -> int:
+        """embeds all pending texts, returns the number of filled dicts"""
+        pending, texts = self._take_pending()
+        vectors = []
+        for chunk in self._chunks(texts):
+            with timer("embedding"):
+                vectors.extend(self.embedding.embed_documents(chunk))
+        return self._scatter(pending, texts, vectors)
+
+    async def aflush(self) -> int:
+        """async version of flush"""
+        pending, texts = self._take_pending()
+        vectors = []
+        for chunk in self._chunks(texts):
+            with timer("embedding"):
+                vectors.extend(await self.embedding.aembed_documents(chunk))
+        return self._scatter(pending, texts, vectors)
@@ -0,0 +1,184 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from utils.custom_logger import log_info
+
+
+def normalize_text(text: str) -> str:
+    return unicodedata.normalize("NFC", text).strip()
+
+
+def embedding_cache_key(model_name: str, text: str) -> str:
+    return hashlib.sha256(
+        f"{model_name}\x00{normalize_text(text)}".encode("utf-8")
+    ).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed on-disk embedding cache.
+    A sqlite index maps the key (hash of model name and normalized text) to a slot,
+    the vectors are stored as rows of a memory-mapped float32 matrix.
+    The cache holds at most 'max_entries' vectors, when it is full the least recently used slot is reused.
+    """
+
+    def __init__(self, directory: str, dim: int = 1536, max_entries: int = 100000):
+        os.makedirs(directory, exist_ok=True)
+        self.dim = dim
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._index = sqlite3.connect(
+            os.path.join(directory, "index.sqlite"), check_same_thread=False
+        )
+        self._index.execute(
+            "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)"
+        )
+        self._index.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, slot INTEGER UNIQUE, last_used REAL)"
+        )
+        self._index.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+
+        vectors_path = os.path.join(directory, "vectors.f32")
+        layout = dict(self._index.execute("SELECT name, value FROM meta").fetchall())
+        if layout != {"dim": dim, "max_entries": max_entries} or not os.path.exists(
+            vectors_path
+        ):
+            # new cache or changed layout, the stored vectors can not be reused
+            log_info(f"Creating embedding cache in {directory}")
+            self._index.execute("DELETE FROM embeddings")
+            self._index.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [("dim", dim), ("max_entries", max_entries)],
+            )
+            self._index.commit()
+            mode = "w+"
+        else:
+            mode = "r+"
+        self._vectors = np.memmap(
+            vectors_path, dtype=np.float32, mode=mode, shape=(max_entries, dim)
+        )
+
+    def __len__(self):
+        with self._lock:
+            return self._index.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_many(self, keys: List[str]) -> dict:
+        """returns {key: vector} for the keys that are cached"""
+        if not keys:
+            return {}
+        with self._lock:
+            found = {}
+            # sqlite limits the number of host parameters per statement
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                rows = self._index.execute(
+                    f"SELECT key, slot FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._index.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._index.commit()
+            return {key: np.array(self._vectors[slot]) for key, slot in found.items()}
+
+    def put_many(self, items: dict):
+        """stores {key: vector}, evicting the least recently used vectors if the cache is full"""
+        if not items:
+            return
+        with self._lock:
+            now = time.time()
+            for key, vector in items.items():
+                vector = np.asarray(vector, dtype=np.float32)
+                if vector.shape != (self.dim,):
+                    raise ValueError(
+                        f"Embedding has shape {vector.shape}, cache expects ({self.dim},)"
+                    )
+                row = self._index.execute(
+                    "SELECT slot FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row:
+                    slot = row[0]
+                else:
+                    slot = self._free_slot()
+                self._vectors[slot] = vector
+                self._index.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                    (key, slot, now),
+                )
+            self._vectors.flush()
+            self._index.commit()
+
+    def _free_slot(self) -> int:
+        used = self._index.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if used < self.max_entries:
+            # slots are handed out in order and only reused after eviction, so the next free slot is 'used'
+            return used
+        key, slot = self._index.execute(
+            "SELECT key, slot FROM embeddings ORDER BY last_used LIMIT 1"
+        ).fetchone()
+        self._index.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+        return slot
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model, texts that are already in the EmbeddingCache are not sent to the model.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model_name: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = model_name
+
+    def _lookup(self, texts):
+        keys = [embedding_cache_key(self.model_name, text) for text in texts]
+        cached = self.cache.get_many(list(dict.fromkeys(keys)))
+        # texts that only differ in normalization share a key and are embedded once
+        missing = {}
+        for text, key in zip(texts, keys):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        return keys, cached, missing
+
+    def _store(self, cached, missing, vectors):
+        new = dict(zip(missing.keys(), vectors))
+        self.cache.put_many(new)
+        cached.update({key: np.asarray(vector) for key, vector in new.items()})
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, cached, missing = self._lookup(texts)
+        if missing:
+            self._store(
+                cached, missing, self.embeddings.embed_documents(list(missing.values()))
+            )
+        return [cached[key].tolist() for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, cached, missing = self._lookup(texts)
+        if missing:
+            self._store(
+                cached,
+                missing,
+                await self.embeddings.aembed_documents(list(missing.values())),
+            )
+        return [cached[key].tolist() for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
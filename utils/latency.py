@@ -0,0 +1,119 @@
+"""
+Per-stage latency instrumentation.
+A stage (f.e. 'embedding' or 'milvus_search') is timed with the timer() context manager or the timed()
+decorator (sync and async functions). The durations are collected per stage for the whole run and
+write_latency_report() writes count, throughput and p50/p95/p99 of every stage as json at the end of a script.
+"""
+
+import asyncio
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config.config_loader import config
+from utils.custom_logger import log_info
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self._durations: Dict[str, List[float]] = defaultdict(list)
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self._durations[stage].append(seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """times the block, also if it raises"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start_time)
+
+    def timed(self, stage: str):
+        """decorator timing every call of a sync or async function"""
+
+        def decorator(function):
+            if asyncio.iscoroutinefunction(function):
+
+                @functools.wraps(function)
+                async def async_wrapper(*args, **kwargs):
+                    with self.timer(stage):
+                        return await function(*args, **kwargs)
+
+                return async_wrapper
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def report(self) -> dict:
+        """
+        per stage: count, total seconds, throughput (calls per second of the run) and
+        mean, p50, p95, p99 and max in milliseconds
+        """
+        wall_time = time.perf_counter() - self._started
+        with self._lock:
+            durations = {
+                stage: list(values) for stage, values in self._durations.items()
+            }
+        stages = {}
+        for stage, values in sorted(durations.items()):
+            values_ms = np.asarray(values) * 1000
+            p50, p95, p99 = np.percentile(values_ms, [50, 95, 99])
+            stages[stage] = {
+                "count": len(values),
+                "total_s": float(values_ms.sum() / 1000),
+                "throughput_per_s": len(values) / wall_time if wall_time else 0.0,
+                "mean_ms": float(values_ms.mean()),
+                "p50_ms": float(p50),
+                "p95_ms": float(p95),
+                "p99_ms": float(p99),
+                "max_ms": float(values_ms.max()),
+            }
+        return {"wall_time_s": wall_time, "stages": stages}
+
+    def reset(self):
+        with self._lock:
+            self._durations.clear()
+            self._started = time.perf_counter()
+
+
+# process wide recorder used by the scripts and modules
+latency_recorder = LatencyRecorder()
+timer = latency_recorder.timer
+timed = latency_recorder.timed
+
+
+def write_latency_report(name: str, report_dir: Optional[str] = None) -> dict:
+    """writes the report of the process wide recorder to <[latency] report_dir>/<name>.json and logs a summary"""
+    report = latency_recorder.report()
+    report_dir = report_dir or config.get(
+        "latency", "report_dir", fallback=".logs/latency"
+    )
+    os.makedirs(report_dir, exist_ok=True)
+    path = os.path.join(report_dir, f"{name}.json")
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+    for stage, stats in report["stages"].items():
+        print(
+            f"{stage:<20} n={stats['count']:<6} p50 {stats['p50_ms']:8.1f} ms  p95 {stats['p95_ms']:8.1f} ms  "
+            f"p99 {stats['p99_ms']:8.1f} ms  {stats['throughput_per_s']:.2f}/s"
+        )
+    log_info(f"Latency report written to {path}")
+    return report
@@ -10,9 +10,35 @@ from langchain_openai import (
 )
 
 from config.config_loader import config
+from utils.embedding_cache import CachedEmbeddings, EmbeddingCache
+from utils.llm_cache import LLM_CACHE_MODES, RecordReplayLLMCache
 
 load_dotenv()
 
+_embedding_cache = None
+_llm_cache = None
+
+
+def get_llm_cache(temperature=0.0):
+    """
+    returns the record/replay response cache configured in the [llm_cache] section of the config.
+    only deterministic calls (temperature 0.0) are cached, sampled generations always call the api.
+    """
+    global _llm_cache
+    mode = config.get("llm_cache", "mode", fallback="off")
+    if mode not in LLM_CACHE_MODES:
+        raise ValueError(f"llm_cache mode must be one of {LLM_CACHE_MODES}, not {mode}")
+    if mode == "off" or temperature != 0.0:
+        return None
+    if _llm_cache is None:
+        _llm_cache = RecordReplayLLMCache(
+            database_path=config.get(
+                "llm_cache", "path", fallback=".cache/llm_cache.sqlite"
+            ),
+            mode=mode,
+        )
+    return _llm_cache
+
 
 # ==== Azure OpenAI ====
 def get_llm_gpt35_azure_openai(temperature=0.0):
@@ -24,6 +50,7 @@ def get_llm_gpt35_azure_openai(temperature=0.0):
         azure_endpoint=os.getenv("AZURE__OPENAI_API_BASE"),
         openai_api_version="2023-07-01-preview",
         openai_api_key=os.getenv("AZURE__OPENAI_API_KEY"),
+        cache=get_llm_cache(temperature),
     )
 
 
@@ -36,6 +63,7 @@ def get_llm_gpt4o_azure_openai(temperature=0.0):
         azure_endpoint=os.getenv("AZURE__OPENAI_API_BASE"),
         openai_api_version="2023-07-01-preview",
         openai_api_key=os.getenv("AZURE__OPENAI_API_KEY"),
+        cache=get_llm_cache(temperature),
     )
 
 
@@ -58,6 +86,7 @@ def get_llm_gpt35_openai(temperature=0.0):
         model="gpt-35-turbo",
         temperature=temperature,
         openai_api_key=os.getenv("OPENAI_API_KEY"),
+        cache=get_llm_cache(temperature),
     )
 
 
@@ -68,6 +97,7 @@ def get_llm_gpt4o_openai(temperature=0.0):
         model="gpt-4o-2024-08-06",
         temperature=temperature,
         openai_api_key=os.getenv("OPENAI_API_KEY"),
+        cache=get_llm_cache(temperature),
     )
 
 
@@ -96,9 +126,32 @@ def get_llm_gpt4o(temperature=0.0):
         return get_llm_gpt4o_openai(temperature)
 
 
+def get_embedding_cache():
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = EmbeddingCache(
+            directory=config.get(
+                "embedding", "cache_dir", fallback=".cache/embeddings"
+            ),
+            dim=config.getint("embedding", "dim", fallback=1536),
+            max_entries=config.getint(
+                "embedding", "cache_max_entries", fallback=100000
+            ),
+        )
+    return _embedding_cache
+
+
 def get_embedding():
     config_use_azure = config.get("use_azure", "use_azure_openai")
     if config_use_azure == "True":
-        return get_embedding_azure_openai()
+        embedding = get_embedding_azure_openai()
     else:
-        return get_embedding_openai()
+        embedding = get_embedding_openai()
+    if config.getboolean("embedding", "cache_enabled", fallback=False):
+        # unchanged texts are served from the on-disk cache instead of the api
+        return CachedEmbeddings(
+            embeddings=embedding,
+            cache=get_embedding_cache(),
+            model_name=embedding.model,
+        )
+    return embedding
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Optional
+
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.load import dumps, loads
+
+from utils.custom_logger import log_debug
+
+LLM_CACHE_MODES = ("off", "record", "replay")
+
+
+class LLMCacheMissError(KeyError):
+    """Raised in replay mode if a llm call is not in the cache."""
+
+
+class RecordReplayLLMCache(BaseCache):
+    """
+    Persistent (sqlite) cache for chat model responses.
+    The key is the hash of the serialized messages and the llm string, which holds the model,
+    its parameters and the bound kwargs (functions, function_call, tools).
+    mode 'record': serves hits from the cache and stores the responses of misses.
+    mode 'replay': only serves from the cache and raises LLMCacheMissError on a miss,
+    so a pipeline run can not silently call the api.
+    """
+
+    def __init__(self, database_path: str, mode: str = "record"):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"LLM cache mode must be 'record' or 'replay', not {mode}")
+        if os.path.dirname(database_path):
+            os.makedirs(os.path.dirname(database_path), exist_ok=True)
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(database_path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, generations TEXT)"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        key = self._key(prompt, llm_string)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT generations FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row:
+            log_debug(f"LLM cache hit: {key}")
+            return [loads(generation) for generation in json.loads(row[0])]
+        if self.mode == "replay":
+            raise LLMCacheMissError(
+                f"LLM call {key} is not in the cache, record it first (llm_cache mode = record)"
+            )
+        return None
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        if self.mode == "replay":
+            return
+        key = self._key(prompt, llm_string)
+        generations = json.dumps([dumps(generation) for generation in return_val])
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO llm_cache VALUES (?, ?)", (key, generations)
+            )
+            self._connection.commit()
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM llm_cache")
+            self._connection.commit()
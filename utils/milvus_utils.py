@@ -1,24 +1,297 @@
-import configparser
+import asyncio
+import itertools
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
-from pymilvus import connections
+from pymilvus import MilvusClient, connections
 
+from config.config_loader import config
+from utils.custom_logger import log_info, log_warning
+from utils.latency import timer
 
-def connect2milvusdb():
+DATABASE_BACKENDS = ("server", "lite", "numpy")
 
-    # Creating Personalization VectorDB
-    config = configparser.ConfigParser()
-    config.read("config/config.ini")
-    load_dotenv()
+_client_pool = None
+_client_pool_lock = threading.Lock()
+_async_client = None
 
-    # MILVUS_HOST = "delphi.northeurope.cloudapp.azure.com"
-    MILVUS_HOST = config.get("database", "host")
-    MILVUS_PORT = config.get("database", "port")
+
+def connect2milvusdb():
+    """connects the 'default' alias of the pymilvus ORM to the configured backend (server or lite)"""
+    load_dotenv()
     print("Testing connection to milvus...")
-    connections.connect(
-        "default",
-        host=MILVUS_HOST,
-        port=MILVUS_PORT,
-    )
+    connections.connect("default", uri=get_milvus_uri())
     print("Connected")
+
+
+def get_database_backend() -> str:
+    """
+    'server': milvus standalone of the docker compose,
+    'lite': embedded milvus-lite on a local .db file,
+    'numpy': in-process store, see document_store/numpy_preference_store.py
+    """
+    backend = config.get("database", "backend", fallback="server")
+    if backend not in DATABASE_BACKENDS:
+        raise ValueError(
+            f"database backend must be one of {DATABASE_BACKENDS}, not {backend}"
+        )
+    return backend
+
+
+def get_milvus_uri():
+    if get_database_backend() == "lite":
+        # pymilvus starts milvus-lite for uris that are a local .db file
+        lite_path = config.get("database", "lite_path", fallback=".cache/milvus.db")
+        if os.path.dirname(lite_path):
+            os.makedirs(os.path.dirname(lite_path), exist_ok=True)
+        return lite_path
+    return f"http://{config.get('database', 'host')}:{config.get('database', 'port')}"
+
+
+# MilvusClient methods that can be repeated after a connection failure without duplicating data
+IDEMPOTENT_METHODS = frozenset(
+    {
+        "query",
+        "search",
+        "get",
+        "upsert",
+        "delete",
+        "flush",
+        "has_collection",
+        "describe_collection",
+        "list_collections",
+        "list_indexes",
+        "describe_index",
+        "get_collection_stats",
+        "load_collection",
+        "get_server_version",
+    }
+)
+
+
+class PooledMilvusClient:
+    """
+    Handle on one client of the MilvusClientPool with the methods of MilvusClient.
+    Every call goes to the current client of the pool slot, so a handle kept for the whole run
+    (f.e. by a store or a script) uses the new connection after a reconnect.
+    If a call fails and the connection is broken, the slot is reconnected and idempotent calls are
+    repeated once, other calls (insert) raise and the next call uses the new connection.
+    """
+
+    def __init__(self, pool: "MilvusClientPool", index: int):
+        self._pool = pool
+        self._index = index
+
+    @property
+    def client(self) -> MilvusClient:
+        return self._pool.client(self._index)
+
+    @property
+    def using(self) -> str:
+        """alias of the pymilvus ORM connection of the current client, for Collection(..., using=...)"""
+        return self.client._using
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            try:
+                return getattr(self.client, name)(*args, **kwargs)
+            except Exception:
+                if not self._pool.reconnect_if_broken(self._index):
+                    raise
+                if name not in IDEMPOTENT_METHODS:
+                    raise
+                log_warning(f"Repeating milvus {name} on the new connection")
+                return getattr(self.client, name)(*args, **kwargs)
+
+        return call
+
+
+def connection_alias(milvus_client) -> str:
+    """ORM connection alias of a pooled or plain MilvusClient"""
+    if isinstance(milvus_client, PooledMilvusClient):
+        return milvus_client.using
+    return milvus_client._using
+
+
+class MilvusClientPool:
+    """
+    Process wide pool of MilvusClients. Each client holds one long-lived gRPC channel (with keep-alive),
+    the pool slots are handed out round robin as PooledMilvusClient handles. A client that was not used
+    for 'health_check_interval' seconds is checked with a cheap server call before it is handed out,
+    a client whose call failed is checked right away, and a broken client is replaced.
+    Replaced clients are not closed while the pool is open, callers may still be in a call on them.
+    """
+
+    def __init__(self, uri: str, size: int = 2, health_check_interval: float = 30.0):
+        self.uri = uri
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self._lock = threading.Lock()
+        self._clients = []
+        self._retired = []
+        self._next = itertools.cycle(range(size))
+        self._open()
+
+    def _open(self):
+        self._clients = [self._connect() for _ in range(self.size)]
+        self._last_checked = [time.monotonic()] * self.size
+
+    def _connect(self) -> MilvusClient:
+        log_info(f"Connecting to milvus at {self.uri}")
+        return MilvusClient(uri=self.uri)
+
+    def _is_healthy(self, client: MilvusClient) -> bool:
+        try:
+            client.get_server_version()
+            return True
+        except Exception as e:
+            log_warning(f"Milvus connection health check failed: {e}")
+            return False
+
+    def client(self, index: int) -> MilvusClient:
+        """current client of the pool slot, reopens the pool after close()"""
+        with self._lock:
+            if not self._clients:
+                self._open()
+            return self._clients[index]
+
+    def reconnect(self, index: int) -> MilvusClient:
+        """replaces the client at 'index' with a new connection, the old one is retired"""
+        with self._lock:
+            if not self._clients:
+                self._open()
+            else:
+                self._retired.append(self._clients[index])
+                self._clients[index] = self._connect()
+            self._last_checked[index] = time.monotonic()
+            return self._clients[index]
+
+    def reconnect_if_broken(self, index: int) -> bool:
+        """health checks the client at 'index' and replaces it if broken, returns if it was replaced"""
+        if self._is_healthy(self.client(index)):
+            return False
+        self.reconnect(index)
+        return True
+
+    def get(self) -> PooledMilvusClient:
+        with self._lock:
+            index = next(self._next)
+        client = self.client(index)
+        with self._lock:
+            check = (
+                time.monotonic() - self._last_checked[index]
+                > self.health_check_interval
+            )
+        if check:
+            if not self._is_healthy(client):
+                self.reconnect(index)
+            else:
+                self._last_checked[index] = time.monotonic()
+        return PooledMilvusClient(self, index)
+
+    def close(self):
+        """closes all clients, the next get() or call of a handle reconnects"""
+        with self._lock:
+            for client in self._clients + self._retired:
+                try:
+                    client.close()
+                except Exception:
+                    pass
+            self._clients = []
+            self._retired = []
+
+
+def get_milvus_client_pool() -> MilvusClientPool:
+    global _client_pool
+    with _client_pool_lock:
+        if _client_pool is None:
+            _client_pool = MilvusClientPool(
+                uri=get_milvus_uri(),
+                # milvus-lite serves one local file, there is nothing to pool
+                size=(
+                    1
+                    if get_database_backend() == "lite"
+                    else config.getint("database", "pool_size", fallback=2)
+                ),
+                health_check_interval=config.getfloat(
+                    "database", "health_check_interval", fallback=30.0
+                ),
+            )
+    return _client_pool
+
+
+def get_milvus_client() -> PooledMilvusClient:
+    """
+    returns a pooled, health checked MilvusClient handle, use this instead of creating a MilvusClient per operation.
+    all clients are created here, for the server or the milvus-lite file of the [database] backend.
+    with [database] backend = numpy the in-process NumpyPreferenceClient with the same methods is returned.
+    """
+    if get_database_backend() == "numpy":
+        from document_store.numpy_preference_store import get_numpy_client
+
+        return get_numpy_client()
+    return get_milvus_client_pool().get()
+
+
+class AsyncMilvusClient:
+    """
+    Awaitable query, search, insert, upsert and delete for async code (f.e. alongside the LLM calls).
+    pymilvus 2.4 has no asyncio client, so the blocking calls of the pooled clients (see get_milvus_client)
+    run on a dedicated I/O thread pool and the event loop is not blocked while milvus answers.
+    The arguments are the ones of the MilvusClient methods.
+    """
+
+    def __init__(self, max_workers: int = 4):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="milvus-io"
+        )
+
+    async def _run(self, method: str, *args, **kwargs):
+        # the client is taken from the pool in the worker, its health check blocks as well
+        def call():
+            with timer(f"milvus_{method}"):
+                return getattr(get_milvus_client(), method)(*args, **kwargs)
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    async def query(self, collection_name: str, **kwargs):
+        return await self._run("query", collection_name=collection_name, **kwargs)
+
+    async def search(self, collection_name: str, data, **kwargs):
+        return await self._run(
+            "search", collection_name=collection_name, data=data, **kwargs
+        )
+
+    async def insert(self, collection_name: str, data, **kwargs):
+        return await self._run(
+            "insert", collection_name=collection_name, data=data, **kwargs
+        )
+
+    async def upsert(self, collection_name: str, data, **kwargs):
+        return await self._run(
+            "upsert", collection_name=collection_name, data=data, **kwargs
+        )
+
+    async def delete(self, collection_name: str, **kwargs):
+        return await self._run("delete", collection_name=collection_name, **kwargs)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+def get_async_milvus_client() -> AsyncMilvusClient:
+    """process wide AsyncMilvusClient with [database] io_threads worker threads"""
+    global _async_client
+    with _client_pool_lock:
+        if _async_client is None:
+            _async_client = AsyncMilvusClient(
+                max_workers=config.getint("database", "io_threads", fallback=4)
+            )
+    return _async_client
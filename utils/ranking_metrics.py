@@ -0,0 +1,72 @@
+"""
+Ranking metrics of retrieval results, computed for all queries and cutoffs at once.
+The results are given as a relevance matrix (one row per query, one column per rank) and the
+cutoffs k per query, so cutoffs that depend on the query (f.e. number of relevant preferences + 1)
+cost the same as fixed ones.
+"""
+
+from typing import Callable, Dict, Optional, Sequence
+
+import numpy as np
+
+
+def relevance_matrix(
+    retrieved: Sequence[Sequence], is_relevant: Callable[[int, object], bool]
+) -> np.ndarray:
+    """
+    returns the bool matrix (queries x max number of results) of is_relevant(query index, result),
+    shorter result lists are padded with not relevant
+    """
+    depth = max((len(results) for results in retrieved), default=0)
+    relevance = np.zeros((len(retrieved), depth), dtype=bool)
+    for row, results in enumerate(retrieved):
+        relevance[row, : len(results)] = [
+            is_relevant(row, result) for result in results
+        ]
+    return relevance
+
+
+def ranking_metrics(
+    relevance: np.ndarray,
+    cutoffs,
+    num_relevant: Optional[Sequence[int]] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    relevance: bool matrix (queries x ranks)
+    cutoffs: k per query and cutoff, shape (queries, cutoffs), or (cutoffs,) for the same k for all queries
+    num_relevant: number of relevant items per query for recall, defaults to the relevant retrieved ones
+    returns arrays of shape (queries, cutoffs):
+    'hit' (a relevant result within the top k), 'precision' (relevant results in the top k / k),
+    'recall' (relevant results in the top k / num_relevant) and 'reciprocal_rank' (1 / rank of the first
+    relevant result if it is within the top k, else 0, the mean over the queries is the MRR@k).
+    """
+    relevance = np.asarray(relevance, dtype=bool)
+    num_queries, depth = relevance.shape
+    cutoffs = np.asarray(cutoffs, dtype=int)
+    if cutoffs.ndim == 1:
+        cutoffs = np.broadcast_to(cutoffs, (num_queries, len(cutoffs)))
+    # relevant results within the first k ranks, k = 0..depth
+    relevant_at = np.zeros((num_queries, depth + 1), dtype=int)
+    np.cumsum(relevance, axis=1, out=relevant_at[:, 1:])
+    relevant_in_top_k = np.take_along_axis(
+        relevant_at, np.clip(cutoffs, 0, depth), axis=1
+    )
+
+    if num_relevant is None:
+        num_relevant = relevant_at[:, -1]
+    num_relevant = np.asarray(num_relevant, dtype=float).reshape(-1, 1)
+
+    first_rank = (
+        relevance.argmax(axis=1) + 1 if depth else np.zeros(num_queries, dtype=int)
+    )
+    first_rank = np.where(relevance.any(axis=1), first_rank, 0)
+    first_rank = first_rank.reshape(-1, 1)
+    found = (first_rank > 0) & (first_rank <= cutoffs)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            "hit": relevant_in_top_k > 0,
+            "precision": np.where(cutoffs > 0, relevant_in_top_k / cutoffs, 0.0),
+            "recall": np.where(num_relevant > 0, relevant_in_top_k / num_relevant, 0.0),
+            "reciprocal_rank": np.where(found, 1.0 / np.maximum(first_rank, 1), 0.0),
+        }